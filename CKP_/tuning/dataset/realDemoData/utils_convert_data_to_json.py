@@ -6,20 +6,8 @@ import pandas as pd
 import argparse
 import os
 
-def load_excel_data(file_path):
-    """Load data from Excel file"""
-    try:
-        df = pd.read_excel(file_path)
-        return df
-    except Exception as e:
-        print(f"❌ Error reading Excel file: {e}")
-        return None
-
-def convert_excel_to_json(df):
-    """Convert Excel DataFrame to JSON format with system prompt"""
-    
-    # System prompt for Pika character
-    system_prompt = """**TASK:** Generate a Fast Response for Pika (ESL Robot for Vietnamese children 5-10 years old) that bridges CONVERSATION HISTORY and MAIN ANSWER.
+# System prompt for Pika character
+PIKA_SYSTEM_PROMPT = """**TASK:** Generate a Fast Response for Pika (ESL Robot for Vietnamese children 5-10 years old) that bridges CONVERSATION HISTORY and MAIN ANSWER.
 
 **Pika Character (Official Guidelines):**
 - ESL teaching robot for Vietnamese children, supportive and educational
@@ -43,6 +31,20 @@ def convert_excel_to_json(df):
 
 **COHERENCE CHECK:**
 Last Robot Message + Last User Message + Fast Response + Main Answer = Natural conversation flow"""
+
+def load_excel_data(file_path):
+    """Load data from Excel file"""
+    try:
+        df = pd.read_excel(file_path)
+        return df
+    except Exception as e:
+        print(f"❌ Error reading Excel file: {e}")
+        return None
+
+def convert_excel_to_json(df):
+    """Convert Excel DataFrame to JSON format with system prompt"""
+    
+    system_prompt = PIKA_SYSTEM_PROMPT
     
     result = []
     
@@ -76,6 +78,23 @@ Last Robot Message + Last User Message + Fast Response + Main Answer = Natural c
     
     return result
 
+def convert_multi_target_json(data):
+    """Add Pika system prompt ONCE per multi-target conversation (output of processed.py --multi-target)"""
+    result = []
+    
+    for index, item in enumerate(data):
+        conversation = item.get("conversations", []) if isinstance(item, dict) else []
+        if not conversation:
+            print(f"❌ Error processing item {index}: no conversations")
+            continue
+        
+        if conversation[0].get("role") != "system":
+            conversation = [{"role": "system", "content": PIKA_SYSTEM_PROMPT}] + conversation
+        
+        result.append({"conversations": conversation})
+    
+    return result
+
 def save_json(data, output_path):
     """Save data to JSON file"""
     try:
@@ -86,8 +105,8 @@ def save_json(data, output_path):
         print(f"❌ Error saving file: {e}")
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert Excel to JSON with Pika system prompt")
-    parser.add_argument('-i', '--input', required=True, help='Input Excel file')
+    parser = argparse.ArgumentParser(description="Convert Excel (or multi-target JSON) to JSON with Pika system prompt")
+    parser.add_argument('-i', '--input', required=True, help='Input Excel file, or multi-target JSON from processed.py --multi-target')
     parser.add_argument('-o', '--output', help='Output JSON file')
     
     args = parser.parse_args()
@@ -106,6 +125,17 @@ def main():
     print(f"🚀 Converting {input_file} to {output_file}")
     print("📋 Adding Pika system prompt to all conversations")
     
+    # Multi-target JSON: system prompt once per conversation, not once per turn
+    if input_file.endswith('.json'):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            json_data = convert_multi_target_json(json.load(f))
+        if json_data:
+            save_json(json_data, output_file)
+            print(f"✅ Conversion complete! Format: multi-target conversations (train with multi_target: true)")
+        else:
+            print("❌ No data to save")
+        return
+    
     # Load Excel file
     df = load_excel_data(input_file)
     if df is None:
@@ -1,38 +1,162 @@
 import requests
 import json
 import os
-from typing import Optional
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+from requests.adapters import HTTPAdapter
+
+# Status code đáng retry (rate limit + lỗi phía server)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 class ConversationDataFetcher:
-    def __init__(self, api_token: str):
+    def __init__(self, api_token: str, connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 max_retries: int = 4, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 pool_size: int = 16):
         self.api_token = api_token
         self.base_url = "https://robot-api.hacknao.edu.vn/robot/api/v1/admin/conversations"
         self.headers = {
             'X-API-Key': api_token,
             'accept': 'application/json'
         }
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+
+        # Session dùng chung: giữ kết nối keep-alive, không bắt tay TCP/TLS lại mỗi request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Thống kê latency từng request (ms), số lần retry, số ID lỗi
+        self._stats_lock = threading.Lock()
+        self.latencies = []
+        self.retries = 0
+        self.failures = 0
         
         # Tạo folder input nếu chưa có
         if not os.path.exists('input'):
             os.makedirs('input')
     
+    def _backoff_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """
+        Exponential backoff với full jitter; ưu tiên header Retry-After (429/503) nếu có
+        """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _record(self, latency_ms: float, retries: int, failed: bool):
+        with self._stats_lock:
+            self.latencies.append(latency_ms)
+            self.retries += retries
+            self.failures += int(failed)
+
     def fetch_conversation(self, conversation_id: str) -> Optional[dict]:
         """
-        Lấy dữ liệu conversation từ API
+        Lấy dữ liệu conversation từ API (timeout + retry với backoff khi 429/5xx/lỗi kết nối)
         """
         url = f"{self.base_url}/{conversation_id}"
         
-        try:
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                latency_ms = (time.perf_counter() - start_time) * 1000
             
-            data = response.json()
-            print(f"✅ Lấy dữ liệu thành công cho conversation ID: {conversation_id}")
-            return data
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                    delay = self._backoff_delay(attempt, response)
+                    print(f"⚠️ HTTP {response.status_code} cho conversation ID {conversation_id}, "
+                          f"thử lại sau {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                    time.sleep(delay)
+                    continue
             
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Lỗi khi lấy dữ liệu cho conversation ID {conversation_id}: {e}")
+                response.raise_for_status()
+                data = response.json()
+                self._record(latency_ms, attempt, failed=False)
+                print(f"✅ Lấy dữ liệu thành công cho conversation ID: {conversation_id} ({latency_ms:.0f}ms)")
+                return data
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt < self.max_retries:
+                    delay = self._backoff_delay(attempt)
+                    print(f"⚠️ {type(e).__name__} cho conversation ID {conversation_id}, "
+                          f"thử lại sau {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                    time.sleep(delay)
+                    continue
+                error = e
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # 4xx (trừ 429) hoặc JSON lỗi: retry cũng không giúp được
+                error = e
+
+            # Lần cuối vẫn 429/5xx thì raise_for_status() cũng rơi vào đây
+            self._record((time.perf_counter() - start_time) * 1000, attempt, failed=True)
+            print(f"❌ Lỗi khi lấy dữ liệu cho conversation ID {conversation_id}: {error}")
             return None
+
+    async def fetch_many(self, conversation_ids: List[str], concurrency: int = None) -> Dict[str, Optional[dict]]:
+        """
+        Lấy nhiều conversation song song (tối đa `concurrency` request cùng lúc, dùng chung connection pool)
+        """
+        concurrency = concurrency or self.pool_size
+        loop = asyncio.get_running_loop()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, self.fetch_conversation, conv_id) for conv_id in conversation_ids
+            ))
+        return dict(zip(conversation_ids, results))
+
+    def fetch_many_and_save(self, conversation_ids: List[str], concurrency: int = None) -> Dict[str, str]:
+        """
+        Lấy và lưu nhiều conversation song song, trả về {ID: đường dẫn file ('' nếu lỗi)}
+        """
+        results = asyncio.run(self.fetch_many(conversation_ids, concurrency))
+        return {
+            conv_id: self.save_to_file(conv_id, data) if data else ""
+            for conv_id, data in results.items()
+        }
+
+    def latency_stats(self) -> dict:
+        """
+        Thống kê latency (ms) của các request đã gọi
+        """
+        with self._stats_lock:
+            latencies = sorted(self.latencies)
+            retries, failures = self.retries, self.failures
+        if not latencies:
+            return {'requests': 0, 'retries': retries, 'failures': failures}
+
+        def percentile(p: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 1)
+
+        return {
+            'requests': len(latencies),
+            'retries': retries,
+            'failures': failures,
+            'mean_ms': round(sum(latencies) / len(latencies), 1),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': round(latencies[-1], 1),
+        }
+
+    def print_latency_stats(self):
+        stats = self.latency_stats()
+        print(f"\n🌐 THỐNG KÊ FETCH API: {stats['requests']} IDs, {stats['retries']} lần retry, "
+              f"{stats['failures']} lỗi")
+        if stats['requests']:
+            print(f"   Latency: TB {stats['mean_ms']}ms | p50 {stats['p50_ms']}ms | p95 {stats['p95_ms']}ms | "
+                  f"p99 {stats['p99_ms']}ms | max {stats['max_ms']}ms")
     
     def save_to_file(self, conversation_id: str, data: dict) -> str:
         """
@@ -69,6 +193,6 @@ if __name__ == "__main__":
     # Test với ID mẫu
     test_ids = ["8532", "358", "359", "362"]
     
-    for conv_id in test_ids:
-        print(f"\n🔄 Đang xử lý conversation ID: {conv_id}")
-        fetcher.fetch_and_save(conv_id)
+    print(f"\n🔄 Đang lấy song song {len(test_ids)} conversation IDs: {', '.join(test_ids)}")
+    fetcher.fetch_many_and_save(test_ids)
+    fetcher.print_latency_stats()
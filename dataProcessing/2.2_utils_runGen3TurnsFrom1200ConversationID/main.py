@@ -15,6 +15,14 @@
 4. 📊 Merge: Gộp tất cả kết quả vào 1 file Excel
 5. 🗑️ Cleanup: Xóa các file trung gian, chỉ giữ file merged
 
+⚡ CHẠY SONG SONG (mặc định):
+- Bước 1-3 chạy như một pipeline asyncio: mỗi bước có nhiều worker và hàng đợi
+  giới hạn (bounded queue) nối các bước với nhau
+- Fetch/Eval (I/O) chạy trong thread pool, Process (CPU) chạy trong process pool
+- ID lỗi ở bước nào thì dừng ở bước đó, các ID khác vẫn chạy tiếp
+- Tổng thời gian ≈ thời gian của bước chậm nhất thay vì tổng 3 bước x số IDs
+- --sequential: chạy tuần tự từng ID như trước
+
 📁 CẤU TRÚC THƯ MỤC:
 - input/: Dữ liệu raw từ API
 - output/: Dữ liệu đã xử lý
@@ -24,6 +32,7 @@
 🎯 CÁCH SỬ DỤNG:
 python main_v2MergerClear.py --ids 358 359 362 --token your_token
 python main_v2MergerClear.py --id_file ids.txt --token your_token
+python main.py --id_file ids.txt --token your_token --fetch_concurrency 8 --process_workers 4 --eval_concurrency 4
 
 📊 KẾT QUẢ CUỐI CÙNG:
 - 1 file Excel duy nhất chứa tất cả conversation data
@@ -35,18 +44,37 @@ python main_v2MergerClear.py --id_file ids.txt --token your_token
 import sys
 import argparse
 import os
+import time
+import asyncio
 import pandas as pd
 import glob
 import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from get_data_conversation import ConversationDataFetcher
 from processed import ConversationProcessor
 from run_eval_api_fast_response import FastResponseEvaluator
 
+STAGES = ['fetch', 'process', 'eval']
+
+
+def process_in_worker(input_file: str, processed_file: str) -> bool:
+    """
+    Bước 2 trong process pool (mỗi process tự tạo ConversationProcessor)
+    """
+    return ConversationProcessor().process_file(input_file, processed_file)
+
+
 class FastResponsePipeline:
-    def __init__(self, api_token: str):
+    def __init__(self, api_token: str, fetch_concurrency: int = 8, process_workers: int = None,
+                 eval_concurrency: int = 4, queue_size: int = 32, sequential: bool = False):
         self.api_token = api_token
-        self.fetcher = ConversationDataFetcher(api_token)
+        self.fetch_concurrency = fetch_concurrency
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.eval_concurrency = eval_concurrency
+        self.queue_size = queue_size
+        self.sequential = sequential
+        self.fetcher = ConversationDataFetcher(api_token, pool_size=fetch_concurrency)
         self.processor = ConversationProcessor()
         self.evaluator = FastResponseEvaluator()
         
@@ -63,15 +91,7 @@ class FastResponsePipeline:
         print(f"🔄 Bắt đầu xử lý conversation ID: {conversation_id}")
         print(f"{'='*50}")
         
-        results = {
-            'id': conversation_id,
-            'fetch_status': 'FAILED',
-            'process_status': 'FAILED',
-            'eval_status': 'FAILED',
-            'input_file': '',
-            'processed_file': '',
-            'eval_file': ''
-        }
+        results = self.new_result(conversation_id)
         
         # Bước 1: Lấy dữ liệu
         print(f"📥 Bước 1: Lấy dữ liệu từ API...")
@@ -106,6 +126,155 @@ class FastResponsePipeline:
         print(f"✅ Hoàn thành xử lý ID: {conversation_id}")
         return results
     
+    def new_result(self, conversation_id: str) -> dict:
+        return {
+            'id': conversation_id,
+            'fetch_status': 'FAILED',
+            'process_status': 'FAILED',
+            'eval_status': 'FAILED',
+            'input_file': '',
+            'processed_file': '',
+            'eval_file': '',
+            'error': ''
+        }
+
+    async def run_stages_async(self, conversation_ids: list) -> list:
+        """
+        Chạy Fetch -> Process -> Evaluate song song cho tất cả IDs
+
+        Mỗi bước có một nhóm worker riêng, nối với nhau bằng asyncio.Queue giới hạn
+        kích thước (bước sau chậm thì bước trước tự chờ, không dồn file trung gian).
+        ID lỗi ở bước nào thì dừng ở bước đó, các ID khác vẫn chạy tiếp.
+        """
+        loop = asyncio.get_running_loop()
+        total = len(conversation_ids)
+        results = {conv_id: self.new_result(conv_id) for conv_id in conversation_ids}
+        timings = {stage: [] for stage in STAGES}
+        done = {'count': 0}
+        start = time.perf_counter()
+
+        to_process = asyncio.Queue(maxsize=self.queue_size)
+        to_eval = asyncio.Queue(maxsize=self.queue_size)
+
+        fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_concurrency)
+        process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+        eval_pool = ThreadPoolExecutor(max_workers=self.eval_concurrency)
+
+        def finish(conv_id: str, stage: str, error: str = ''):
+            """Đánh dấu ID đã xong (thành công hoặc lỗi ở `stage`) và in tiến độ"""
+            done['count'] += 1
+            result = results[conv_id]
+            if error:
+                result['error'] = f"{stage}: {error}"
+                status = f"❌ lỗi ở bước {stage} ({error})"
+            else:
+                status = "✅ xong"
+            elapsed = time.perf_counter() - start
+            eta = elapsed / done['count'] * (total - done['count'])
+            print(f"📈 [{done['count']}/{total}] ID {conv_id}: {status} "
+                  f"| {elapsed:.0f}s, còn ~{eta:.0f}s")
+
+        async def run_step(stage: str, pool, func, *args):
+            """Chạy một bước trong pool, trả về (kết quả, lỗi)"""
+            step_start = time.perf_counter()
+            try:
+                return await loop.run_in_executor(pool, func, *args), ''
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}"
+            finally:
+                timings[stage].append(time.perf_counter() - step_start)
+
+        async def fetch_worker():
+            while True:
+                conv_id = await ids.get()
+                if conv_id is None:
+                    return
+                input_file, error = await run_step('fetch', fetch_pool, self.fetcher.fetch_and_save, conv_id)
+                if not input_file:
+                    finish(conv_id, 'fetch', error or "không lấy được dữ liệu")
+                    continue
+                results[conv_id]['fetch_status'] = 'SUCCESS'
+                results[conv_id]['input_file'] = input_file
+                await to_process.put((conv_id, input_file))
+
+        async def process_worker():
+            while True:
+                item = await to_process.get()
+                if item is None:
+                    return
+                conv_id, input_file = item
+                processed_file = f"output/conversation_{conv_id}_processed.xlsx"
+                ok, error = await run_step('process', process_pool, process_in_worker, input_file, processed_file)
+                if not ok:
+                    finish(conv_id, 'process', error or "không xử lý được dữ liệu")
+                    continue
+                results[conv_id]['process_status'] = 'SUCCESS'
+                results[conv_id]['processed_file'] = processed_file
+                await to_eval.put((conv_id, processed_file))
+
+        async def eval_worker():
+            while True:
+                item = await to_eval.get()
+                if item is None:
+                    return
+                conv_id, processed_file = item
+                eval_file = f"eval/conversation_{conv_id}_output_eval.xlsx"
+                ok, error = await run_step('eval', eval_pool, self.evaluator.evaluate_excel_file,
+                                           processed_file, eval_file)
+                if not ok:
+                    finish(conv_id, 'eval', error or "không đánh giá được")
+                    continue
+                results[conv_id]['eval_status'] = 'SUCCESS'
+                results[conv_id]['eval_file'] = eval_file
+                finish(conv_id, 'eval')
+
+        async def run_workers(worker, count: int, next_queue: asyncio.Queue = None, next_count: int = 0):
+            """Chạy `count` worker; khi tất cả xong thì báo dừng cho bước tiếp theo"""
+            await asyncio.gather(*(worker() for _ in range(count)))
+            for _ in range(next_count):
+                await next_queue.put(None)
+
+        ids = asyncio.Queue()
+        for conv_id in conversation_ids:
+            ids.put_nowait(conv_id)
+        for _ in range(self.fetch_concurrency):
+            ids.put_nowait(None)
+
+        print(f"⚡ Pipeline song song: fetch x{self.fetch_concurrency}, process x{self.process_workers}, "
+              f"eval x{self.eval_concurrency}, queue {self.queue_size}")
+        try:
+            await asyncio.gather(
+                run_workers(fetch_worker, self.fetch_concurrency, to_process, self.process_workers),
+                run_workers(process_worker, self.process_workers, to_eval, self.eval_concurrency),
+                run_workers(eval_worker, self.eval_concurrency),
+            )
+        finally:
+            fetch_pool.shutdown()
+            process_pool.shutdown()
+            eval_pool.shutdown()
+
+        self.print_stage_timings(timings, time.perf_counter() - start)
+        self.fetcher.print_latency_stats()
+        return [results[conv_id] for conv_id in conversation_ids]
+
+    def print_stage_timings(self, timings: dict, wall_time: float):
+        """
+        In thời gian từng bước (tổng thời gian chạy, trung bình mỗi ID, thông lượng tối đa)
+        """
+        concurrency = {'fetch': self.fetch_concurrency, 'process': self.process_workers, 'eval': self.eval_concurrency}
+
+        print(f"\n⏱️ THỜI GIAN TỪNG BƯỚC (wall time: {wall_time:.1f}s)")
+        for stage in STAGES:
+            durations = timings[stage]
+            if not durations:
+                print(f"   {stage:<8}: không có ID nào")
+                continue
+            busy = sum(durations)
+            avg = busy / len(durations)
+            throughput = concurrency[stage] / avg if avg > 0 else float('inf')
+            print(f"   {stage:<8}: {len(durations)} IDs, tổng {busy:.1f}s, TB {avg:.2f}s/ID, "
+                  f"x{concurrency[stage]} → tối đa {throughput:.2f} IDs/s")
+
     def calculate_avg_response_time(self, eval_file_path: str) -> float:
         """
         Tính response time trung bình từ file eval
@@ -217,9 +386,12 @@ class FastResponsePipeline:
         print(f"🔄 BƯỚC 1-3: XỬ LÝ TỪNG CONVERSATION ID")
         print(f"{'='*60}")
         
-        for conv_id in conversation_ids:
-            result = self.process_single_id(conv_id)
-            results.append(result)
+        if self.sequential:
+            for conv_id in conversation_ids:
+                result = self.process_single_id(conv_id)
+                results.append(result)
+        else:
+            results = asyncio.run(self.run_stages_async(conversation_ids))
         
         # In báo cáo tóm tắt pipeline
         self.print_summary_report(results)
@@ -548,6 +720,11 @@ def parse_arguments():
     
     parser.add_argument('--token', type=str, default='{{token}}', 
                        help='API token (default: {{token}})')
+    parser.add_argument('--fetch_concurrency', type=int, default=8, help='Số request fetch chạy song song')
+    parser.add_argument('--process_workers', type=int, default=None, help='Số process cho bước Process (default: số CPU)')
+    parser.add_argument('--eval_concurrency', type=int, default=4, help='Số file eval chạy song song')
+    parser.add_argument('--queue_size', type=int, default=32, help='Kích thước hàng đợi giữa các bước')
+    parser.add_argument('--sequential', action='store_true', help='Chạy tuần tự từng ID (như cũ)')
     
     args = parser.parse_args()
     
@@ -628,7 +805,14 @@ def main():
     # Khởi tạo và chạy pipeline
     print("🔍 DEBUG: Initializing pipeline...")
     try:
-        pipeline = FastResponsePipeline(args.token)
+        pipeline = FastResponsePipeline(
+            args.token,
+            fetch_concurrency=args.fetch_concurrency,
+            process_workers=args.process_workers,
+            eval_concurrency=args.eval_concurrency,
+            queue_size=args.queue_size,
+            sequential=args.sequential,
+        )
         print("✅ DEBUG: Pipeline initialized successfully")
         
         results, merged_file = pipeline.run_pipeline(conversation_ids)
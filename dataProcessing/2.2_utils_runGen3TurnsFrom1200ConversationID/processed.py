@@ -1,6 +1,7 @@
 import json
 import pandas as pd
 import os
+import sys
 from typing import List, Dict, Any
 
 class ConversationProcessor:
@@ -19,21 +20,13 @@ class ConversationProcessor:
             print(f"❌ Lỗi khi đọc file {filepath}: {e}")
             return {}
     
-    def extract_conversations(self, data: Dict[Any, Any]) -> List[Dict[str, Any]]:
+    def _extract_pairs(self, data: Dict[Any, Any]) -> List[Dict[str, str]]:
         """
-        Trích xuất conversation với 3 turns history (sliding window).
-        Mỗi conversation chứa tối đa 3 cặp BOT-USER gần nhất (6 messages).
-        Sliding window theo PAIRS để maintain proper chronology.
+        Trích xuất tất cả các cặp BOT-USER theo thứ tự thời gian,
+        kèm FAST_RESPONSE và BOT_RESPONSE tiếp theo của mỗi cặp.
         """
-        if 'data' not in data:
-            print("❌ Không tìm thấy key 'data' trong JSON")
-            return []
-
-        conversations = []
         pairs = []  # Store completed BOT-USER pairs
-        MAX_TURNS = 3  # Tối đa 3 turns (3 pairs = 6 messages)
         
-        # Step 1: Extract all BOT-USER pairs in chronological order
         current_bot_messages = []  # Store consecutive BOT messages
         original_data = data['data']
         
@@ -135,6 +128,24 @@ class ConversationProcessor:
                         }
                         pairs.append(pair)
         
+        return pairs
+    
+    def extract_conversations(self, data: Dict[Any, Any]) -> List[Dict[str, Any]]:
+        """
+        Trích xuất conversation với 3 turns history (sliding window).
+        Mỗi conversation chứa tối đa 3 cặp BOT-USER gần nhất (6 messages).
+        Sliding window theo PAIRS để maintain proper chronology.
+        """
+        if 'data' not in data:
+            print("❌ Không tìm thấy key 'data' trong JSON")
+            return []
+
+        conversations = []
+        MAX_TURNS = 3  # Tối đa 3 turns (3 pairs = 6 messages)
+        
+        # Step 1: Extract all BOT-USER pairs in chronological order
+        pairs = self._extract_pairs(data)
+        
         # Step 2: Build conversations with sliding window of pairs
         for i in range(len(pairs)):
             # Get sliding window of pairs (max MAX_TURNS pairs)
@@ -158,6 +169,28 @@ class ConversationProcessor:
         
         return conversations
     
+    def extract_multi_target_conversation(self, data: Dict[Any, Any], system_prompt: str = "") -> List[Dict[str, Any]]:
+        """
+        Trích xuất TOÀN BỘ conversation thành 1 sequence (multi-target format).
+        Mỗi FAST_RESPONSE được đánh dấu "target": true để train loss trên mọi turn,
+        thay vì tạo 1 sample sliding window cho mỗi turn.
+        """
+        if 'data' not in data:
+            print("❌ Không tìm thấy key 'data' trong JSON")
+            return []
+        
+        conversation = []
+        if system_prompt:
+            conversation.append({"role": "system", "content": system_prompt})
+        
+        for pair in self._extract_pairs(data):
+            conversation.append({"role": "assistant", "content": pair['bot']})
+            conversation.append({"role": "user", "content": pair['user']})
+            if pair['next_fast_response']:
+                conversation.append({"role": "assistant", "content": pair['next_fast_response'], "target": True})
+        
+        return conversation
+    
     def _ensure_assistant_first(self, conversation: List[Dict[str, str]]) -> List[Dict[str, str]]:
         """
         Ensure conversation starts with assistant message.
@@ -257,7 +290,35 @@ class ConversationProcessor:
             print(f"❌ Lỗi khi xử lý file: {e}")
             return False
 
-def process_all_input_files():
+    def process_file_multi_target(self, input_filepath: str, output_filepath: str, system_prompt: str = "") -> bool:
+        """
+        Xử lý file JSON và xuất ra JSON multi-target (1 conversation = 1 sample)
+        """
+        try:
+            data = self.load_json_data(input_filepath)
+            if not data:
+                return False
+            
+            conversation = self.extract_multi_target_conversation(data, system_prompt)
+            num_targets = sum(1 for msg in conversation if msg.get('target'))
+            if not num_targets:
+                print("❌ Không tìm thấy FAST_RESPONSE nào để làm target")
+                return False
+            
+            with open(output_filepath, 'w', encoding='utf-8') as f:
+                json.dump([{"conversations": conversation}], f, ensure_ascii=False, indent=2)
+            
+            print(f"✅ Đã xuất dữ liệu ra: {output_filepath}")
+            print(f"📊 Số lượng targets: {num_targets} trong 1 sequence ({len(conversation)} messages)")
+            print(f"🎯 Strategy: Multi-target, train với multi_target: true (window = 3 turns)")
+            
+            return True
+            
+        except Exception as e:
+            print(f"❌ Lỗi khi xử lý file: {e}")
+            return False
+
+def process_all_input_files(multi_target: bool = False):
     """
     Xử lý tất cả file trong folder input
     """
@@ -275,11 +336,16 @@ def process_all_input_files():
     for filename in os.listdir('input'):
         if filename.endswith('.json'):
             input_path = os.path.join('input', filename)
-            output_filename = filename.replace('.json', '_processed_v3_3turns.xlsx')
-            output_path = os.path.join('output', output_filename)
-            
             print(f"\n🔄 Đang xử lý: {filename}")
-            processor.process_file(input_path, output_path)
+            
+            if multi_target:
+                output_path = os.path.join('output', filename.replace('.json', '_multi_target.json'))
+                processor.process_file_multi_target(input_path, output_path)
+            else:
+                output_filename = filename.replace('.json', '_processed_v3_3turns.xlsx')
+                output_path = os.path.join('output', output_filename)
+                processor.process_file(input_path, output_path)
 
 if __name__ == "__main__":
-    process_all_input_files()
\ No newline at end of file
+    # python processed.py --multi-target  => 1 sequence / conversation
+    process_all_input_files(multi_target='--multi-target' in sys.argv)
\ No newline at end of file
@@ -38,8 +38,18 @@ else
     print_warning "Virtual environment not found. Using system Python."
 fi
 
+# Multi-GPU settings (NUM_GPUS > 1 runs the standard LoRA trainer data-parallel)
+NUM_GPUS=${NUM_GPUS:-1}
+DISTRIBUTED=${DISTRIBUTED:-ddp}      # ddp | fsdp
+LAUNCHER=${LAUNCHER:-torchrun}       # torchrun | accelerate
+TRAIN_CONFIG=${TRAIN_CONFIG:-configs/training_config_standard.yaml}
+
 # Set environment variables
-export CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES:-0}
+if [ "$NUM_GPUS" -gt 1 ]; then
+    export CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES:-$(seq -s, 0 $((NUM_GPUS - 1)))}
+else
+    export CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES:-0}
+fi
 export PYTHONPATH="${PYTHONPATH}:$(pwd)/src"
 export TOKENIZERS_PARALLELISM=false
 
@@ -47,6 +57,27 @@ print_status "Environment variables set:"
 print_status "  CUDA_VISIBLE_DEVICES: $CUDA_VISIBLE_DEVICES"
 print_status "  PYTHONPATH: $PYTHONPATH"
 
+# Launch helpers: one process per GPU, the trainer reads `distributed` from its config
+launch_torchrun() {
+    torchrun --standalone --nproc_per_node="$NUM_GPUS" "$@"
+}
+
+launch_accelerate() {
+    accelerate launch --multi_gpu --num_processes="$NUM_GPUS" "$@"
+}
+
+# Config copy with `distributed` set, so the YAML itself stays single-GPU
+distributed_config() {
+    local config_path="outputs/train_config_${DISTRIBUTED}.yaml"
+    python -c "
+import yaml, sys
+config = yaml.safe_load(open('$TRAIN_CONFIG')) or {}
+config['distributed'] = '$DISTRIBUTED'
+yaml.safe_dump(config, open('$config_path', 'w'), allow_unicode=True)
+"
+    echo "$config_path"
+}
+
 # Check GPU availability
 if command -v nvidia-smi &> /dev/null; then
     print_status "GPU Status:"
@@ -96,9 +127,17 @@ fi
 
 # Run training with error handling
 print_status "Starting training process..."
-print_status "Command: python src/qwen_finetune/training/finetune_unsloth_chatml.py"
 
-if python src/qwen_finetune/training/finetune_unsloth_chatml.py; then
+if [ "$NUM_GPUS" -gt 1 ]; then
+    # Unsloth trains on one GPU; multi-GPU uses the standard LoRA trainer
+    TRAIN_CMD=("launch_${LAUNCHER}" src/qwen_finetune/training/finetune_standard_lora.py --config "$(distributed_config)")
+    print_status "Distributed: $DISTRIBUTED on $NUM_GPUS GPUs ($LAUNCHER)"
+else
+    TRAIN_CMD=(python src/qwen_finetune/training/finetune_unsloth_chatml.py)
+fi
+print_status "Command: ${TRAIN_CMD[*]}"
+
+if "${TRAIN_CMD[@]}"; then
     print_success "Training completed successfully! 🎉"
     
     # Check if model was saved
@@ -15,10 +15,20 @@ Version: 0.1.0
 __version__ = "0.1.0"
 __author__ = "StepUp Education Team"
 
-from .training.finetune_unsloth_chatml import QwenFineTuner, FineTuneConfig
-from .serving.vllm_server import QwenVLLMServer, ServingConfig
 from .utils.data_processor import DataProcessor
 
+# Training and serving backends are optional: Unsloth is unavailable on
+# Python 3.13+ and vLLM is usually not installed on training-only machines
+try:
+    from .training.finetune_unsloth_chatml import QwenFineTuner, FineTuneConfig
+except ImportError:
+    QwenFineTuner = FineTuneConfig = None
+
+try:
+    from .serving.vllm_server import QwenVLLMServer, ServingConfig
+except ImportError:
+    QwenVLLMServer = ServingConfig = None
+
 __all__ = [
     "QwenFineTuner",
     "FineTuneConfig", 
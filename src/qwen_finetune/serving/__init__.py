@@ -1,5 +1,8 @@
 """Serving module for Qwen models with vLLM"""
 
-from .vllm_server import QwenVLLMServer, ServingConfig
+try:
+    from .vllm_server import QwenVLLMServer, ServingConfig
+except ImportError:  # vLLM not installed (e.g. index-building machines)
+    QwenVLLMServer = ServingConfig = None
 
 __all__ = ["QwenVLLMServer", "ServingConfig"]
\ No newline at end of file
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Rule-based fast lane for trivial utterances
+Answers empty turns, single words and fillers from a YAML rule set before
+the request reaches the LLM
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import re
+import random
+import logging
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_utterance(text: str) -> str:
+    """Lowercase, NFC-normalize, drop punctuation/symbols and collapse whitespace"""
+    text = unicodedata.normalize("NFC", str(text or "")).lower()
+    text = "".join(
+        " " if unicodedata.category(ch)[0] in ("P", "S") else ch
+        for ch in text
+    )
+    return " ".join(text.split())
+
+
+@dataclass
+class FastLaneRule:
+    """One rule: patterns that map to an intent and a weighted response pool"""
+    name: str
+    intent: str
+    responses: List[str]
+    weights: List[float]
+    patterns: List[str] = field(default_factory=list)
+    regex: List[str] = field(default_factory=list)
+    match_empty: bool = False
+
+
+class FastLane:
+    """Compiled multi-pattern matcher over the last user utterance"""
+
+    def __init__(self, rules: List[FastLaneRule], seed: Optional[int] = None):
+        if not rules:
+            raise ValueError("Fast lane needs at least one rule")
+
+        self.rules = {rule.name: rule for rule in rules}
+        self.empty_rule = next((rule for rule in rules if rule.match_empty), None)
+        self._random = random.Random(seed)
+
+        # One alternation with a named group per rule; rule order is priority
+        alternatives = []
+        for i, rule in enumerate(rules):
+            options = [re.escape(normalize_utterance(p)) for p in rule.patterns if normalize_utterance(p)]
+            options += rule.regex
+            if options:
+                alternatives.append(f"(?P<r{i}>{'|'.join(options)})")
+        self._group_to_rule = {f"r{i}": rule for i, rule in enumerate(rules)}
+        self._pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+        self._lock = threading.Lock()
+        self._hits = {rule.name: 0 for rule in rules}
+        self._misses = 0
+
+        logger.info(f"✅ Fast lane loaded with {len(rules)} rules")
+
+    @classmethod
+    def from_yaml(cls, path: str) -> "FastLane":
+        """Load rules from YAML (see configs/fast_lane_rules.yaml)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f) or {}
+
+        rules = []
+        for item in config.get("rules", []):
+            responses, weights = [], []
+            for response in item.get("responses", []):
+                if isinstance(response, dict):
+                    responses.append(response["text"])
+                    weights.append(float(response.get("weight", 1.0)))
+                else:
+                    responses.append(str(response))
+                    weights.append(1.0)
+
+            if not responses:
+                raise ValueError(f"Fast lane rule '{item.get('name')}' has no responses")
+
+            rules.append(FastLaneRule(
+                name=item["name"],
+                intent=item.get("intent", "neutral"),
+                responses=responses,
+                weights=weights,
+                patterns=[str(p) for p in item.get("patterns", [])],
+                regex=item.get("regex", []),
+                match_empty=item.get("match_empty", False),
+            ))
+
+        logger.info(f"Fast lane rules loaded from: {path}")
+        return cls(rules, seed=config.get("seed"))
+
+    def match_text(self, text: str) -> Optional[FastLaneRule]:
+        """Return the first rule matching the whole normalized utterance"""
+        normalized = normalize_utterance(text)
+
+        if not normalized:
+            return self.empty_rule
+        if self._pattern is None:
+            return None
+
+        match = self._pattern.fullmatch(normalized)
+        return self._group_to_rule[match.lastgroup] if match else None
+
+    def match(self, messages: List[Any]) -> Optional[Dict[str, Any]]:
+        """Match the last message if it is a user turn; returns {fast_response, intent, rule}"""
+        if not messages:
+            return None
+
+        last = messages[-1]
+        role = (last.get("role") if isinstance(last, dict) else last.role).lower()
+        content = last.get("content") if isinstance(last, dict) else last.content
+        rule = self.match_text(content) if role == "user" else None
+
+        with self._lock:
+            if rule is None:
+                self._misses += 1
+                return None
+            self._hits[rule.name] += 1
+            response = self._random.choices(rule.responses, weights=rule.weights, k=1)[0]
+
+        return {"fast_response": response, "intent": rule.intent, "rule": rule.name}
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-rule hit counters and overall hit rate"""
+        with self._lock:
+            hits = dict(self._hits)
+            misses = self._misses
+
+        total_hits = sum(hits.values())
+        return {
+            "lookups": total_hits + misses,
+            "hits": total_hits,
+            "misses": misses,
+            "hit_rate": total_hits / max(total_hits + misses, 1),
+            "rule_hits": hits,
+        }
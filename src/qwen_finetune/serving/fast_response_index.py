@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Retrieval-based fast-response mapping
+Embeds labeled (last_robot_answer, last_user_answer) pairs into a compact
+float16 nearest-neighbour index and serves the nearest labeled fast response
+when similarity clears a threshold, falling back to the LLM otherwise
+
+Usage:
+    python -m qwen_finetune.serving.fast_response_index build \
+        --input dataProcessing/4_ParserData/parsed_output_data.xlsx \
+        --output models/fast_response_index
+    python -m qwen_finetune.serving.fast_response_index add \
+        --input new_batch.xlsx --output models/fast_response_index
+    python -m qwen_finetune.serving.fast_response_index query \
+        --index models/fast_response_index --robot "Cậu sẵn sàng chưa?" --user "I'm ready!"
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+VECTORS_FILENAME = "vectors.f16"
+ENTRIES_FILENAME = "entries.jsonl"
+META_FILENAME = "index_meta.json"
+
+# Column names used by our parsed datasets, in order of preference
+FAST_RESPONSE_COLUMNS = ["fast_response", "FAST_RESPONSE_next", "assistant_fast_response"]
+
+
+def pair_text(robot: str, user: str) -> str:
+    """Text that gets embedded for one (last robot answer, last user answer) pair"""
+    return f"{str(robot).strip()}\n{str(user).strip()}"
+
+
+def last_pair_from_messages(messages: List[Any]) -> Tuple[str, str]:
+    """Return (last assistant content, last user content) from a chat history"""
+    robot, user = "", ""
+
+    for message in reversed(messages):
+        role = (message.get("role") if isinstance(message, dict) else message.role).lower()
+        content = message.get("content") if isinstance(message, dict) else message.content
+
+        if not user and role == "user":
+            user = content
+        elif user and role == "assistant":
+            robot = content
+            break
+
+    return robot or "", user or ""
+
+
+def load_labeled_pairs(data_path: str) -> List[Dict[str, Any]]:
+    """
+    Load labeled pairs from parsed datasets (parsed_output_data.xlsx, 1.2_validated.xlsx, ...)
+
+    Each row needs a fast response column and either `last_robot_answer`/`last_user_answer`
+    or a `BOT_RESPONSE_CONVERSATION_with_USER` JSON conversation. `user_intent` is optional.
+    """
+    logger.info(f"Loading labeled pairs from: {data_path}")
+
+    if data_path.endswith(".json"):
+        with open(data_path, 'r', encoding='utf-8') as f:
+            rows = json.load(f)
+    else:
+        import pandas as pd
+        df = pd.read_csv(data_path) if data_path.endswith(".csv") else pd.read_excel(data_path)
+        df = df.astype(object).where(df.notna(), None)
+        rows = df.to_dict(orient="records")
+
+    pairs = []
+    skipped = 0
+
+    for row in rows:
+        fast_response = next(
+            (row[col] for col in FAST_RESPONSE_COLUMNS if isinstance(row.get(col), str) and row[col].strip()),
+            None
+        )
+
+        robot, user = row.get("last_robot_answer"), row.get("last_user_answer")
+        if not (isinstance(robot, str) and isinstance(user, str)):
+            try:
+                conversation = json.loads(row.get("BOT_RESPONSE_CONVERSATION_with_USER") or "[]")
+                robot, user = last_pair_from_messages(conversation)
+            except (TypeError, json.JSONDecodeError):
+                robot, user = "", ""
+
+        if not fast_response or not user:
+            skipped += 1
+            continue
+
+        intent = row.get("user_intent")
+        pairs.append({
+            "robot": robot,
+            "user": user,
+            "fast_response": fast_response.strip(),
+            "intent": str(intent).strip().lower() if intent else None,
+        })
+
+    logger.info(f"Loaded {len(pairs)} labeled pairs ({skipped} skipped)")
+    return pairs
+
+
+class TextEmbedder:
+    """Sentence embedder (mean pooling, L2-normalized) on top of transformers"""
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, device: str = "cpu", max_length: int = 128):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+
+        self.model_name = model_name
+        self.device = device
+        self.max_length = max_length
+        self._torch = torch
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(device).eval()
+        self.dim = self.model.config.hidden_size
+
+    def embed(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """Embed texts into an (N, dim) float32 array of unit vectors"""
+        torch = self._torch
+        vectors = []
+
+        with torch.inference_mode():
+            for start in range(0, len(texts), batch_size):
+                batch = self.tokenizer(
+                    texts[start:start + batch_size],
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_length,
+                    return_tensors="pt",
+                ).to(self.device)
+
+                hidden = self.model(**batch).last_hidden_state
+                mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                pooled = torch.nn.functional.normalize(pooled, dim=-1)
+                vectors.append(pooled.float().cpu().numpy())
+
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(vectors, axis=0)
+
+
+class FastResponseIndex:
+    """
+    Flat inner-product index over unit vectors
+
+    Vectors are stored as raw float16 in a memory-mapped file next to a JSONL
+    file of entries; appends only touch the tail of both files.
+    """
+
+    def __init__(self, index_dir: str, preload: bool = True):
+        self.index_dir = index_dir
+        self.preload = preload
+
+        with open(os.path.join(index_dir, META_FILENAME), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        self.dim = self.meta["dim"]
+        self._load()
+
+    @classmethod
+    def create(cls, index_dir: str, dim: int, embedding_model: str) -> "FastResponseIndex":
+        """Create an empty index on disk"""
+        os.makedirs(index_dir, exist_ok=True)
+
+        meta = {"dim": dim, "count": 0, "embedding_model": embedding_model, "dtype": "float16"}
+        with open(os.path.join(index_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        open(os.path.join(index_dir, VECTORS_FILENAME), 'wb').close()
+        open(os.path.join(index_dir, ENTRIES_FILENAME), 'w', encoding='utf-8').close()
+
+        return cls(index_dir)
+
+    def _load(self):
+        """(Re)map vectors and read entries"""
+        count = self.meta["count"]
+        vectors_path = os.path.join(self.index_dir, VECTORS_FILENAME)
+
+        if count > 0:
+            self.vectors = np.memmap(vectors_path, dtype=np.float16, mode="r", shape=(count, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float16)
+
+        # float32 copy makes the matmul hit BLAS; the on-disk index stays float16
+        self._matrix = np.asarray(self.vectors, dtype=np.float32) if self.preload else None
+
+        with open(os.path.join(self.index_dir, ENTRIES_FILENAME), 'r', encoding='utf-8') as f:
+            self.entries = [json.loads(line) for line in f if line.strip()]
+
+        if len(self.entries) != count:
+            raise ValueError(f"Index is corrupted: {len(self.entries)} entries for {count} vectors")
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def add(self, vectors: np.ndarray, entries: List[Dict[str, Any]]) -> None:
+        """Append vectors (unit-normalized) and their entries"""
+        if len(vectors) != len(entries):
+            raise ValueError("vectors and entries must have the same length")
+        if len(vectors) and vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected dim {self.dim}, got {vectors.shape[1]}")
+
+        with open(os.path.join(self.index_dir, VECTORS_FILENAME), 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float16).tobytes())
+
+        with open(os.path.join(self.index_dir, ENTRIES_FILENAME), 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        self.meta["count"] += len(entries)
+        with open(os.path.join(self.index_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, indent=2)
+
+        self._load()
+
+    def search(self, query: np.ndarray, k: int = 1, block_size: int = 65536) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return the top-k (cosine similarity, entry) pairs for one unit query vector"""
+        if len(self) == 0:
+            return []
+
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+
+        if self._matrix is not None:
+            scores = self._matrix @ query
+        else:
+            scores = np.concatenate([
+                np.asarray(self.vectors[start:start + block_size], dtype=np.float32) @ query
+                for start in range(0, len(self), block_size)
+            ])
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(float(scores[i]), self.entries[i]) for i in top]
+
+
+class FastResponseRetriever:
+    """Threshold-gated lookup with hit-rate and latency metrics"""
+
+    def __init__(self, index_dir: str, threshold: float = 0.92, device: str = "cpu", preload: bool = True):
+        self.index = FastResponseIndex(index_dir, preload=preload)
+        self.embedder = TextEmbedder(self.index.meta["embedding_model"], device=device)
+        self.threshold = threshold
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "embed_ms_total": 0.0,
+            "search_ms_total": 0.0,
+            "search_ms_max": 0.0,
+        }
+
+        logger.info(f"✅ Fast-response index loaded: {len(self.index)} entries (threshold={threshold})")
+
+    def lookup(self, messages: List[Any]) -> Optional[Dict[str, Any]]:
+        """Return {fast_response, intent, score} for the nearest labeled pair, or None"""
+        robot, user = last_pair_from_messages(messages)
+        if not user:
+            return None
+
+        start = time.perf_counter()
+        query = self.embedder.embed([pair_text(robot, user)])[0]
+        embedded = time.perf_counter()
+        results = self.index.search(query, k=1)
+        searched = time.perf_counter()
+
+        hit = bool(results) and results[0][0] >= self.threshold
+
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["hits" if hit else "misses"] += 1
+            self._stats["embed_ms_total"] += (embedded - start) * 1000
+            search_ms = (searched - embedded) * 1000
+            self._stats["search_ms_total"] += search_ms
+            self._stats["search_ms_max"] = max(self._stats["search_ms_max"], search_ms)
+
+        if not hit:
+            return None
+
+        score, entry = results[0]
+        return {"fast_response": entry["fast_response"], "intent": entry.get("intent"), "score": score}
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate and latency summary"""
+        with self._lock:
+            stats = dict(self._stats)
+
+        lookups = max(stats["lookups"], 1)
+        stats["hit_rate"] = stats["hits"] / lookups
+        stats["embed_ms_avg"] = stats["embed_ms_total"] / lookups
+        stats["search_ms_avg"] = stats["search_ms_total"] / lookups
+        stats["index_size"] = len(self.index)
+        stats["threshold"] = self.threshold
+        return stats
+
+
+def build_index(
+    input_paths: List[str],
+    index_dir: str,
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+    device: str = "cpu",
+    batch_size: int = 64,
+    append: bool = False
+) -> FastResponseIndex:
+    """Embed labeled pairs from `input_paths` into a new (or existing, if append) index"""
+    pairs = []
+    for path in input_paths:
+        pairs.extend(load_labeled_pairs(path))
+
+    if append:
+        index = FastResponseIndex(index_dir, preload=False)
+        embedding_model = index.meta["embedding_model"]
+        embedder = TextEmbedder(embedding_model, device=device)
+    else:
+        embedder = TextEmbedder(embedding_model, device=device)
+        index = FastResponseIndex.create(index_dir, embedder.dim, embedding_model)
+
+    logger.info(f"Embedding {len(pairs)} pairs with {embedding_model}...")
+    start = time.time()
+    vectors = embedder.embed([pair_text(p["robot"], p["user"]) for p in pairs], batch_size=batch_size)
+    logger.info(f"Embedding took {time.time() - start:.2f} seconds")
+
+    index.add(vectors, pairs)
+    logger.info(f"✅ Index at {index_dir} now holds {len(index)} entries")
+    return index
+
+
+def main():
+    """Offline build / incremental add / query CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Fast-response kNN index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name in ["build", "add"]:
+        sub = subparsers.add_parser(name, help=f"{name.capitalize()} index from labeled data files")
+        sub.add_argument("--input", nargs="+", required=True, help="Labeled .xlsx/.csv/.json files")
+        sub.add_argument("--output", default="models/fast_response_index", help="Index directory")
+        sub.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL, help="Embedding model (build only)")
+        sub.add_argument("--device", default="cpu")
+        sub.add_argument("--batch-size", type=int, default=64)
+
+    query = subparsers.add_parser("query", help="Look up one pair")
+    query.add_argument("--index", default="models/fast_response_index")
+    query.add_argument("--robot", default="")
+    query.add_argument("--user", required=True)
+    query.add_argument("--threshold", type=float, default=0.92)
+    query.add_argument("--k", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.command in ["build", "add"]:
+        build_index(
+            args.input,
+            args.output,
+            embedding_model=args.model,
+            device=args.device,
+            batch_size=args.batch_size,
+            append=args.command == "add",
+        )
+    else:
+        retriever = FastResponseRetriever(args.index, threshold=args.threshold)
+        query_vector = retriever.embedder.embed([pair_text(args.robot, args.user)])[0]
+        for score, entry in retriever.index.search(query_vector, k=args.k):
+            marker = "✅" if score >= args.threshold else "  "
+            print(f"{marker} {score:.4f}  [{entry.get('intent')}] {entry['fast_response']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,12 @@ Date: 2025
 """
 
 import asyncio
+import glob
 import json
+import os
 import yaml
 import time
+import torch
 from typing import List, Dict, Optional, AsyncGenerator
 from dataclasses import dataclass
 from fastapi import FastAPI, HTTPException, Request
@@ -22,6 +25,11 @@ from vllm import AsyncLLMEngine, AsyncEngineArgs, SamplingParams
 from vllm.utils import random_uuid
 import logging
 
+from qwen_finetune.training.intent_head import load_intent_head
+from qwen_finetune.serving.fast_response_index import FastResponseRetriever
+from qwen_finetune.serving.fast_lane import FastLane
+from qwen_finetune.utils.formatting import render_chatml
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +37,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Share of GPU memory the intent engine needs on top of its copy of the weights (activations, CUDA graphs)
+INTENT_ENGINE_HEADROOM = 0.05
+
+
+def model_weight_bytes(model_path: str) -> Optional[int]:
+    """Size of a local checkpoint's weight files (None for hub IDs or unknown layouts)"""
+    if not os.path.isdir(model_path):
+        return None
+    files = (glob.glob(os.path.join(model_path, "*.safetensors"))
+             or glob.glob(os.path.join(model_path, "pytorch_model*.bin")))
+    return sum(os.path.getsize(path) for path in files) or None
+
 
 @dataclass
 class ServingConfig:
@@ -61,6 +81,18 @@ class ServingConfig:
     # API configuration
     api_key: Optional[str] = None
     cors_allow_origins: List[str] = None
+    
+    # Intent classification head (served from a prefill-only pooling engine)
+    intent_head_path: Optional[str] = None
+    intent_gpu_memory_utilization: float = 0.25
+    
+    # Rule-based fast lane for trivial utterances (checked first)
+    fast_lane_rules_path: Optional[str] = None
+    
+    # Retrieval fast path (kNN over labeled fast responses)
+    fast_response_index_path: Optional[str] = None
+    fast_response_threshold: float = 0.92
+    fast_response_device: str = "cpu"
 
 
 class ChatMessage(BaseModel):
@@ -93,6 +125,22 @@ class ChatResponse(BaseModel):
     usage: Dict
 
 
+class IntentRequest(BaseModel):
+    """Intent classification request model"""
+    messages: Optional[List[ChatMessage]] = Field(None, description="Single conversation to classify")
+    inputs: Optional[List[List[ChatMessage]]] = Field(None, description="Batch of conversations to classify")
+
+
+class IntentResponse(BaseModel):
+    """Intent classification response model"""
+    id: str
+    object: str = "intent.classification"
+    created: int
+    model: str
+    data: List[Dict]
+    usage: Dict
+
+
 class ChatStreamResponse(BaseModel):
     """Chat completion stream response model"""
     id: str
@@ -108,6 +156,11 @@ class QwenVLLMServer:
     def __init__(self, config: ServingConfig):
         self.config = config
         self.engine = None
+        self.intent_engine = None
+        self.intent_head = None
+        self.intent_labels: List[str] = []
+        self.fast_lane = None
+        self.fast_response_retriever = None
         self.app = FastAPI(
             title="Qwen vLLM Server",
             description="OpenAI-compatible API for fine-tuned Qwen models",
@@ -151,9 +204,82 @@ class QwenVLLMServer:
             self.engine = AsyncLLMEngine.from_engine_args(engine_args)
             logger.info("✅ vLLM engine initialized successfully!")
             
+            if self.config.intent_head_path:
+                self.initialize_intent_engine()
+            
+            if self.config.fast_lane_rules_path:
+                self.fast_lane = FastLane.from_yaml(self.config.fast_lane_rules_path)
+            
+            if self.config.fast_response_index_path:
+                self.fast_response_retriever = FastResponseRetriever(
+                    self.config.fast_response_index_path,
+                    threshold=self.config.fast_response_threshold,
+                    device=self.config.fast_response_device,
+                )
+            
         except Exception as e:
             logger.error(f"❌ Failed to initialize vLLM engine: {e}")
             raise
+    
+    def initialize_intent_engine(self):
+        """Initialize the pooling engine and head used by /v1/intent"""
+        logger.info(f"Loading intent head from: {self.config.intent_head_path}")
+        
+        self._check_intent_memory()
+        self.intent_head, self.intent_labels = load_intent_head(self.config.intent_head_path)
+        
+        # Pooling engine config (vLLM >= 0.6.4), only needed with the intent head
+        from vllm.config import PoolerConfig
+        
+        # Same weights, pooling task: runs prefill only and returns the
+        # un-normalized final hidden state of the last token
+        intent_engine_args = AsyncEngineArgs(
+            model=self.config.model_path,
+            task="embed",
+            override_pooler_config=PoolerConfig(pooling_type="LAST", normalize=False),
+            tensor_parallel_size=self.config.tensor_parallel_size,
+            gpu_memory_utilization=self.config.intent_gpu_memory_utilization,
+            max_model_len=self.config.max_model_len,
+            dtype=self.config.dtype,
+            quantization=self.config.quantization,
+            max_num_seqs=self.config.max_num_seqs,
+            max_num_batched_tokens=self.config.max_num_batched_tokens,
+            trust_remote_code=self.config.trust_remote_code,
+            enforce_eager=self.config.enforce_eager,
+        )
+        
+        self.intent_engine = AsyncLLMEngine.from_engine_args(intent_engine_args)
+        logger.info(f"✅ Intent engine initialized with labels: {self.intent_labels}")
+        
+    def _check_intent_memory(self):
+        """
+        Fail fast when the intent engine cannot fit: it is a second engine
+        over the same model, so the GPU holds the weights twice
+        """
+        total_memory = self.config.gpu_memory_utilization + self.config.intent_gpu_memory_utilization
+        if total_memory > 1.0:
+            raise ValueError(
+                f"gpu_memory_utilization + intent_gpu_memory_utilization = {total_memory:.2f} > 1.0, "
+                "lower gpu_memory_utilization to fit both engines"
+            )
+        
+        weight_bytes = model_weight_bytes(self.config.model_path)
+        if weight_bytes is None or not torch.cuda.is_available():
+            logger.info("Intent engine memory not checked (weights or GPU size unknown)")
+            return
+        
+        gpu_bytes = torch.cuda.get_device_properties(0).total_memory
+        # Tensor parallelism splits the weights across GPUs
+        weight_share = weight_bytes / self.config.tensor_parallel_size / gpu_bytes
+        required = weight_share + INTENT_ENGINE_HEADROOM
+        if self.config.intent_gpu_memory_utilization < required:
+            raise ValueError(
+                f"The intent engine loads a second copy of the weights ({weight_share * gpu_bytes / 2**30:.1f} GiB "
+                f"per GPU), but intent_gpu_memory_utilization={self.config.intent_gpu_memory_utilization} "
+                f"gives it {self.config.intent_gpu_memory_utilization * gpu_bytes / 2**30:.1f} GiB. "
+                f"Set intent_gpu_memory_utilization >= {required:.2f} and "
+                f"gpu_memory_utilization <= {1.0 - required:.2f}"
+            )
         
     def setup_routes(self):
         """Setup API routes"""
@@ -170,6 +296,7 @@ class QwenVLLMServer:
             return {
                 "status": "healthy",
                 "model_path": self.config.model_path,
+                "intent_head": self.intent_engine is not None,
                 "timestamp": time.time()
             }
             
@@ -189,16 +316,7 @@ class QwenVLLMServer:
         @self.app.post("/v1/chat/completions")
         async def chat_completions(request: ChatRequest, http_request: Request):
             """Chat completions endpoint (OpenAI compatibility)"""
-            
-            # API key validation if configured
-            if self.config.api_key:
-                auth_header = http_request.headers.get("authorization")
-                if not auth_header or not auth_header.startswith("Bearer "):
-                    raise HTTPException(status_code=401, detail="Missing or invalid API key")
-                
-                provided_key = auth_header.split(" ")[1]
-                if provided_key != self.config.api_key:
-                    raise HTTPException(status_code=401, detail="Invalid API key")
+            self.verify_api_key(http_request)
             
             if request.stream:
                 return StreamingResponse(
@@ -208,9 +326,146 @@ class QwenVLLMServer:
             else:
                 return await self.handle_chat_request(request)
                 
+        @self.app.get("/v1/fast_path/stats")
+        async def fast_path_stats():
+            """Hit-rate and latency metrics of the fast paths"""
+            stats = {}
+            if self.fast_lane is not None:
+                stats["rules"] = self.fast_lane.stats()
+            if self.fast_response_retriever is not None:
+                stats["knn"] = self.fast_response_retriever.stats()
+            return stats
+            
+        @self.app.post("/v1/intent")
+        async def intent_classification(request: IntentRequest, http_request: Request):
+            """Intent classification from a single prefill (no generation)"""
+            self.verify_api_key(http_request)
+            
+            if self.intent_engine is None:
+                raise HTTPException(status_code=404, detail="Intent head not configured")
+            
+            return await self.handle_intent_request(request)
+    
+    def verify_api_key(self, http_request: Request):
+        """Validate the bearer API key if one is configured"""
+        if not self.config.api_key:
+            return
+            
+        auth_header = http_request.headers.get("authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Missing or invalid API key")
+        
+        provided_key = auth_header.split(" ")[1]
+        if provided_key != self.config.api_key:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+                
+    async def handle_intent_request(self, request: IntentRequest) -> IntentResponse:
+        """Handle intent classification for one or many conversations"""
+        conversations = request.inputs or ([request.messages] if request.messages else [])
+        if not conversations:
+            raise HTTPException(status_code=400, detail="Provide `messages` or `inputs`")
+            
+        try:
+            request_id = random_uuid()
+            
+            # Submit all prompts at once so the engine batches their prefills
+            outputs = await asyncio.gather(*[
+                self._pool_last_hidden_state(self.format_messages_to_chatml(messages), f"{request_id}-{i}")
+                for i, messages in enumerate(conversations)
+            ])
+            
+            hidden_states = torch.stack([hidden for hidden, _ in outputs]).float()
+            with torch.no_grad():
+                probabilities = torch.softmax(self.intent_head(hidden_states), dim=-1)
+            
+            data = []
+            for i, probs in enumerate(probabilities.tolist()):
+                best = max(range(len(probs)), key=probs.__getitem__)
+                data.append({
+                    "index": i,
+                    "intent": self.intent_labels[best],
+                    "probabilities": dict(zip(self.intent_labels, probs))
+                })
+                
+            prompt_tokens = sum(num_tokens for _, num_tokens in outputs)
+            return IntentResponse(
+                id=request_id,
+                created=int(time.time()),
+                model="qwen-finetuned",
+                data=data,
+                usage={"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+            )
+            
+        except Exception as e:
+            logger.error(f"Error handling intent request: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+            
+    async def _pool_last_hidden_state(self, prompt: str, request_id: str):
+        """Run one prompt through the pooling engine, return (hidden state, prompt tokens)"""
+        from vllm import PoolingParams
+        
+        final_output = None
+        async for output in self.intent_engine.encode(prompt, PoolingParams(), request_id):
+            final_output = output
+            
+        if final_output is None:
+            raise RuntimeError("Pooling failed")
+            
+        pooled = final_output.outputs
+        hidden = getattr(pooled, "data", None)
+        if hidden is None:
+            hidden = getattr(pooled, "embedding")
+        
+        return torch.as_tensor(hidden).flatten().cpu(), len(final_output.prompt_token_ids)
+                
+    async def lookup_fast_response(self, request: ChatRequest) -> Optional[Dict]:
+        """Try to answer from the fast paths without touching the GPU"""
+        if self.fast_lane is not None:
+            fast_response = self.fast_lane.match(request.messages)
+            if fast_response is not None:
+                fast_response["source"] = "rule"
+                return fast_response
+                
+        if self.fast_response_retriever is None:
+            return None
+            
+        # Embedding is blocking CPU work, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        fast_response = await loop.run_in_executor(None, self.fast_response_retriever.lookup, request.messages)
+        if fast_response is not None:
+            fast_response["source"] = "retrieval"
+        return fast_response
+        
+    def build_fast_chat_response(self, fast_response: Dict) -> ChatResponse:
+        """Wrap a fast-path answer in the same shape as an LLM response (plus where it came from)"""
+        return ChatResponse(
+            id=random_uuid(),
+            created=int(time.time()),
+            model="qwen-finetuned",
+            choices=[{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": fast_response["fast_response"]
+                },
+                "finish_reason": "stop",
+                # Intent of the matched labeled pair, so clients get the mapping without /v1/intent
+                "fast_path": {key: value for key, value in fast_response.items() if key != "fast_response"}
+            }],
+            usage={
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            }
+        )
+        
     async def handle_chat_request(self, request: ChatRequest) -> ChatResponse:
         """Handle non-streaming chat completion request"""
         try:
+            fast_response = await self.lookup_fast_response(request)
+            if fast_response is not None:
+                return self.build_fast_chat_response(fast_response)
+            
             # Format messages to prompt
             prompt = self.format_messages_to_chatml(request.messages)
             logger.info(f"Generated prompt: {prompt[:200]}...")
@@ -267,6 +522,27 @@ class QwenVLLMServer:
     async def handle_chat_stream(self, request: ChatRequest) -> AsyncGenerator[str, None]:
         """Handle streaming chat completion request"""
         try:
+            fast_response = await self.lookup_fast_response(request)
+            if fast_response is not None:
+                response = self.build_fast_chat_response(fast_response)
+                for delta, finish_reason in [(response.choices[0]["message"], None), ({}, "stop")]:
+                    choice = {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": finish_reason
+                    }
+                    if finish_reason is None:
+                        choice["fast_path"] = response.choices[0]["fast_path"]
+                    chunk = ChatStreamResponse(
+                        id=response.id,
+                        created=response.created,
+                        model=response.model,
+                        choices=[choice]
+                    )
+                    yield f"data: {chunk.model_dump_json()}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+            
             # Format messages to prompt
             prompt = self.format_messages_to_chatml(request.messages)
             
@@ -333,19 +609,7 @@ class QwenVLLMServer:
             
     def format_messages_to_chatml(self, messages: List[ChatMessage]) -> str:
         """Format messages to ChatML prompt format"""
-        prompt = ""
-        
-        for message in messages:
-            role = message.role.lower()
-            if role not in ["system", "user", "assistant"]:
-                role = "user"  # Default fallback
-                
-            prompt += f"<|im_start|>{role}\n{message.content}<|im_end|>\n"
-        
-        # Add assistant start token for generation
-        prompt += "<|im_start|>assistant\n"
-        
-        return prompt
+        return render_chatml(messages, add_generation_prompt=True)
         
     def run(self):
         """Run the vLLM server"""
@@ -398,5 +662,4 @@ def main():
 
 
 if __name__ == "__main__":
-    import os
     main()
\ No newline at end of file
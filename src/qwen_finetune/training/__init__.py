@@ -1,5 +1,8 @@
 """Training module for Qwen fine-tuning"""
 
-from .finetune_unsloth_chatml import QwenFineTuner, FineTuneConfig
+try:
+    from .finetune_unsloth_chatml import QwenFineTuner, FineTuneConfig
+except ImportError:  # Unsloth not available (e.g. Python 3.13+)
+    QwenFineTuner = FineTuneConfig = None
 
 __all__ = ["QwenFineTuner", "FineTuneConfig"]
\ No newline at end of file
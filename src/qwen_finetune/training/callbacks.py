@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Training throughput instrumentation
+A TrainerCallback shared by both trainers that records tokens/s, samples/s,
+estimated MFU, padding fraction, dataloader wait, optimizer-step time and
+peak memory per logging step (JSONL, optionally wandb) plus an end-of-run
+summary report
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import resource
+import logging
+from typing import Dict, List, Mapping, Optional, Any
+
+import torch
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+# Dense bf16/fp16 tensor-core peak TFLOPS by GPU name fragment (first match wins)
+GPU_PEAK_TFLOPS = [
+    ("H200", 989.0),
+    ("H100 PCIe", 756.0),
+    ("H100", 989.0),
+    ("A100", 312.0),
+    ("L40S", 362.0),
+    ("L40", 181.0),
+    ("A6000", 155.0),
+    ("L4", 121.0),
+    ("A10G", 70.0),
+    ("A10", 125.0),
+    ("4090", 165.0),
+    ("3090", 71.0),
+    ("V100", 125.0),
+    ("T4", 65.0),
+]
+
+
+def detect_peak_tflops() -> Optional[float]:
+    """Peak dense bf16 TFLOPS of the current GPU, or None if unknown / no GPU"""
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    for fragment, tflops in GPU_PEAK_TFLOPS:
+        if fragment in name:
+            return tflops
+    logger.warning(f"Unknown GPU '{name}', set peak_tflops to report MFU")
+    return None
+
+
+def model_flops_per_token(model, seq_len: float) -> float:
+    """
+    Training FLOPs per token (PaLM-style MFU estimate, no recomputation)
+
+    6N + 12·L·H·S for full fine-tuning; with mostly frozen weights (LoRA)
+    the weight-gradient matmuls are skipped, so 4N + 2·N_trainable + 12·L·H·S.
+    """
+    total = sum(p.numel() for p in model.parameters())
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    config = getattr(model, "config", None)
+    layers = getattr(config, "num_hidden_layers", 0) or 0
+    hidden = getattr(config, "hidden_size", 0) or 0
+
+    return 4 * total + 2 * trainable + 12 * layers * hidden * seq_len
+
+
+def batch_token_stats(batch: Mapping[str, Any], pad_token_id: Optional[int] = None) -> Dict[str, int]:
+    """Real tokens, padded tokens and samples in one collated batch"""
+    input_ids = batch["input_ids"]
+    padded = input_ids.numel()
+
+    attention_mask = batch.get("attention_mask")
+    if attention_mask is not None and attention_mask.dim() == 2:
+        real_mask = attention_mask.bool()
+    elif pad_token_id is not None:
+        real_mask = input_ids.ne(pad_token_id)
+    else:
+        real_mask = torch.ones_like(input_ids, dtype=torch.bool)
+
+    # Token-budget batches carry their exact unpadded count
+    real = int(batch["num_tokens"]) if "num_tokens" in batch else int(real_mask.sum())
+
+    # Packed / flattened rows: every position reset starts a sample
+    position_ids = batch.get("position_ids")
+    if position_ids is not None and position_ids.shape == input_ids.shape:
+        samples = int((position_ids.eq(0) & real_mask).sum())
+    else:
+        samples = input_ids.shape[0]
+
+    return {"real_tokens": real, "padded_tokens": padded, "samples": max(samples, 1)}
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Per-logging-step throughput metrics
+
+    Batches are observed by wrapping the trainer's `get_batch_samples`, which
+    pulls one optimizer step's micro-batches from the dataloader, so the time
+    spent inside it is the dataloader wait. Records go to
+    `<output_dir>/throughput.jsonl`, the run summary to
+    `<output_dir>/throughput_summary.json`. Token counts are per device.
+    """
+
+    def __init__(self, trainer, output_dir: str, peak_tflops: Optional[float] = None,
+                 use_wandb: bool = False, synchronize: bool = True):
+        self.trainer = trainer
+        self.output_dir = output_dir
+        self.jsonl_path = os.path.join(output_dir, "throughput.jsonl")
+        self.summary_path = os.path.join(output_dir, "throughput_summary.json")
+        self.peak_tflops = peak_tflops
+        self.use_wandb = use_wandb
+        self.synchronize = synchronize and torch.cuda.is_available()
+
+        self.records: List[Dict[str, Any]] = []
+        self._model = None
+        self._reset_window()
+
+        self._get_batch_samples = trainer.get_batch_samples
+        trainer.get_batch_samples = self._timed_get_batch_samples
+
+    def _reset_window(self) -> None:
+        self.window = {
+            "real_tokens": 0,
+            "padded_tokens": 0,
+            "samples": 0,
+            "steps": 0,
+            "dataloader_wait_s": 0.0,
+            "optimizer_s": 0.0,
+        }
+        self.window_start = time.perf_counter()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _sync(self) -> None:
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _timed_get_batch_samples(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = self._get_batch_samples(*args, **kwargs)
+        self.window["dataloader_wait_s"] += time.perf_counter() - start
+
+        batch_samples = result[0] if isinstance(result, tuple) else result
+        pad_token_id = getattr(getattr(self.trainer, "processing_class", None), "pad_token_id", None)
+        for batch in batch_samples:
+            if isinstance(batch, Mapping) and "input_ids" in batch:
+                for key, value in batch_token_stats(batch, pad_token_id).items():
+                    self.window[key] += value
+        return result
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self._model = model or self.trainer.model
+        if self.peak_tflops is None:
+            self.peak_tflops = detect_peak_tflops()
+
+        if state.is_world_process_zero:
+            os.makedirs(self.output_dir, exist_ok=True)
+            open(self.jsonl_path, 'w').close()
+        self._reset_window()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self._optimizer_start = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self.window["optimizer_s"] += time.perf_counter() - self._optimizer_start
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.window["steps"] += 1
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        logs = logs or {}
+        if "loss" not in logs or not self.window["steps"]:
+            return
+
+        self._sync()
+        elapsed = max(time.perf_counter() - self.window_start, 1e-9)
+        window = self.window
+
+        record: Dict[str, Any] = {
+            "step": state.global_step,
+            "loss": logs.get("loss"),
+            "steps": window["steps"],
+            "elapsed_s": round(elapsed, 4),
+            "tokens_per_s": round(window["real_tokens"] / elapsed, 1),
+            "samples_per_s": round(window["samples"] / elapsed, 3),
+            "padding_fraction": round(1 - window["real_tokens"] / max(window["padded_tokens"], 1), 4),
+            "dataloader_wait_s": round(window["dataloader_wait_s"], 4),
+            "dataloader_wait_fraction": round(window["dataloader_wait_s"] / elapsed, 4),
+            "optimizer_step_s": round(window["optimizer_s"] / window["steps"], 4),
+            "cpu_peak_rss_gb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2, 3),
+        }
+
+        if torch.cuda.is_available():
+            record["gpu_peak_memory_gb"] = round(torch.cuda.max_memory_allocated() / 1024 ** 3, 3)
+            record["gpu_peak_reserved_gb"] = round(torch.cuda.max_memory_reserved() / 1024 ** 3, 3)
+
+        if self.peak_tflops and self._model is not None and window["real_tokens"]:
+            rows = max(window["padded_tokens"] / max(window["samples"], 1), 1)
+            flops_per_token = model_flops_per_token(self._model, rows)
+            achieved = flops_per_token * window["real_tokens"] / elapsed
+            record["mfu"] = round(achieved / (self.peak_tflops * 1e12), 4)
+
+        self.records.append(record)
+        self._reset_window()
+
+        if not state.is_world_process_zero:
+            return
+
+        with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+
+        if self.use_wandb:
+            try:
+                import wandb
+                if wandb.run is not None:
+                    metrics = {f"throughput/{k}": v for k, v in record.items() if k not in ("step", "loss")}
+                    wandb.log({**metrics, "train/global_step": state.global_step})
+            except ImportError:
+                pass
+
+    def summary(self) -> Dict[str, Any]:
+        """Run averages (the first logging window is excluded as warmup when there are more)"""
+        records = self.records[1:] if len(self.records) > 1 else self.records
+        if not records:
+            return {}
+
+        elapsed = sum(r["elapsed_s"] for r in records)
+        summary: Dict[str, Any] = {
+            "logged_windows": len(self.records),
+            "measured_steps": sum(r["steps"] for r in records),
+            "tokens_per_s": round(sum(r["tokens_per_s"] * r["elapsed_s"] for r in records) / elapsed, 1),
+            "samples_per_s": round(sum(r["samples_per_s"] * r["elapsed_s"] for r in records) / elapsed, 3),
+            "padding_fraction": round(sum(r["padding_fraction"] for r in records) / len(records), 4),
+            "dataloader_wait_fraction": round(sum(r["dataloader_wait_s"] for r in records) / elapsed, 4),
+            "optimizer_step_s": round(sum(r["optimizer_step_s"] * r["steps"] for r in records)
+                                      / max(sum(r["steps"] for r in records), 1), 4),
+            "cpu_peak_rss_gb": max(r["cpu_peak_rss_gb"] for r in self.records),
+            "peak_tflops": self.peak_tflops,
+        }
+        if "gpu_peak_memory_gb" in records[0]:
+            summary["gpu_peak_memory_gb"] = max(r["gpu_peak_memory_gb"] for r in self.records)
+            summary["gpu_name"] = torch.cuda.get_device_name()
+        # MFU is missing on windows without a FLOP count; average over the windows that have it
+        with_mfu = [r for r in records if r.get("mfu") is not None]
+        if with_mfu:
+            mfu_elapsed = sum(r["elapsed_s"] for r in with_mfu)
+            summary["mfu"] = round(sum(r["mfu"] * r["elapsed_s"] for r in with_mfu) / max(mfu_elapsed, 1e-9), 4)
+        return summary
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        summary = self.summary()
+        summary["world_size"] = args.world_size
+        with open(self.summary_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+        logger.info("📊 Throughput summary (per device):")
+        for key, value in summary.items():
+            logger.info(f"   {key}: {value}")
+        logger.info(f"   Saved to: {self.summary_path}")
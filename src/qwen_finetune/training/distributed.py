@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Multi-GPU training for the standard LoRA trainer
+Rank helpers, DDP / FSDP settings and a tokens/s vs. GPU-count scaling
+benchmark (launches the standard trainer under torchrun)
+
+Modes (`distributed` in configs/training_config_standard.yaml):
+- "none": single process, `device_map="auto"` (layers split across GPUs, run sequentially)
+- "ddp":  one full model replica per GPU, for models that fit on one GPU
+- "fsdp": parameters sharded across GPUs (LoRA on 14B/32B)
+
+Usage:
+    torchrun --nproc_per_node 4 src/qwen_finetune/training/finetune_standard_lora.py
+    python -m qwen_finetune.training.distributed --gpus 1 2 4 --distributed ddp
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import sys
+import json
+import yaml
+import argparse
+import subprocess
+import logging
+from typing import Dict, List, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTED_MODES = ["none", "ddp", "fsdp"]
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size() -> int:
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def is_main_process() -> bool:
+    """True on global rank 0 (and when not launched distributed)"""
+    return int(os.environ.get("RANK", 0)) == 0
+
+
+def validate_mode(mode: str) -> str:
+    if mode not in DISTRIBUTED_MODES:
+        raise ValueError(f"Unknown distributed mode: {mode} (expected one of {DISTRIBUTED_MODES})")
+    if mode != "none" and get_world_size() == 1:
+        logger.warning(f"distributed={mode} but WORLD_SIZE=1, launch with torchrun/accelerate to use several GPUs")
+    return mode
+
+
+def device_map_for(mode: str, quantized: bool = False) -> Optional[Any]:
+    """
+    `device_map` for from_pretrained
+
+    DDP places the full model on this process's GPU. FSDP loads on CPU (rank 0
+    only, see prepare_fsdp_loading) and lets the FSDP wrapper shard and move
+    parameters; 4-bit weights are placed by bitsandbytes at load time, so
+    they go straight to this rank's GPU.
+    """
+    if mode == "ddp" or (mode == "fsdp" and quantized):
+        import torch
+        return {"": get_local_rank()} if torch.cuda.is_available() else None
+    if mode == "fsdp":
+        return None
+    return "auto"
+
+
+def prepare_fsdp_loading() -> None:
+    """
+    Set up this rank before from_pretrained under FSDP
+
+    Binds the process to its GPU (bitsandbytes and NCCL use the current CUDA
+    device, which is otherwise 0 on every rank), initializes the process
+    group and enables transformers' rank-0-only loading: the other ranks
+    build the model without materializing weights and receive them through
+    `sync_module_states` when FSDP wraps the model, so host RAM holds one
+    copy of a 14B/32B checkpoint instead of one per rank.
+    """
+    import torch
+    import torch.distributed as dist
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_local_rank())
+    if get_world_size() > 1 and not dist.is_initialized():
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+
+    # Read by from_pretrained, and by TrainingArguments for fsdp_config["cpu_ram_efficient_loading"]
+    os.environ["ACCELERATE_USE_FSDP"] = "true"
+    os.environ["FSDP_CPU_RAM_EFFICIENT_LOADING"] = "true"
+
+
+def fsdp_settings(model, gradient_checkpointing: bool = False, cpu_offload: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """`fsdp` and `fsdp_config` TrainingArguments that wrap every decoder layer"""
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    layer_classes = list(getattr(base_model, "_no_split_modules", None) or [])
+
+    fsdp = "full_shard auto_wrap" + (" offload" if cpu_offload else "")
+    fsdp_config: Dict[str, Any] = {
+        "use_orig_params": True,  # LoRA: frozen and trainable parameters share wrapped units
+        "sync_module_states": True,
+        "cpu_ram_efficient_loading": True,
+        "activation_checkpointing": gradient_checkpointing,
+    }
+    if layer_classes:
+        fsdp_config["transformer_layer_cls_to_wrap"] = layer_classes
+    return fsdp, fsdp_config
+
+
+def run_scaling_benchmark(config_path: str, gpu_counts: List[int], mode: str, max_steps: int,
+                          output_dir: str) -> List[Dict[str, Any]]:
+    """
+    Train `max_steps` with each GPU count and compare tokens/s
+
+    Every run uses the throughput summary written by ThroughputCallback;
+    total tokens/s = per-device tokens/s x GPUs, scaling efficiency is
+    relative to the smallest GPU count.
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        base_config = yaml.safe_load(f) or {}
+
+    os.makedirs(output_dir, exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finetune_standard_lora.py")
+    results = []
+
+    for num_gpus in gpu_counts:
+        run_dir = os.path.join(output_dir, f"{mode}_{num_gpus}gpu")
+        run_config = {
+            **base_config,
+            "distributed": mode,
+            "max_steps": max_steps,
+            "output_dir": run_dir,
+            "save_model": False,
+            "log_throughput": True,
+            "use_wandb": False,
+            "train_intent_head": False,
+            "eval_data_path": "",  # evaluation pauses would skew tokens/s
+        }
+        run_config_path = os.path.join(output_dir, f"{mode}_{num_gpus}gpu.yaml")
+        with open(run_config_path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(run_config, f, allow_unicode=True)
+
+        command = [
+            sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={num_gpus}",
+            script, "--config", run_config_path,
+        ]
+        env = {**os.environ, "CUDA_VISIBLE_DEVICES": ",".join(str(i) for i in range(num_gpus))}
+        logger.info(f"🚀 {mode.upper()} x{num_gpus}: {' '.join(command)}")
+
+        result: Dict[str, Any] = {"gpus": num_gpus, "distributed": mode}
+        if subprocess.run(command, env=env).returncode != 0:
+            result["error"] = "training failed"
+            results.append(result)
+            continue
+
+        with open(os.path.join(run_dir, "throughput_summary.json"), 'r', encoding='utf-8') as f:
+            summary = json.load(f)
+        result.update({
+            "tokens_per_s_per_gpu": summary.get("tokens_per_s"),
+            "tokens_per_s": round(summary.get("tokens_per_s", 0) * num_gpus, 1),
+            "mfu": summary.get("mfu"),
+            "gpu_peak_memory_gb": summary.get("gpu_peak_memory_gb"),
+        })
+        results.append(result)
+
+    baseline = next((r for r in results if "error" not in r), None)
+    for result in results:
+        if baseline and "error" not in result and baseline["tokens_per_s"]:
+            ideal = baseline["tokens_per_s"] * result["gpus"] / baseline["gpus"]
+            result["scaling_efficiency"] = round(result["tokens_per_s"] / ideal, 3)
+
+    report_path = os.path.join(output_dir, "scaling_report.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Scaling report saved to: {report_path}")
+    return results
+
+
+def main():
+    """Scaling benchmark CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Tokens/s vs. GPU count for the standard LoRA trainer")
+    parser.add_argument("--config", default="configs/training_config_standard.yaml")
+    parser.add_argument("--gpus", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--distributed", choices=["ddp", "fsdp"], default="ddp")
+    parser.add_argument("--max-steps", type=int, default=30)
+    parser.add_argument("--output-dir", default="outputs/scaling")
+    args = parser.parse_args()
+
+    import torch
+    available = torch.cuda.device_count()
+    gpu_counts = [n for n in args.gpus if n <= available]
+    if not gpu_counts:
+        raise SystemExit(f"No requested GPU count fits the {available} available GPUs")
+
+    results = run_scaling_benchmark(args.config, gpu_counts, args.distributed, args.max_steps, args.output_dir)
+
+    print(f"\n📊 Scaling benchmark ({args.distributed}, {args.max_steps} steps)")
+    print(f"   {'GPUs':>4}  {'tokens/s':>10}  {'per GPU':>9}  {'efficiency':>10}  {'MFU':>6}")
+    for r in results:
+        if "error" in r:
+            print(f"   {r['gpus']:>4}  ❌ {r['error']}")
+            continue
+        mfu = f"{r['mfu']:.1%}" if r.get("mfu") is not None else "-"
+        print(f"   {r['gpus']:>4}  {r['tokens_per_s']:>10,.0f}  {r['tokens_per_s_per_gpu']:>9,.0f}  "
+              f"{r.get('scaling_efficiency', 0):>10.0%}  {mfu:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Dataset loading and intent head training shared by the Unsloth and the
+standard LoRA trainers
+
+Mixed into QwenFineTuner and StandardQwenFineTuner, which provide `config`,
+`model`, `tokenizer`, `prepare_dataset` and `tokenize_dataset`.
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import logging
+from typing import Dict, Optional, Any
+
+from datasets import Dataset
+
+from qwen_finetune.training.intent_head import load_intent_examples, fit_intent_head, save_intent_head
+from qwen_finetune.utils.dataset_cache import TokenizedDatasetCache
+from qwen_finetune.utils.dataset_io import build_streaming_dataset
+
+logger = logging.getLogger(__name__)
+
+
+class FineTunerDataMixin:
+    """Tokenized / streaming / val datasets and the intent head for both fine-tuners"""
+
+    def dataset_recipe(self) -> Dict[str, Any]:
+        """Config fields that change the tokenized dataset (part of the cache key)"""
+        recipe = {"packing": self.config.packing, "multi_target": self.config.multi_target}
+        if self.config.multi_target:
+            recipe["multi_target_attention"] = self.config.multi_target_attention
+            recipe["multi_target_window"] = self.config.multi_target_window
+        return recipe
+
+    def load_streaming_dataset(self, data_path: str, template_path: str):
+        """Tokenize a JSONL file on the fly (constant memory, bounded shuffle buffer)"""
+        if self.config.packing:
+            logger.warning("Packing needs the whole dataset, streaming without packing")
+
+        with open(template_path, 'r', encoding='utf-8') as f:
+            self.tokenizer.chat_template = f.read().strip()
+
+        return build_streaming_dataset(
+            self.tokenizer,
+            data_path,
+            self.config.max_seq_length,
+            multi_target=self.config.multi_target,
+            multi_target_attention=self.config.multi_target_attention,
+            shuffle_buffer_size=self.config.shuffle_buffer_size,
+            seed=self.config.seed,
+        )
+
+    def load_tokenized_dataset(self, data_path: str, template_path: str) -> Dataset:
+        """Prepare and tokenize the dataset, reusing the tokenized-dataset cache when possible"""
+        if self.config.streaming:
+            return self.load_streaming_dataset(data_path, template_path)
+
+        if not self.config.dataset_cache_dir:
+            return self.tokenize_dataset(self.prepare_dataset(data_path, template_path))
+
+        with open(template_path, 'r', encoding='utf-8') as f:
+            chat_template = f.read().strip()
+
+        cache = TokenizedDatasetCache(self.config.dataset_cache_dir)
+        key = cache.make_key(data_path, chat_template, self.tokenizer, self.config.max_seq_length, self.dataset_recipe())
+
+        dataset = cache.load(key)
+        if dataset is not None:
+            self.tokenizer.chat_template = chat_template
+            return dataset
+
+        dataset = self.tokenize_dataset(self.prepare_dataset(data_path, template_path))
+        cache.save(key, dataset, {"data_path": data_path, "recipe": self.dataset_recipe()})
+        return dataset
+
+    def load_eval_dataset(self, template_path: str) -> Optional[Dataset]:
+        """Tokenized val split for eval loss (None when there is no val file)"""
+        eval_path = self.config.eval_data_path
+        if not eval_path or not os.path.exists(eval_path):
+            logger.info(f"No val split at '{eval_path}', training without evaluation")
+            return None
+
+        # The val split is small: always loaded in memory, even when training streams
+        return self.tokenize_dataset(self.prepare_dataset(eval_path, template_path))
+
+    def train_intent_head(self, data_path: Optional[str] = None) -> Dict[str, Any]:
+        """Train and save an intent classification head on the fine-tuned model"""
+        data_path = data_path or self.config.intent_data_path
+        logger.info(f"Training intent head from: {data_path}")
+
+        try:
+            examples = load_intent_examples(data_path, self.config.intent_system_prompt)
+            head, labels, metrics = fit_intent_head(
+                self.model,
+                self.tokenizer,
+                examples,
+                epochs=self.config.intent_head_epochs,
+                learning_rate=self.config.intent_head_learning_rate,
+                batch_size=self.config.intent_head_batch_size,
+                max_length=self.config.max_seq_length,
+                seed=self.config.seed,
+            )
+            metrics["save_path"] = save_intent_head(head, labels, self.config.intent_head_save_path)
+            return metrics
+
+        except Exception as e:
+            logger.error(f"Error training intent head: {e}")
+            raise
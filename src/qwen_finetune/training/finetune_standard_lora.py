@@ -8,7 +8,7 @@ Date: 2025
 """
 
 import os
-import json
+import argparse
 import yaml
 import torch
 import logging
@@ -19,12 +19,38 @@ from transformers import (
     AutoModelForCausalLM,
     TrainingArguments,
     Trainer,
-    DataCollatorForLanguageModeling
+    DataCollatorForLanguageModeling,
+    DataCollatorForSeq2Seq,
 )
 from datasets import Dataset
 from peft import LoraConfig, get_peft_model, TaskType
 import wandb
 
+from qwen_finetune.training.callbacks import ThroughputCallback
+from qwen_finetune.training.distributed import (
+    validate_mode,
+    device_map_for,
+    prepare_fsdp_loading,
+    fsdp_settings,
+    is_main_process,
+)
+from qwen_finetune.training.generation_eval import (
+    GenerationEvaluator,
+    GenerationEvalCallback,
+    build_generation_examples,
+)
+from qwen_finetune.training.merge_lora import merge_lora_checkpoint
+from qwen_finetune.training.finetune_common import FineTunerDataMixin
+from qwen_finetune.utils.packing import build_packed_dataset, pack_sequences, PackedDataCollator, IGNORE_INDEX
+from qwen_finetune.utils.multi_target import (
+    build_multi_target_dataset,
+    normalize_multi_target_conversation,
+    MultiTargetDataCollator,
+)
+from qwen_finetune.utils.dataset_io import load_records, load_conversation_dataset
+from qwen_finetune.utils.formatting import format_dataset, tokenize_text_dataset
+from qwen_finetune.utils.batching import TokenBudgetTrainer
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -43,6 +69,12 @@ class StandardFineTuneConfig:
     dtype: str = "bfloat16"  # "float16", "bfloat16", "float32"
     load_in_4bit: bool = False  # Requires bitsandbytes
     load_in_8bit: bool = False
+    attn_implementation: str = "sdpa"  # "sdpa", "eager", "flash_attention_2"
+    
+    # Multi-GPU (launch with torchrun / accelerate, see scripts/train.sh)
+    distributed: str = "none"  # "none" (device_map auto), "ddp" (replica per GPU), "fsdp" (sharded, 14B/32B)
+    fsdp_cpu_offload: bool = False
+    gradient_checkpointing: bool = False
     
     # LoRA parameters
     r: int = 16
@@ -58,6 +90,8 @@ class StandardFineTuneConfig:
     # Training parameters
     per_device_train_batch_size: int = 1
     gradient_accumulation_steps: int = 8
+    max_tokens_per_batch: int = 0  # > 0: length-grouped batches up to this many padded tokens (replaces the fixed batch size)
+    length_bucket_size: int = 1000  # Samples sorted by length together when forming token-budget batches
     warmup_steps: int = 10
     max_steps: int = 100
     learning_rate: float = 2e-4
@@ -72,7 +106,29 @@ class StandardFineTuneConfig:
     save_steps: int = 50
     
     # Data parameters
+    data_path: str = "data/pika_data.json"  # .json array or .jsonl
     dataset_text_field: str = "text"
+    packing: bool = False  # Pack samples into max_seq_length rows (assistant-only loss)
+    dataset_num_proc: Optional[int] = None  # None = sized from dataset length and CPU count
+    multi_target: bool = False  # One sequence per conversation, loss on every "target": true turn
+    multi_target_attention: str = "window"  # "window" (W-turn context like sliding windows) or "causal"
+    multi_target_window: int = 3
+    dataset_cache_dir: str = "cache/tokenized_datasets"  # Empty string disables the cache
+    streaming: bool = False  # Stream a JSONL data file instead of loading it (no packing / cache)
+    shuffle_buffer_size: int = 10000
+    dataloader_num_workers: int = 0  # Streaming shards lines across workers
+    
+    # Throughput instrumentation (<output_dir>/throughput.jsonl + throughput_summary.json)
+    log_throughput: bool = True
+    peak_tflops: Optional[float] = None  # GPU peak for MFU; None = detected from the GPU name
+    
+    # Evaluation on the val split: eval loss + greedy generation metrics (<output_dir>/generation_eval.jsonl)
+    eval_data_path: str = "data/val.json"  # Written by DataProcessor.split_data; empty or missing disables evaluation
+    eval_steps: int = 50
+    per_device_eval_batch_size: int = 8
+    generation_eval: bool = True  # Intent accuracy, fast-response length rule, generation tokens/s
+    generation_eval_samples: int = 128  # Val conversations generated per evaluation
+    generation_max_new_tokens: int = 64
     
     # Model saving
     save_model: bool = True
@@ -85,9 +141,18 @@ class StandardFineTuneConfig:
     use_wandb: bool = False
     wandb_project: str = "qwen-finetune-standard"
     wandb_run_name: str = ""
+    
+    # Intent classification head (trained on the final hidden state)
+    train_intent_head: bool = False
+    intent_data_path: str = "dataProcessing/4_ParserData/parsed_output_data.xlsx"
+    intent_system_prompt: str = ""
+    intent_head_epochs: int = 5
+    intent_head_learning_rate: float = 1e-3
+    intent_head_batch_size: int = 16
+    intent_head_save_path: str = "models/intent_head"
 
 
-class StandardQwenFineTuner:
+class StandardQwenFineTuner(FineTunerDataMixin):
     """Standard LoRA fine-tuner for Qwen models (Python 3.13+ compatible)"""
     
     def __init__(self, config: StandardFineTuneConfig):
@@ -121,12 +186,19 @@ class StandardQwenFineTuner:
             # Configure dtype
             torch_dtype = torch.bfloat16 if self.config.dtype == "bfloat16" else torch.float16
             
-            # Load model
+            # Load model (DDP: whole model on this rank's GPU, FSDP: rank 0 loads, sharded later by the trainer)
+            distributed = validate_mode(self.config.distributed)
+            if distributed == "fsdp":
+                prepare_fsdp_loading()
             model_kwargs = {
                 "trust_remote_code": True,
                 "torch_dtype": torch_dtype,
-                "device_map": "auto",
+                "device_map": device_map_for(distributed, quantized=self.config.load_in_4bit),
+                "attn_implementation": self.config.attn_implementation,
             }
+            if distributed == "fsdp":
+                # Older transformers only skip materializing weights on ranks > 0 with this set
+                model_kwargs["low_cpu_mem_usage"] = True
             
             # Add quantization if specified
             if self.config.load_in_4bit:
@@ -136,7 +208,9 @@ class StandardQwenFineTuner:
                         load_in_4bit=True,
                         bnb_4bit_use_double_quant=True,
                         bnb_4bit_quant_type="nf4",
-                        bnb_4bit_compute_dtype=torch_dtype
+                        bnb_4bit_compute_dtype=torch_dtype,
+                        # FSDP shards the packed 4-bit weights, which needs a float storage dtype
+                        bnb_4bit_quant_storage=torch_dtype if distributed == "fsdp" else torch.uint8,
                     )
                     model_kwargs["quantization_config"] = bnb_config
                     logger.info("4-bit quantization enabled")
@@ -153,19 +227,7 @@ class StandardQwenFineTuner:
             )
             
             # Configure LoRA
-            logger.info("Configuring LoRA adapters...")
-            peft_config = LoraConfig(
-                task_type=TaskType.CAUSAL_LM,
-                inference_mode=False,
-                r=self.config.r,
-                lora_alpha=self.config.lora_alpha,
-                lora_dropout=self.config.lora_dropout,
-                bias=self.config.bias,
-                target_modules=self.config.target_modules,
-            )
-            
-            self.model = get_peft_model(self.model, peft_config)
-            self.model.print_trainable_parameters()
+            self.apply_lora()
             
             logger.info("Model and tokenizer loaded successfully")
             return self.model, self.tokenizer
@@ -173,6 +235,24 @@ class StandardQwenFineTuner:
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             raise
+    
+    def apply_lora(self) -> Any:
+        """Wrap the loaded base model with fresh LoRA adapters from the config"""
+        logger.info("Configuring LoRA adapters...")
+        peft_config = LoraConfig(
+            task_type=TaskType.CAUSAL_LM,
+            inference_mode=False,
+            r=self.config.r,
+            lora_alpha=self.config.lora_alpha,
+            lora_dropout=self.config.lora_dropout,
+            bias=self.config.bias,
+            target_modules=self.config.target_modules,
+        )
+        
+        self.model = get_peft_model(self.model, peft_config)
+        if is_main_process():
+            self.model.print_trainable_parameters()
+        return self.model
         
     def prepare_dataset(self, data_path: str, template_path: str) -> Dataset:
         """Prepare dataset with ChatML format"""
@@ -180,8 +260,9 @@ class StandardQwenFineTuner:
         
         try:
             # Load training data
-            with open(data_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            # JSON array, JSONL, Parquet or Arrow (memory-mapped); only the conversations column,
+            # without the rows listed in the file's error index (DataProcessor.validate_data)
+            data = load_conversation_dataset(data_path, columns=["conversations"], skip_invalid=True)
                 
             # Load chat template
             with open(template_path, 'r', encoding='utf-8') as f:
@@ -190,57 +271,22 @@ class StandardQwenFineTuner:
             # Set chat template
             self.tokenizer.chat_template = chat_template
             
-            def formatting_prompts_func(examples):
-                """Format conversations using ChatML template"""
-                convos = examples["conversations"]
-                texts = []
-                
-                for convo in convos:
-                    try:
-                        # Validate conversation structure
-                        if not isinstance(convo, list):
-                            continue
-                            
-                        valid_convo = []
-                        for turn in convo:
-                            if isinstance(turn, dict) and "role" in turn and "content" in turn:
-                                role = turn["role"].lower()
-                                if role not in ["system", "user", "assistant"]:
-                                    role = "user"
-                                    
-                                valid_convo.append({
-                                    "role": role,
-                                    "content": str(turn["content"]).strip()
-                                })
-                        
-                        if not valid_convo:
-                            continue
-                            
-                        # Apply chat template
-                        text = self.tokenizer.apply_chat_template(
-                            valid_convo,
-                            tokenize=False,
-                            add_generation_prompt=False
-                        )
-                        texts.append(text)
-                        
-                    except Exception as e:
-                        logger.warning(f"Error processing conversation: {e}")
-                        continue
-                
-                return {"text": texts}
-            
-            # Create and process dataset
-            dataset = Dataset.from_list(data)
-            dataset = dataset.map(
-                formatting_prompts_func,
-                batched=True,
-                remove_columns=dataset.column_names,
-                desc="Formatting conversations"
-            )
+            if self.config.multi_target:
+                # Keep conversations (with target flags); tokenized in tokenize_dataset
+                dataset = Dataset.from_list([
+                    {"conversations": normalize_multi_target_conversation(convo)}
+                    for convo in data["conversations"]
+                ])
+                logger.info(f"Multi-target dataset prepared with {len(dataset)} conversations")
+                return dataset
             
-            # Filter empty texts
-            dataset = dataset.filter(lambda x: len(x["text"].strip()) > 0)
+            # Normalize roles and render the chat template (no Jinja for ChatML), in parallel
+            dataset = format_dataset(
+                self.tokenizer,
+                data,
+                text_field=self.config.dataset_text_field,
+                num_proc=self.config.dataset_num_proc,
+            )
             
             logger.info(f"Dataset prepared with {len(dataset)} samples")
             return dataset
@@ -249,43 +295,96 @@ class StandardQwenFineTuner:
             logger.error(f"Error preparing dataset: {e}")
             raise
     
+    def generation_eval_callback(self) -> GenerationEvalCallback:
+        """Callback generating replies for the first val conversations at every evaluation"""
+        examples = build_generation_examples(
+            load_records(self.config.eval_data_path),
+            max_samples=self.config.generation_eval_samples,
+        )
+        logger.info(f"Generation eval: {len(examples)} val conversations every {self.config.eval_steps} steps")
+        evaluator = GenerationEvaluator(
+            self.tokenizer,
+            examples,
+            batch_size=self.config.per_device_eval_batch_size,
+            max_new_tokens=self.config.generation_max_new_tokens,
+        )
+        return GenerationEvalCallback(self.trainer, evaluator, output_dir=self.config.output_dir)
+    
     def tokenize_dataset(self, dataset: Dataset) -> Dataset:
         """Tokenize the dataset"""
+        if not isinstance(dataset, Dataset) or "input_ids" in dataset.column_names:
+            return dataset
+        
         logger.info("Tokenizing dataset...")
         
-        def tokenize_function(examples):
-            # Tokenize texts
-            tokenized = self.tokenizer(
-                examples["text"],
-                truncation=True,
-                padding=False,
-                max_length=self.config.max_seq_length,
-                return_overflowing_tokens=False,
+        if self.config.multi_target:
+            window_attention = self.config.multi_target_attention == "window"
+            tokenized = build_multi_target_dataset(
+                self.tokenizer,
+                dataset,
+                self.config.max_seq_length,
+                attention=self.config.multi_target_attention,
+                window=self.config.multi_target_window,
+                num_proc=self.config.dataset_num_proc,
             )
-            
-            # For causal language modeling, labels are the same as input_ids
-            tokenized["labels"] = tokenized["input_ids"].copy()
-            
+            if self.config.packing and window_attention:
+                logger.warning("Packing is not supported with window attention, training one conversation per row")
+            elif self.config.packing:
+                tokenized = pack_sequences(tokenized, self.config.max_seq_length)
             return tokenized
         
-        tokenized_dataset = dataset.map(
-            tokenize_function,
-            batched=True,
-            remove_columns=dataset.column_names,
-            desc="Tokenizing dataset"
+        if self.config.packing:
+            return build_packed_dataset(
+                self.tokenizer,
+                dataset,
+                self.config.max_seq_length,
+                text_field=self.config.dataset_text_field,
+                num_proc=self.config.dataset_num_proc,
+            )
+        
+        tokenized_dataset = tokenize_text_dataset(
+            self.tokenizer,
+            dataset,
+            self.config.max_seq_length,
+            text_field=self.config.dataset_text_field,
+            num_proc=self.config.dataset_num_proc,
         )
         
         logger.info(f"Tokenized dataset: {len(tokenized_dataset)} samples")
         return tokenized_dataset
         
-    def create_trainer(self, dataset: Dataset) -> Trainer:
-        """Create Hugging Face trainer"""
+    def create_trainer(self, dataset: Dataset, eval_dataset: Optional[Dataset] = None) -> Trainer:
+        """Create Hugging Face trainer (evaluating every eval_steps when a val dataset is given)"""
         logger.info("Creating trainer...")
         
         try:
             # Tokenize dataset
             tokenized_dataset = self.tokenize_dataset(dataset)
             
+            eval_kwargs = {}
+            if eval_dataset is not None:
+                eval_kwargs = {
+                    "eval_strategy": "steps",
+                    "eval_steps": self.config.eval_steps,
+                    "per_device_eval_batch_size": self.config.per_device_eval_batch_size,
+                }
+            
+            distributed_kwargs = {}
+            if self.config.distributed == "fsdp":
+                fsdp, fsdp_config = fsdp_settings(
+                    self.model,
+                    gradient_checkpointing=self.config.gradient_checkpointing,
+                    cpu_offload=self.config.fsdp_cpu_offload,
+                )
+                distributed_kwargs = {"fsdp": fsdp, "fsdp_config": fsdp_config}
+            else:
+                distributed_kwargs = {"gradient_checkpointing": self.config.gradient_checkpointing}
+                if self.config.distributed == "ddp":
+                    # LoRA leaves most parameters frozen; skip the unused-parameter search every step
+                    distributed_kwargs["ddp_find_unused_parameters"] = False
+            if self.config.gradient_checkpointing:
+                distributed_kwargs["gradient_checkpointing_kwargs"] = {"use_reentrant": False}
+            
             training_args = TrainingArguments(
                 output_dir=self.config.output_dir,
                 per_device_train_batch_size=self.config.per_device_train_batch_size,
@@ -305,23 +404,81 @@ class StandardQwenFineTuner:
                 logging_first_step=True,
                 remove_unused_columns=False,
                 dataloader_pin_memory=False,
+                dataloader_num_workers=self.config.dataloader_num_workers,
                 report_to="wandb" if self.config.use_wandb else [],
                 run_name=self.config.wandb_run_name if self.config.wandb_run_name else None,
+                **distributed_kwargs,
+                **eval_kwargs,
             )
             
-            # Data collator for language modeling
-            data_collator = DataCollatorForLanguageModeling(
-                tokenizer=self.tokenizer,
-                mlm=False,  # We're doing causal language modeling
-            )
+            compute_dtype = torch.bfloat16 if self.config.dtype == "bfloat16" else torch.float16
+            window_attention = self.config.multi_target and self.config.multi_target_attention == "window"
             
-            self.trainer = Trainer(
-                model=self.model,
-                args=training_args,
-                train_dataset=tokenized_dataset,
-                data_collator=data_collator,
-                tokenizer=self.tokenizer,
-            )
+            if window_attention:
+                if self.config.attn_implementation == "flash_attention_2":
+                    raise ValueError("Window multi-target attention needs sdpa or eager attention")
+                data_collator = MultiTargetDataCollator(
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    window=self.config.multi_target_window,
+                    dtype=compute_dtype,
+                )
+            elif self.config.packing:
+                # Varlen kernels split on position resets; other backends need a block-diagonal mask
+                data_collator = PackedDataCollator(
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    mode="position_ids" if self.config.attn_implementation == "flash_attention_2" else "mask",
+                    dtype=compute_dtype,
+                )
+            elif self.config.multi_target:
+                # Pad labels instead of recomputing them from input_ids
+                data_collator = DataCollatorForSeq2Seq(
+                    self.tokenizer,
+                    padding=True,
+                    label_pad_token_id=IGNORE_INDEX,
+                )
+            else:
+                # Data collator for language modeling
+                data_collator = DataCollatorForLanguageModeling(
+                    tokenizer=self.tokenizer,
+                    mlm=False,  # We're doing causal language modeling
+                )
+            
+            trainer_kwargs = {
+                "model": self.model,
+                "args": training_args,
+                "train_dataset": tokenized_dataset,
+                "eval_dataset": eval_dataset,
+                "data_collator": data_collator,
+                "tokenizer": self.tokenizer,
+            }
+            
+            if self.config.max_tokens_per_batch > 0 and isinstance(tokenized_dataset, Dataset):
+                if self.config.max_tokens_per_batch < self.config.max_seq_length:
+                    logger.warning(
+                        f"max_tokens_per_batch ({self.config.max_tokens_per_batch}) < max_seq_length "
+                        f"({self.config.max_seq_length}): the longest samples get single-sample batches"
+                    )
+                logger.info(f"Token-budget batching: up to {self.config.max_tokens_per_batch} padded tokens per batch")
+                self.trainer = TokenBudgetTrainer(
+                    max_tokens_per_batch=self.config.max_tokens_per_batch,
+                    bucket_size=self.config.length_bucket_size,
+                    **trainer_kwargs,
+                )
+            else:
+                if self.config.max_tokens_per_batch > 0:
+                    logger.warning("Token-budget batching needs a tokenized dataset, using the fixed batch size for streaming")
+                self.trainer = Trainer(**trainer_kwargs)
+            
+            if self.config.log_throughput:
+                self.trainer.add_callback(ThroughputCallback(
+                    self.trainer,
+                    output_dir=self.config.output_dir,
+                    peak_tflops=self.config.peak_tflops,
+                    use_wandb=self.config.use_wandb,
+                ))
+            
+            if eval_dataset is not None and self.config.generation_eval:
+                self.trainer.add_callback(self.generation_eval_callback())
             
             logger.info("Trainer created successfully")
             return self.trainer
@@ -335,8 +492,9 @@ class StandardQwenFineTuner:
         if self.trainer is None:
             raise ValueError("Trainer not initialized. Call create_trainer() first.")
             
-        # Initialize wandb if enabled
-        if self.config.use_wandb:
+        # Initialize wandb if enabled (one run, on rank 0)
+        use_wandb = self.config.use_wandb and is_main_process()
+        if use_wandb:
             wandb.init(
                 project=self.config.wandb_project,
                 name=self.config.wandb_run_name,
@@ -348,8 +506,12 @@ class StandardQwenFineTuner:
             logger.info("STARTING TRAINING (Standard LoRA)")
             logger.info("=" * 50)
             logger.info(f"Model: {self.config.model_name}")
+            logger.info(f"Distributed: {self.config.distributed} (world size {self.trainer.args.world_size})")
             logger.info(f"Max steps: {self.config.max_steps}")
-            logger.info(f"Batch size: {self.config.per_device_train_batch_size}")
+            if self.config.max_tokens_per_batch > 0:
+                logger.info(f"Tokens per batch: {self.config.max_tokens_per_batch}")
+            else:
+                logger.info(f"Batch size: {self.config.per_device_train_batch_size}")
             logger.info(f"LoRA r: {self.config.r}")
             logger.info("=" * 50)
             
@@ -366,14 +528,18 @@ class StandardQwenFineTuner:
             logger.error(f"Error during training: {e}")
             raise
         finally:
-            if self.config.use_wandb:
+            if use_wandb:
                 wandb.finish()
-        
+    
     def save_model(self) -> None:
         """Save the fine-tuned model"""
         if not self.config.save_model:
             return
             
+        if self.config.distributed != "none":
+            self.save_model_distributed()
+            return
+            
         logger.info(f"Saving model using method: {self.config.save_method}")
         
         try:
@@ -386,15 +552,13 @@ class StandardQwenFineTuner:
                 logger.info(f"LoRA adapters saved to: {save_path}")
                 
             elif self.config.save_method == "merged":
-                # Merge LoRA weights and save full model
+                # Save the adapters, then merge them into the base safetensors shard by
+                # shard on CPU (the trained model stays untouched on the GPU)
+                adapter_path = "models/lora_adapters"
                 save_path = "models/merged"
-                os.makedirs(save_path, exist_ok=True)
-                
-                # Merge and unload LoRA
-                merged_model = self.model.merge_and_unload()
-                merged_model.save_pretrained(save_path)
-                self.tokenizer.save_pretrained(save_path)
-                logger.info(f"Merged model saved to: {save_path}")
+                self.model.save_pretrained(adapter_path)
+                self.tokenizer.save_pretrained(adapter_path)
+                merge_lora_checkpoint(self.config.model_name, adapter_path, save_path)
                 
             # Push to hub if configured
             if self.config.push_to_hub and self.config.hub_model_id:
@@ -407,6 +571,43 @@ class StandardQwenFineTuner:
         except Exception as e:
             logger.error(f"Error saving model: {e}")
             raise
+    
+    def save_model_distributed(self) -> None:
+        """
+        Save from a DDP/FSDP run
+        
+        Every rank takes part in `trainer.save_model` (FSDP gathers the
+        sharded adapter weights); only rank 0 writes files. For "merged", rank 0
+        then merges the saved adapters into the base safetensors shard by shard,
+        since no single rank holds the full weights under FSDP.
+        """
+        adapter_path = "models/lora_adapters"
+        logger.info(f"Saving LoRA adapters from all ranks ({self.config.distributed})")
+        
+        try:
+            self.trainer.save_model(adapter_path)
+            if not self.trainer.is_world_process_zero():
+                return
+            
+            self.tokenizer.save_pretrained(adapter_path)
+            logger.info(f"LoRA adapters saved to: {adapter_path}")
+            save_path = adapter_path
+            
+            if self.config.save_method == "merged":
+                save_path = "models/merged"
+                merge_lora_checkpoint(self.config.model_name, adapter_path, save_path)
+            
+            if self.config.push_to_hub and self.config.hub_model_id:
+                from huggingface_hub import HfApi
+                
+                logger.info(f"Pushing to Hub: {self.config.hub_model_id}")
+                api = HfApi(token=self.config.hub_token if self.config.hub_token else None)
+                api.create_repo(self.config.hub_model_id, exist_ok=True)
+                api.upload_folder(repo_id=self.config.hub_model_id, folder_path=save_path)
+                
+        except Exception as e:
+            logger.error(f"Error saving model: {e}")
+            raise
 
 
 def load_standard_config(config_path: str) -> StandardFineTuneConfig:
@@ -448,10 +649,14 @@ def main():
         else:
             logger.info("⚠️  Standard LoRA training (Unsloth recommended for Python <3.13)")
         
+        parser = argparse.ArgumentParser(description="Standard LoRA fine-tuning")
+        parser.add_argument("--config", default=None, help="Default: configs/training_config_standard.yaml")
+        args, _ = parser.parse_known_args()
+        
         # Load configuration
         # Try standard config first, then fall back to regular config
-        config_path = "configs/training_config_standard.yaml"
-        if not os.path.exists(config_path):
+        config_path = args.config or "configs/training_config_standard.yaml"
+        if not args.config and not os.path.exists(config_path):
             config_path = "configs/training_config.yaml"
             logger.info("Using regular training config (will adapt for standard LoRA)")
             
@@ -462,7 +667,7 @@ def main():
         config = load_standard_config(config_path)
         
         # Validate required files
-        data_path = "data/pika_data.json"
+        data_path = config.data_path
         template_path = "data/chat_template.txt"
         
         for path in [data_path, template_path]:
@@ -477,22 +682,41 @@ def main():
         # Load model and tokenizer
         fine_tuner.load_model_and_tokenizer()
         
-        # Prepare dataset
-        dataset = fine_tuner.prepare_dataset(data_path, template_path)
+        # Prepare and tokenize dataset (cached across runs); under DDP/FSDP rank 0
+        # builds the cache entry first and the other ranks load it
+        if config.distributed != "none":
+            from accelerate import PartialState
+            with PartialState().main_process_first():
+                dataset = fine_tuner.load_tokenized_dataset(data_path, template_path)
+                eval_dataset = fine_tuner.load_eval_dataset(template_path)
+        else:
+            dataset = fine_tuner.load_tokenized_dataset(data_path, template_path)
+            eval_dataset = fine_tuner.load_eval_dataset(template_path)
         
-        if len(dataset) == 0:
+        if not config.streaming and len(dataset) == 0:
             logger.error("No valid training samples found")
             return
         
-        # Create trainer
-        fine_tuner.create_trainer(dataset)
+        # Create trainer (eval loss + generation metrics on the val split, if present)
+        fine_tuner.create_trainer(dataset, eval_dataset)
         
         # Train the model
         fine_tuner.train()
         
+        # Train intent head on the fine-tuned model (optional)
+        if config.train_intent_head and config.distributed == "none":
+            fine_tuner.train_intent_head()
+        
         # Save model
         fine_tuner.save_model()
         
+        # Distributed runs: intent head on rank 0 after saving (not supported on FSDP shards)
+        if config.train_intent_head and config.distributed != "none":
+            if config.distributed == "fsdp":
+                logger.warning("Intent head training is not supported with FSDP, run it on the saved model instead")
+            elif is_main_process():
+                fine_tuner.train_intent_head()
+        
         logger.info("🎉 Standard LoRA fine-tuning completed successfully!")
         
     except Exception as e:
@@ -8,19 +8,30 @@ Date: 2025
 """
 
 import os
-import json
 import yaml
 import torch
 import logging
 from typing import Dict, List, Optional, Tuple, Any
 from dataclasses import dataclass, field
-from transformers import TrainingArguments
+from transformers import TrainingArguments, DataCollatorForSeq2Seq
 from datasets import Dataset, load_dataset
 from unsloth import FastLanguageModel, is_bfloat16_supported
 from unsloth.chat_templates import get_chat_template
 from trl import SFTTrainer
 import wandb
 
+from qwen_finetune.training.callbacks import ThroughputCallback
+from qwen_finetune.training.generation_eval import (
+    GenerationEvaluator,
+    GenerationEvalCallback,
+    build_generation_examples,
+)
+from qwen_finetune.training.finetune_common import FineTunerDataMixin
+from qwen_finetune.utils.packing import build_packed_dataset, pack_sequences, PackedDataCollator, IGNORE_INDEX
+from qwen_finetune.utils.multi_target import build_multi_target_dataset, normalize_multi_target_conversation
+from qwen_finetune.utils.dataset_io import load_records, load_conversation_dataset
+from qwen_finetune.utils.formatting import format_dataset, tokenize_text_dataset, auto_num_proc
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -69,8 +80,29 @@ class FineTuneConfig:
     output_dir: str = "outputs"
     
     # Data parameters
+    data_path: str = "data/pika_data.json"  # .json array or .jsonl
     dataset_text_field: str = "text"
-    packing: bool = False
+    packing: bool = False  # Pack samples into max_seq_length rows (assistant-only loss)
+    dataset_num_proc: Optional[int] = None  # None = sized from dataset length and CPU count
+    multi_target: bool = False  # One sequence per conversation, loss on every "target": true turn
+    multi_target_attention: str = "causal"  # Only "causal" here; "window" needs the standard trainer
+    multi_target_window: int = 3
+    dataset_cache_dir: str = "cache/tokenized_datasets"  # Empty string disables the cache
+    streaming: bool = False  # Stream a JSONL data file instead of loading it (no packing / cache)
+    shuffle_buffer_size: int = 10000
+    dataloader_num_workers: int = 0  # Streaming shards lines across workers
+    
+    # Throughput instrumentation (<output_dir>/throughput.jsonl + throughput_summary.json)
+    log_throughput: bool = True
+    peak_tflops: Optional[float] = None  # GPU peak for MFU; None = detected from the GPU name
+    
+    # Evaluation on the val split: eval loss + greedy generation metrics (<output_dir>/generation_eval.jsonl)
+    eval_data_path: str = "data/val.json"  # Written by DataProcessor.split_data; empty or missing disables evaluation
+    eval_steps: int = 20
+    per_device_eval_batch_size: int = 8
+    generation_eval: bool = True  # Intent accuracy, fast-response length rule, generation tokens/s
+    generation_eval_samples: int = 128  # Val conversations generated per evaluation
+    generation_max_new_tokens: int = 64
     
     # Model saving
     save_model: bool = True
@@ -83,9 +115,18 @@ class FineTuneConfig:
     use_wandb: bool = False
     wandb_project: str = "qwen-finetune"
     wandb_run_name: str = ""
+    
+    # Intent classification head (trained on the final hidden state)
+    train_intent_head: bool = False
+    intent_data_path: str = "dataProcessing/4_ParserData/parsed_output_data.xlsx"
+    intent_system_prompt: str = ""
+    intent_head_epochs: int = 5
+    intent_head_learning_rate: float = 1e-3
+    intent_head_batch_size: int = 16
+    intent_head_save_path: str = "models/intent_head"
 
 
-class QwenFineTuner:
+class QwenFineTuner(FineTunerDataMixin):
     """Fine-tuner for Qwen models using Unsloth and LoRA"""
     
     def __init__(self, config: FineTuneConfig):
@@ -146,11 +187,9 @@ class QwenFineTuner:
         
         try:
             # Load training data
-            with open(data_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            if not isinstance(data, list):
-                raise ValueError("Data must be a list of conversation objects")
+            # JSON array, JSONL, Parquet or Arrow (memory-mapped); only the conversations column,
+            # without the rows listed in the file's error index (DataProcessor.validate_data)
+            data = load_conversation_dataset(data_path, columns=["conversations"], skip_invalid=True)
                 
             logger.info(f"Loaded {len(data)} training examples")
             
@@ -162,71 +201,23 @@ class QwenFineTuner:
             self.tokenizer.chat_template = chat_template
             logger.info("Chat template configured")
             
-            def formatting_prompts_func(examples):
-                """Format conversations using ChatML template"""
-                convos = examples["conversations"]
-                texts = []
-                
-                for convo in convos:
-                    try:
-                        # Ensure proper conversation format
-                        if not isinstance(convo, list):
-                            logger.warning(f"Skipping invalid conversation: {convo}")
-                            continue
-                            
-                        # Validate conversation structure
-                        valid_convo = []
-                        for turn in convo:
-                            if isinstance(turn, dict) and "role" in turn and "content" in turn:
-                                # Normalize role names
-                                role = turn["role"].lower()
-                                if role in ["human", "user"]:
-                                    role = "user"
-                                elif role in ["assistant", "gpt", "bot"]:
-                                    role = "assistant"
-                                elif role == "system":
-                                    role = "system"
-                                else:
-                                    logger.warning(f"Unknown role: {role}, defaulting to user")
-                                    role = "user"
-                                    
-                                valid_convo.append({
-                                    "role": role,
-                                    "content": str(turn["content"]).strip()
-                                })
-                        
-                        if not valid_convo:
-                            logger.warning("Skipping empty conversation")
-                            continue
-                            
-                        # Apply chat template
-                        text = self.tokenizer.apply_chat_template(
-                            valid_convo,
-                            tokenize=False,
-                            add_generation_prompt=False
-                        )
-                        texts.append(text)
-                        
-                    except Exception as e:
-                        logger.warning(f"Error processing conversation: {e}")
-                        continue
-                
-                return {"text": texts}
-            
-            # Create and process dataset
-            dataset = Dataset.from_list(data)
-            original_columns = dataset.column_names
+            if self.config.multi_target:
+                # Keep conversations (with target flags); tokenized in create_trainer
+                dataset = Dataset.from_list([
+                    {"conversations": normalize_multi_target_conversation(convo)}
+                    for convo in data["conversations"]
+                ])
+                logger.info(f"Multi-target dataset prepared with {len(dataset)} conversations")
+                return dataset
             
-            dataset = dataset.map(
-                formatting_prompts_func,
-                batched=True,
-                remove_columns=original_columns,
-                desc="Formatting conversations"
+            # Normalize roles and render the chat template (no Jinja for ChatML), in parallel
+            dataset = format_dataset(
+                self.tokenizer,
+                data,
+                text_field=self.config.dataset_text_field,
+                num_proc=self.config.dataset_num_proc,
             )
             
-            # Filter out empty texts
-            dataset = dataset.filter(lambda x: len(x["text"].strip()) > 0)
-            
             logger.info(f"Dataset prepared with {len(dataset)} valid samples")
             
             # Log a sample for verification
@@ -240,11 +231,92 @@ class QwenFineTuner:
             logger.error(f"Error preparing dataset: {e}")
             raise
         
-    def create_trainer(self, dataset: Dataset) -> SFTTrainer:
-        """Create SFT trainer with optimized settings"""
+    def load_streaming_dataset(self, data_path: str, template_path: str):
+        """Streaming dataset (see FineTunerDataMixin), causal multi-target attention only"""
+        if self.config.multi_target and self.config.multi_target_attention != "causal":
+            raise ValueError("Unsloth trainer supports multi_target_attention: causal only")
+        return super().load_streaming_dataset(data_path, template_path)
+    
+    def generation_eval_callback(self) -> GenerationEvalCallback:
+        """Callback generating replies for the first val conversations at every evaluation"""
+        examples = build_generation_examples(
+            load_records(self.config.eval_data_path),
+            max_samples=self.config.generation_eval_samples,
+        )
+        logger.info(f"Generation eval: {len(examples)} val conversations every {self.config.eval_steps} steps")
+        evaluator = GenerationEvaluator(
+            self.tokenizer,
+            examples,
+            batch_size=self.config.per_device_eval_batch_size,
+            max_new_tokens=self.config.generation_max_new_tokens,
+        )
+        # Unsloth's fast generation path has to be switched on and off around generate()
+        return GenerationEvalCallback(
+            self.trainer,
+            evaluator,
+            output_dir=self.config.output_dir,
+            prepare_inference=FastLanguageModel.for_inference,
+            prepare_training=FastLanguageModel.for_training,
+        )
+    
+    def tokenize_dataset(self, dataset: Dataset) -> Dataset:
+        """Tokenize formatted texts (or multi-target conversations) for training"""
+        if not isinstance(dataset, Dataset) or "input_ids" in dataset.column_names:
+            return dataset
+        
+        logger.info("Tokenizing dataset...")
+        
+        if self.config.multi_target:
+            if self.config.multi_target_attention != "causal":
+                raise ValueError(
+                    "Unsloth kernels do not take custom attention masks; use "
+                    "multi_target_attention: causal or finetune_standard_lora.py for window attention"
+                )
+            tokenized = build_multi_target_dataset(
+                self.tokenizer,
+                dataset,
+                self.config.max_seq_length,
+                attention="causal",
+                window=self.config.multi_target_window,
+                num_proc=self.config.dataset_num_proc,
+            )
+            if self.config.packing:
+                tokenized = pack_sequences(tokenized, self.config.max_seq_length)
+            return tokenized
+        
+        if self.config.packing:
+            return build_packed_dataset(
+                self.tokenizer,
+                dataset,
+                self.config.max_seq_length,
+                text_field=self.config.dataset_text_field,
+                num_proc=self.config.dataset_num_proc,
+            )
+        
+        tokenized_dataset = tokenize_text_dataset(
+            self.tokenizer,
+            dataset,
+            self.config.max_seq_length,
+            text_field=self.config.dataset_text_field,
+            num_proc=self.config.dataset_num_proc,
+        )
+        
+        logger.info(f"Tokenized dataset: {len(tokenized_dataset)} samples")
+        return tokenized_dataset
+        
+    def create_trainer(self, dataset: Dataset, eval_dataset: Optional[Dataset] = None) -> SFTTrainer:
+        """Create SFT trainer with optimized settings (evaluating every eval_steps when a val dataset is given)"""
         logger.info("Creating SFT trainer...")
         
         try:
+            eval_kwargs = {}
+            if eval_dataset is not None:
+                eval_kwargs = {
+                    "eval_strategy": "steps",
+                    "eval_steps": self.config.eval_steps,
+                    "per_device_eval_batch_size": self.config.per_device_eval_batch_size,
+                }
+            
             training_args = TrainingArguments(
                 per_device_train_batch_size=self.config.per_device_train_batch_size,
                 gradient_accumulation_steps=self.config.gradient_accumulation_steps,
@@ -266,18 +338,51 @@ class QwenFineTuner:
                 logging_first_step=True,
                 remove_unused_columns=False,
                 dataloader_pin_memory=False,
+                dataloader_num_workers=self.config.dataloader_num_workers,
+                **eval_kwargs,
             )
             
-            self.trainer = SFTTrainer(
-                model=self.model,
-                tokenizer=self.tokenizer,
-                train_dataset=dataset,
-                dataset_text_field=self.config.dataset_text_field,
-                max_seq_length=self.config.max_seq_length,
-                dataset_num_proc=2,
-                packing=self.config.packing,
-                args=training_args,
-            )
+            if not isinstance(dataset, Dataset) or "input_ids" in dataset.column_names:
+                if isinstance(dataset, Dataset) and "seq_lengths" in dataset.column_names:
+                    # Position-ID resets isolate packed samples in Unsloth's varlen attention
+                    data_collator = PackedDataCollator(self.tokenizer.pad_token_id, mode="position_ids")
+                else:
+                    data_collator = DataCollatorForSeq2Seq(self.tokenizer, padding=True, label_pad_token_id=IGNORE_INDEX)
+                
+                self.trainer = SFTTrainer(
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    train_dataset=dataset,
+                    eval_dataset=eval_dataset,
+                    max_seq_length=self.config.max_seq_length,
+                    data_collator=data_collator,
+                    dataset_kwargs={"skip_prepare_dataset": True},
+                    packing=False,
+                    args=training_args,
+                )
+            else:
+                self.trainer = SFTTrainer(
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    train_dataset=dataset,
+                    eval_dataset=eval_dataset,
+                    dataset_text_field=self.config.dataset_text_field,
+                    max_seq_length=self.config.max_seq_length,
+                    dataset_num_proc=self.config.dataset_num_proc or auto_num_proc(len(dataset)),
+                    packing=False,
+                    args=training_args,
+                )
+            
+            if self.config.log_throughput:
+                self.trainer.add_callback(ThroughputCallback(
+                    self.trainer,
+                    output_dir=self.config.output_dir,
+                    peak_tflops=self.config.peak_tflops,
+                    use_wandb=self.config.use_wandb,
+                ))
+            
+            if eval_dataset is not None and self.config.generation_eval:
+                self.trainer.add_callback(self.generation_eval_callback())
             
             logger.info("SFT trainer created successfully")
             return self.trainer
@@ -330,7 +435,7 @@ class QwenFineTuner:
         finally:
             if self.config.use_wandb:
                 wandb.finish()
-        
+    
     def save_model(self) -> None:
         """Save the fine-tuned model"""
         if not self.config.save_model:
@@ -413,7 +518,7 @@ def main():
         config = load_config(config_path)
         
         # Validate required files
-        data_path = "data/pika_data.json"
+        data_path = config.data_path
         template_path = "data/chat_template.txt"
         
         if not os.path.exists(data_path):
@@ -431,19 +536,24 @@ def main():
         # Load model and tokenizer
         fine_tuner.load_model_and_tokenizer()
         
-        # Prepare dataset
-        dataset = fine_tuner.prepare_dataset(data_path, template_path)
+        # Prepare and tokenize dataset (cached across runs)
+        dataset = fine_tuner.load_tokenized_dataset(data_path, template_path)
+        eval_dataset = fine_tuner.load_eval_dataset(template_path)
         
-        if len(dataset) == 0:
+        if not config.streaming and len(dataset) == 0:
             logger.error("No valid training samples found")
             return
         
-        # Create trainer
-        fine_tuner.create_trainer(dataset)
+        # Create trainer (eval loss + generation metrics on the val split, if present)
+        fine_tuner.create_trainer(dataset, eval_dataset)
         
         # Train the model
         fine_tuner.train()
         
+        # Train intent head on the fine-tuned model (optional)
+        if config.train_intent_head:
+            fine_tuner.train_intent_head()
+        
         # Save model
         fine_tuner.save_model()
         
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Generation-based evaluation during training
+Batched greedy generation (left padding, KV cache) over the val split written
+by `DataProcessor.split_data`, scored for intent accuracy and fast-response
+length-rule compliance, with generation throughput, logged next to eval loss
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import re
+import json
+import time
+import logging
+from typing import Callable, Dict, List, Optional, Any
+
+import torch
+from transformers import TrainerCallback
+
+from qwen_finetune.utils.formatting import ChatTemplateFormatter, normalize_conversation
+from qwen_finetune.utils.intents import normalize_intent
+
+logger = logging.getLogger(__name__)
+
+# Fast-response length rule (QuickReact prompt): 3-8 words, at most 60 characters
+FAST_RESPONSE_MAX_CHARS = 60
+FAST_RESPONSE_MIN_WORDS = 3
+FAST_RESPONSE_MAX_WORDS = 8
+
+RESPONSE_KEYS = ["fast_response", "response", "text"]
+
+
+def _parse_json(text: str) -> Optional[Dict[str, Any]]:
+    cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", str(text).strip())
+    if not cleaned.startswith("{"):
+        return None
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def json_intent(text: str) -> Optional[str]:
+    """Intent label of a JSON reply ({"user_intent": ...} / {"intent": ...}), None for anything else"""
+    data = _parse_json(text)
+    return normalize_intent(data.get("user_intent", data.get("intent"))) if data else None
+
+
+def response_text(text: str) -> str:
+    """The reply to score: the response field of a JSON output, else the whole text"""
+    data = _parse_json(text)
+    if data:
+        for key in RESPONSE_KEYS:
+            if isinstance(data.get(key), str):
+                return data[key].strip()
+    return str(text).strip()
+
+
+def length_rule_ok(text: str, max_chars: int = FAST_RESPONSE_MAX_CHARS,
+                   min_words: int = FAST_RESPONSE_MIN_WORDS, max_words: int = FAST_RESPONSE_MAX_WORDS) -> bool:
+    """True if a fast response follows the length rule"""
+    text = text.strip()
+    return len(text) <= max_chars and min_words <= len(text.split()) <= max_words
+
+
+def build_generation_examples(records: List[Dict[str, Any]], max_samples: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Prompt / reference pairs from val records
+
+    The prompt is the conversation up to its last assistant turn, the
+    reference is that turn. An example is intent-labelled only when the
+    reference is a JSON reply with an intent key, i.e. the model is trained
+    to emit one; the label is the record's `user_intent` / `intent` field,
+    else the reply's. Plain-text replies (data/pika_data.json) get None.
+    """
+    examples = []
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        messages = normalize_conversation(record.get("conversations"))
+        last = max((i for i, m in enumerate(messages) if m["role"] == "assistant"), default=None)
+        if not last:  # no assistant turn, or nothing to prompt with before it
+            continue
+
+        reference = messages[last]["content"]
+        intent = None
+        reply_intent = json_intent(reference)
+        if reply_intent is not None:
+            intent = normalize_intent(record.get("user_intent", record.get("intent"))) or reply_intent
+
+        examples.append({"messages": messages[:last], "reference": reference, "intent": intent})
+        if max_samples and len(examples) >= max_samples:
+            break
+    return examples
+
+
+class GenerationEvaluator:
+    """Greedy batched generation over fixed examples and the metrics on top of it"""
+
+    def __init__(self, tokenizer, examples: List[Dict[str, Any]], batch_size: int = 8, max_new_tokens: int = 64):
+        self.tokenizer = tokenizer
+        self.examples = examples
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+
+        formatter = ChatTemplateFormatter(tokenizer)
+        prompts = [formatter.render(example["messages"], add_generation_prompt=True) for example in examples]
+        # Similar prompt lengths per batch keep left padding short
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+        self.prompts = [prompts[i] for i in order]
+        self.examples = [examples[i] for i in order]
+
+        labelled = sum(1 for example in examples if example["intent"])
+        if labelled:
+            logger.info(f"Generation eval: intent accuracy on {labelled}/{len(examples)} labelled examples")
+        else:
+            logger.info("Generation eval: intent accuracy skipped, the val replies carry no intent labels "
+                        "(plain-text replies, no JSON user_intent)")
+
+    @torch.no_grad()
+    def generate(self, model) -> Dict[str, Any]:
+        """Predictions plus generated-token and timing counts"""
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        device = next(model.parameters()).device
+
+        predictions: List[str] = []
+        generated_tokens = 0
+        start = time.perf_counter()
+        try:
+            for begin in range(0, len(self.prompts), self.batch_size):
+                batch = self.tokenizer(
+                    self.prompts[begin:begin + self.batch_size],
+                    return_tensors="pt",
+                    padding=True,
+                    add_special_tokens=False,
+                ).to(device)
+                output = model.generate(
+                    **batch,
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=False,
+                    use_cache=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+                new_tokens = output[:, batch["input_ids"].shape[1]:]
+                # Count tokens up to and including the first EOS, not the padding after it
+                is_eos = new_tokens.eq(self.tokenizer.eos_token_id).int()
+                generated_tokens += int(is_eos.cumsum(dim=1).sub(is_eos).eq(0).sum())
+                predictions.extend(self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True))
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        return {
+            "predictions": [p.strip() for p in predictions],
+            "generated_tokens": generated_tokens,
+            "elapsed_s": time.perf_counter() - start,
+        }
+
+    def evaluate(self, model) -> Dict[str, Any]:
+        """Generate and score (model is put in eval mode and restored afterwards)"""
+        was_training = model.training
+        model.eval()
+        try:
+            output = self.generate(model)
+        finally:
+            if was_training:
+                model.train()
+
+        predictions = output["predictions"]
+        elapsed = max(output["elapsed_s"], 1e-9)
+        metrics: Dict[str, Any] = {
+            "samples": len(predictions),
+            "length_compliance": sum(length_rule_ok(response_text(p)) for p in predictions) / max(len(predictions), 1),
+            "reference_length_compliance": sum(
+                length_rule_ok(response_text(e["reference"])) for e in self.examples
+            ) / max(len(self.examples), 1),
+            "exact_match": sum(
+                response_text(p) == response_text(e["reference"]) for p, e in zip(predictions, self.examples)
+            ) / max(len(predictions), 1),
+            "tokens_per_s": output["generated_tokens"] / elapsed,
+            "samples_per_s": len(predictions) / elapsed,
+            "time_s": elapsed,
+        }
+
+        labelled = [(p, e["intent"]) for p, e in zip(predictions, self.examples) if e["intent"]]
+        if labelled:
+            # Only a JSON intent counts, not a label word that happens to appear in free text
+            metrics["intent_accuracy"] = sum(json_intent(p) == intent for p, intent in labelled) / len(labelled)
+            metrics["intent_samples"] = len(labelled)
+
+        metrics = {k: round(v, 4) if isinstance(v, float) else v for k, v in metrics.items()}
+        metrics["examples"] = [
+            {"prompt": e["messages"][-1]["content"], "reference": e["reference"], "prediction": p}
+            for p, e in list(zip(predictions, self.examples))[:3]
+        ]
+        return metrics
+
+
+class GenerationEvalCallback(TrainerCallback):
+    """
+    Run the generation evaluator after every Trainer evaluation
+
+    Metrics are logged through `trainer.log` (so every report_to backend sees
+    them) as `eval_gen_*`, and appended to `<output_dir>/generation_eval.jsonl`
+    with a few sample predictions. Generation runs on rank 0 only and is
+    skipped under FSDP, where no rank holds the full weights.
+    `prepare_inference` / `prepare_training` switch model modes that need
+    more than eval()/train() (Unsloth's fast inference path).
+    """
+
+    def __init__(self, trainer, evaluator: GenerationEvaluator, output_dir: str,
+                 prepare_inference: Optional[Callable] = None, prepare_training: Optional[Callable] = None):
+        self.trainer = trainer
+        self.evaluator = evaluator
+        self.jsonl_path = os.path.join(output_dir, "generation_eval.jsonl")
+        self.prepare_inference = prepare_inference
+        self.prepare_training = prepare_training
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+            open(self.jsonl_path, 'w').close()
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if not state.is_world_process_zero or args.fsdp:
+            return
+
+        model = self.trainer.model
+        if self.prepare_inference:
+            self.prepare_inference(model)
+        try:
+            results = self.evaluator.evaluate(model)
+        finally:
+            if self.prepare_training:
+                self.prepare_training(model)
+
+        examples = results.pop("examples")
+        intent = f", intent acc {results['intent_accuracy']:.1%}" if "intent_accuracy" in results else ""
+        logger.info(
+            f"🎯 Generation eval @ step {state.global_step}: length rule {results['length_compliance']:.1%}"
+            f"{intent}, {results['tokens_per_s']:.0f} tokens/s"
+        )
+
+        record = {"step": state.global_step, "eval_loss": (metrics or {}).get("eval_loss"), **results}
+        with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({**record, "examples": examples}, ensure_ascii=False) + "\n")
+
+        self.trainer.log({f"eval_gen_{k}": v for k, v in results.items()})
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Intent classifier distillation
+Trains a compact fastText-style student (hashed word / word-bigram / char
+n-gram embeddings, mean-pooled, linear layer) on LLM-labelled
+(last_robot_answer, last_user_answer, user_intent) rows and exports it as an
+int8 .npz artifact with a NumPy batched predictor, so intent routing runs on
+CPU at thousands of requests per second
+
+Usage:
+    python -m qwen_finetune.training.intent_distill \
+        --data dataProcessing/4_ParserData/parsed_output_data.xlsx --output models/intent_student
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import argparse
+import logging
+import unicodedata
+from functools import lru_cache
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+
+from qwen_finetune.utils.intents import INTENT_LABELS
+
+logger = logging.getLogger(__name__)
+
+STUDENT_FILENAME = "intent_student.npz"
+REPORT_FILENAME = "distill_report.json"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@dataclass
+class DistillConfig:
+    """Configuration for the distilled intent student"""
+
+    data_path: str = "dataProcessing/4_ParserData/parsed_output_data.xlsx"
+    output_dir: str = "models/intent_student"
+
+    # Features (hashed into num_buckets rows)
+    num_buckets: int = 2 ** 18
+    embedding_dim: int = 64
+    char_ngrams: Tuple[int, int] = (2, 4)  # user-answer char n-gram lengths, min / max ((0, 0) disables)
+    word_bigrams: bool = True
+    robot_max_words: int = 24  # Last words of the robot answer used as features (the question)
+
+    # Training
+    epochs: int = 10
+    batch_size: int = 64
+    learning_rate: float = 5e-3
+    val_ratio: float = 0.1
+    seed: int = 3407
+
+    # Benchmark
+    benchmark_batch_size: int = 256
+
+
+def normalize_text(text: Any) -> str:
+    if not isinstance(text, str):
+        return ""
+    return unicodedata.normalize("NFC", text).lower().strip()
+
+
+@lru_cache(maxsize=65536)
+def _side_features(side: str, text: str, num_buckets: int, char_ngrams: Tuple[int, int],
+                   word_bigrams: bool, max_words: int) -> Tuple[int, ...]:
+    words = _WORD_RE.findall(text)
+    if max_words:
+        words = words[-max_words:]
+    if not words:
+        return (zlib.crc32(f"{side}|<empty>".encode("utf-8")) % num_buckets,)
+
+    features = [f"{side}|{word}" for word in words]
+    if word_bigrams:
+        features.extend(f"{side}|{a} {b}" for a, b in zip(words, words[1:]))
+
+    low, high = char_ngrams
+    if high:
+        for word in words:
+            padded = f"<{word}>"
+            for n in range(low, high + 1):
+                features.extend(f"{side}#{padded[i:i + n]}" for i in range(len(padded) - n + 1))
+
+    return tuple(zlib.crc32(feature.encode("utf-8")) % num_buckets for feature in features)
+
+
+def extract_features(robot_answer: str, user_answer: str, num_buckets: int,
+                     char_ngrams: Tuple[int, int] = (2, 4), word_bigrams: bool = True,
+                     robot_max_words: int = 24) -> List[int]:
+    """
+    Hashed feature ids of one exchange
+
+    The robot and user sides get separate namespaces, so "yes" in the
+    question and "yes" in the answer are different features. Char n-grams
+    (robust to typos and partial English) are used on the short user
+    answer only; the robot side keeps the words and bigrams of its last
+    `robot_max_words` words, where the question is. Robot answers come from
+    a limited script, so their features are cached. crc32 keeps ids stable
+    across processes (Python's hash() is salted).
+    """
+    robot = _side_features("r", normalize_text(robot_answer), num_buckets, (0, 0), word_bigrams, robot_max_words)
+    user = _side_features("u", normalize_text(user_answer), num_buckets, tuple(char_ngrams), word_bigrams, 0)
+    return [*robot, *user]
+
+
+def last_exchange(conversation: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """(last robot answer, last user answer) of a conversation"""
+    user, robot = "", ""
+    for index in range(len(conversation) - 1, -1, -1):
+        turn = conversation[index]
+        if turn.get("role") == "user" and not user:
+            user = str(turn.get("content", ""))
+        elif turn.get("role") == "assistant" and user:
+            robot = str(turn.get("content", ""))
+            break
+    return robot, user
+
+
+def load_distill_rows(data_path: str) -> List[Dict[str, str]]:
+    """Teacher-labelled rows: {"robot", "user", "intent"}"""
+    # Imported here: the predictor itself only needs NumPy
+    from qwen_finetune.training.intent_head import load_intent_examples
+
+    rows = []
+    for example in load_intent_examples(data_path):
+        robot, user = last_exchange(example["conversations"])
+        rows.append({"robot": robot, "user": user, "intent": example["intent"]})
+    return rows
+
+
+class IntentStudent:
+    """
+    Int8 NumPy predictor
+
+    The embedding table is stored as int8 with one float scale per row;
+    per request only the rows of its features are dequantized and averaged,
+    then one small matmul gives the logits.
+    """
+
+    def __init__(self, embeddings_int8: np.ndarray, scales: np.ndarray, weight: np.ndarray,
+                 bias: np.ndarray, labels: List[str], char_ngrams: Tuple[int, int], word_bigrams: bool,
+                 robot_max_words: int):
+        self.embeddings = embeddings_int8
+        self.scales = scales.astype(np.float32)
+        self.weight = weight.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.labels = list(labels)
+        self.char_ngrams = tuple(int(n) for n in char_ngrams)
+        self.word_bigrams = bool(word_bigrams)
+        self.robot_max_words = int(robot_max_words)
+        self.num_buckets = embeddings_int8.shape[0]
+
+    @classmethod
+    def load(cls, path: str) -> "IntentStudent":
+        """Load from an artifact file or the directory holding it"""
+        if os.path.isdir(path):
+            path = os.path.join(path, STUDENT_FILENAME)
+        with np.load(path) as data:
+            return cls(
+                data["embeddings"], data["scales"], data["weight"], data["bias"],
+                [str(label) for label in data["labels"]],
+                tuple(data["char_ngrams"]), bool(data["word_bigrams"]), int(data["robot_max_words"]),
+            )
+
+    def save(self, path: str) -> str:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(
+            path,
+            embeddings=self.embeddings,
+            scales=self.scales,
+            weight=self.weight,
+            bias=self.bias,
+            labels=np.array(self.labels),
+            char_ngrams=np.array(self.char_ngrams),
+            word_bigrams=np.array(self.word_bigrams),
+            robot_max_words=np.array(self.robot_max_words),
+        )
+        return path
+
+    @property
+    def size_bytes(self) -> int:
+        return self.embeddings.nbytes + self.scales.nbytes + self.weight.nbytes + self.bias.nbytes
+
+    def features(self, robot_answer: str, user_answer: str) -> List[int]:
+        return extract_features(
+            robot_answer, user_answer, self.num_buckets, self.char_ngrams, self.word_bigrams, self.robot_max_words
+        )
+
+    def predict_proba(self, robot_answers: List[str], user_answers: List[str]) -> np.ndarray:
+        """Class probabilities, shape (batch, num_labels) in `self.labels` order"""
+        feature_ids = [self.features(r, u) for r, u in zip(robot_answers, user_answers)]
+        lengths = np.array([len(ids) for ids in feature_ids])
+        flat = np.fromiter((i for ids in feature_ids for i in ids), dtype=np.int64, count=int(lengths.sum()))
+
+        rows = self.embeddings[flat].astype(np.float32) * self.scales[flat, None]
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        pooled = np.add.reduceat(rows, offsets, axis=0) / lengths[:, None]
+
+        logits = pooled @ self.weight.T + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, robot_answers: List[str], user_answers: List[str]) -> List[Dict[str, Any]]:
+        """Batched prediction: [{"intent", "confidence"}] per exchange"""
+        if not robot_answers:
+            return []
+        probabilities = self.predict_proba(robot_answers, user_answers)
+        best = probabilities.argmax(axis=1)
+        return [
+            {"intent": self.labels[index], "confidence": float(probabilities[row, index])}
+            for row, index in enumerate(best)
+        ]
+
+
+def quantize_rows(table: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization"""
+    scales = np.abs(table).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.round(table / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def train_student(rows: List[Dict[str, str]], config: DistillConfig) -> Tuple[IntentStudent, Dict[str, Any]]:
+    """Train on the teacher labels and return the int8 student plus held-out accuracy"""
+    import torch
+    from torch import nn
+
+    labels = [label for label in INTENT_LABELS if any(row["intent"] == label for row in rows)]
+    label_to_id = {label: i for i, label in enumerate(labels)}
+
+    features = [
+        extract_features(row["robot"], row["user"], config.num_buckets, config.char_ngrams,
+                         config.word_bigrams, config.robot_max_words)
+        for row in rows
+    ]
+    targets = torch.tensor([label_to_id[row["intent"]] for row in rows], dtype=torch.long)
+
+    generator = torch.Generator().manual_seed(config.seed)
+    torch.manual_seed(config.seed)
+    order = torch.randperm(len(rows), generator=generator)
+    num_val = int(len(rows) * config.val_ratio)
+    val_idx, train_idx = order[:num_val].tolist(), order[num_val:].tolist()
+
+    embedding = nn.EmbeddingBag(config.num_buckets, config.embedding_dim, mode="mean", sparse=True)
+    nn.init.uniform_(embedding.weight, -1.0 / config.embedding_dim, 1.0 / config.embedding_dim)
+    classifier = nn.Linear(config.embedding_dim, len(labels))
+    optimizers = [
+        torch.optim.SparseAdam(embedding.parameters(), lr=config.learning_rate),
+        torch.optim.Adam(classifier.parameters(), lr=config.learning_rate),
+    ]
+
+    # Balance classes (positive dominates the labelled data)
+    counts = torch.bincount(targets[train_idx], minlength=len(labels)).float()
+    loss_fn = nn.CrossEntropyLoss(weight=counts.sum() / (len(labels) * counts.clamp(min=1)))
+
+    def bag(indices: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        ids = [features[i] for i in indices]
+        offsets = torch.tensor([0] + [len(x) for x in ids[:-1]]).cumsum(dim=0)
+        return torch.tensor([i for x in ids for i in x], dtype=torch.long), offsets
+
+    start = time.time()
+    for epoch in range(config.epochs):
+        perm = [train_idx[i] for i in torch.randperm(len(train_idx), generator=generator).tolist()]
+        total_loss = 0.0
+        for begin in range(0, len(perm), config.batch_size):
+            batch = perm[begin:begin + config.batch_size]
+            logits = classifier(embedding(*bag(batch)))
+            loss = loss_fn(logits, targets[batch])
+
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            loss.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            total_loss += loss.item() * len(batch)
+
+        logger.info(f"Student epoch {epoch + 1}/{config.epochs} - loss: {total_loss / max(len(perm), 1):.4f}")
+
+    embeddings_int8, scales = quantize_rows(embedding.weight.detach().numpy())
+    student = IntentStudent(
+        embeddings_int8, scales,
+        classifier.weight.detach().numpy(), classifier.bias.detach().numpy(),
+        labels, config.char_ngrams, config.word_bigrams, config.robot_max_words,
+    )
+
+    metrics: Dict[str, Any] = {
+        "num_rows": len(rows),
+        "train_rows": len(train_idx),
+        "val_rows": num_val,
+        "labels": labels,
+        "train_time_s": round(time.time() - start, 1),
+    }
+    if num_val:
+        with torch.no_grad():
+            fp32_predictions = classifier(embedding(*bag(val_idx))).argmax(dim=-1).tolist()
+        metrics.update(teacher_agreement(
+            student,
+            [rows[i] for i in val_idx],
+            fp32_predictions=[labels[p] for p in fp32_predictions],
+        ))
+    return student, metrics
+
+
+def teacher_agreement(student: IntentStudent, rows: List[Dict[str, str]],
+                      fp32_predictions: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Accuracy against the teacher labels, overall and per label (int8 vs. fp32 student)"""
+    predictions = [p["intent"] for p in student.predict([r["robot"] for r in rows], [r["user"] for r in rows])]
+    teacher = [row["intent"] for row in rows]
+
+    metrics: Dict[str, Any] = {
+        "teacher_accuracy": round(float(np.mean([p == t for p, t in zip(predictions, teacher)])), 4),
+        "per_label_accuracy": {
+            label: round(float(np.mean([p == label for p, t in zip(predictions, teacher) if t == label])), 4)
+            for label in student.labels if label in teacher
+        },
+    }
+    if fp32_predictions is not None:
+        metrics["fp32_teacher_accuracy"] = round(float(np.mean([p == t for p, t in zip(fp32_predictions, teacher)])), 4)
+        metrics["int8_fp32_agreement"] = round(float(np.mean([p == q for p, q in zip(predictions, fp32_predictions)])), 4)
+    return metrics
+
+
+def benchmark_student(student: IntentStudent, rows: List[Dict[str, str]], batch_size: int = 256,
+                      repeats: int = 3) -> Dict[str, float]:
+    """
+    µs per inference, one request at a time and in batches (one process, best of `repeats`)
+
+    The robot-answer feature cache is cleared before every run, so hits only
+    come from robot answers repeated within `rows`, as in live traffic.
+    """
+    robots = [r["robot"] for r in rows]
+    users = [r["user"] for r in rows]
+
+    def best_time(run) -> float:
+        times = []
+        for _ in range(repeats):
+            _side_features.cache_clear()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    single = best_time(lambda: [student.predict([r], [u]) for r, u in zip(robots, users)])
+    batched = best_time(lambda: [
+        student.predict(robots[i:i + batch_size], users[i:i + batch_size])
+        for i in range(0, len(rows), batch_size)
+    ])
+    return {
+        "us_per_inference_single": round(single / len(rows) * 1e6, 1),
+        "us_per_inference_batched": round(batched / len(rows) * 1e6, 1),
+        "requests_per_s_batched": round(len(rows) / batched, 1),
+        "benchmark_batch_size": batch_size,
+    }
+
+
+def distill(config: DistillConfig) -> Dict[str, Any]:
+    """Load teacher labels, train, export and report"""
+    rows = load_distill_rows(config.data_path)
+    if not rows:
+        raise ValueError(f"No labelled rows in {config.data_path}")
+
+    student, metrics = train_student(rows, config)
+    artifact = student.save(os.path.join(config.output_dir, STUDENT_FILENAME))
+
+    # Reload the exported file so the benchmark measures what gets deployed
+    student = IntentStudent.load(artifact)
+    report = {
+        "config": asdict(config),
+        "artifact": artifact,
+        "artifact_mb": round(os.path.getsize(artifact) / 1024 ** 2, 2),
+        **metrics,
+        **benchmark_student(student, rows[:2000], config.benchmark_batch_size),
+    }
+    with open(os.path.join(config.output_dir, REPORT_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def main():
+    """Intent distillation CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    defaults = DistillConfig()
+    parser = argparse.ArgumentParser(description="Distill LLM intent labels into a compact int8 CPU classifier")
+    parser.add_argument("--data", default=defaults.data_path, help=".xlsx/.csv/.json with user_intent labels")
+    parser.add_argument("--output", default=defaults.output_dir)
+    parser.add_argument("--num-buckets", type=int, default=defaults.num_buckets)
+    parser.add_argument("--embedding-dim", type=int, default=defaults.embedding_dim)
+    parser.add_argument("--epochs", type=int, default=defaults.epochs)
+    parser.add_argument("--learning-rate", type=float, default=defaults.learning_rate)
+    parser.add_argument("--val-ratio", type=float, default=defaults.val_ratio)
+    args = parser.parse_args()
+
+    config = DistillConfig(
+        data_path=args.data,
+        output_dir=args.output,
+        num_buckets=args.num_buckets,
+        embedding_dim=args.embedding_dim,
+        epochs=args.epochs,
+        learning_rate=args.learning_rate,
+        val_ratio=args.val_ratio,
+    )
+    report = distill(config)
+
+    print(f"\n📦 Intent student: {report['artifact']} ({report['artifact_mb']} MB)")
+    if "teacher_accuracy" in report:
+        print(f"   Accuracy vs. teacher: {report['teacher_accuracy']:.1%} "
+              f"(fp32 {report['fp32_teacher_accuracy']:.1%}, int8/fp32 agreement {report['int8_fp32_agreement']:.1%})")
+        for label, accuracy in report["per_label_accuracy"].items():
+            print(f"     {label:>9}: {accuracy:.1%}")
+    print(f"   Latency: {report['us_per_inference_single']} µs/request single, "
+          f"{report['us_per_inference_batched']} µs/request batched "
+          f"({report['requests_per_s_batched']:,.0f} req/s in one process)")
+
+
+if __name__ == "__main__":
+    main()
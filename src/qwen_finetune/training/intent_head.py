@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Intent classification head for fine-tuned Qwen models
+Trains a small head on the LoRA model's final hidden state so that intent
+can be served from a single prefill pass
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Dict, List, Tuple, Any
+
+import torch
+from torch import nn
+
+from ..utils.intents import INTENT_LABELS, normalize_intent
+from ..utils.formatting import render_chatml
+
+logger = logging.getLogger(__name__)
+
+INTENT_HEAD_FILENAME = "intent_head.pt"
+
+
+class IntentClassificationHead(nn.Module):
+    """Linear classifier over the last-token hidden state"""
+
+    def __init__(self, hidden_size: int, num_labels: int, dropout: float = 0.1):
+        super().__init__()
+        self.dropout = nn.Dropout(dropout)
+        self.classifier = nn.Linear(hidden_size, num_labels)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.classifier(self.dropout(hidden_states))
+
+
+def load_intent_examples(data_path: str, system_prompt: str = "") -> List[Dict[str, Any]]:
+    """
+    Load (conversation, intent) examples from our parsed datasets
+
+    Supported inputs:
+      - .xlsx/.csv with `BOT_RESPONSE_CONVERSATION_with_USER` (JSON conversation)
+        or `last_robot_answer`/`last_user_answer`, plus `user_intent`
+      - .json/.jsonl/.parquet/.arrow records of {"conversations": [...], "user_intent" | "intent": ...}
+
+    Args:
+        data_path: Path to the labelled data file
+        system_prompt: Optional system prompt prepended to every conversation
+                       (must match what clients send to /v1/intent)
+
+    Returns:
+        List of {"conversations": [...], "intent": label}
+    """
+    logger.info(f"Loading intent examples from: {data_path}")
+
+    if data_path.endswith((".json", ".jsonl", ".parquet", ".arrow")):
+        from qwen_finetune.utils.dataset_io import load_records
+        rows = load_records(data_path)
+    elif data_path.endswith((".xlsx", ".xls", ".csv")):
+        import pandas as pd
+        if data_path.endswith(".csv"):
+            df = pd.read_csv(data_path)
+        else:
+            df = pd.read_excel(data_path)
+        rows = df.to_dict(orient="records")
+    else:
+        raise ValueError(f"Unsupported intent data format: {data_path}")
+
+    examples = []
+    skipped = 0
+
+    for row in rows:
+        intent = normalize_intent(row.get("user_intent", row.get("intent")))
+        if intent is None:
+            skipped += 1
+            continue
+
+        conversation = None
+        if isinstance(row.get("conversations"), list):
+            conversation = row["conversations"]
+        elif isinstance(row.get("BOT_RESPONSE_CONVERSATION_with_USER"), str):
+            try:
+                conversation = json.loads(row["BOT_RESPONSE_CONVERSATION_with_USER"])
+            except json.JSONDecodeError:
+                conversation = None
+
+        if not conversation:
+            robot = row.get("last_robot_answer")
+            user = row.get("last_user_answer")
+            if isinstance(robot, str) and isinstance(user, str):
+                conversation = [
+                    {"role": "assistant", "content": robot},
+                    {"role": "user", "content": user},
+                ]
+
+        if not conversation:
+            skipped += 1
+            continue
+
+        conversation = [
+            turn for turn in conversation
+            if isinstance(turn, dict) and turn.get("role") != "system"
+        ]
+        if system_prompt:
+            conversation = [{"role": "system", "content": system_prompt}] + conversation
+
+        examples.append({"conversations": conversation, "intent": intent})
+
+    logger.info(f"Loaded {len(examples)} intent examples ({skipped} skipped)")
+    return examples
+
+
+def _backbone(model):
+    """Return the decoder stack (no LM head) of a plain or PEFT causal LM"""
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return getattr(model, "model", model)
+
+
+@torch.no_grad()
+def extract_last_hidden_states(
+    model,
+    tokenizer,
+    texts: List[str],
+    batch_size: int = 16,
+    max_length: int = 2048
+) -> torch.Tensor:
+    """
+    Run prefill only and collect the final hidden state of the last prompt token
+
+    The LM head is skipped entirely, which is what the served pooling engine
+    does as well, so training and serving see the same features.
+    """
+    backbone = _backbone(model)
+    was_training = model.training
+    model.eval()
+
+    device = next(backbone.parameters()).device
+    features = []
+
+    try:
+        for start in range(0, len(texts), batch_size):
+            batch = tokenizer(
+                texts[start:start + batch_size],
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=max_length,
+                add_special_tokens=False,
+            ).to(device)
+
+            outputs = backbone(
+                input_ids=batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                use_cache=False,
+            )
+            hidden = outputs.last_hidden_state
+
+            # Index of the last real token (works for left or right padding)
+            positions = torch.arange(hidden.shape[1], device=device)
+            last_idx = (batch["attention_mask"] * positions).argmax(dim=1)
+            last_hidden = hidden[torch.arange(hidden.shape[0], device=device), last_idx]
+
+            features.append(last_hidden.float().cpu())
+    finally:
+        if was_training:
+            model.train()
+
+    return torch.cat(features, dim=0)
+
+
+def fit_intent_head(
+    model,
+    tokenizer,
+    examples: List[Dict[str, Any]],
+    epochs: int = 5,
+    learning_rate: float = 1e-3,
+    batch_size: int = 16,
+    max_length: int = 2048,
+    val_ratio: float = 0.1,
+    seed: int = 3407
+) -> Tuple[IntentClassificationHead, List[str], Dict[str, Any]]:
+    """
+    Train an intent head on frozen features from the fine-tuned model
+
+    Features are extracted once (one prefill per example) and the head is
+    then trained on the cached features, so extra epochs are nearly free.
+
+    Returns:
+        (head, label names, metrics)
+    """
+    if not examples:
+        raise ValueError("No intent examples to train on")
+
+    labels = [label for label in INTENT_LABELS if any(ex["intent"] == label for ex in examples)]
+    label_to_id = {label: i for i, label in enumerate(labels)}
+
+    # Same prompt the server builds for /v1/intent (render_chatml, ends with the assistant header);
+    # the training chat template separates turns differently, so it must not be used here
+    texts = [render_chatml(ex["conversations"], add_generation_prompt=True) for ex in examples]
+    targets = torch.tensor([label_to_id[ex["intent"]] for ex in examples], dtype=torch.long)
+
+    logger.info(f"Extracting hidden states for {len(texts)} examples...")
+    start_time = time.time()
+    features = extract_last_hidden_states(model, tokenizer, texts, batch_size, max_length)
+    logger.info(f"Feature extraction took {time.time() - start_time:.2f} seconds")
+
+    generator = torch.Generator().manual_seed(seed)
+    order = torch.randperm(len(features), generator=generator)
+    num_val = int(len(features) * val_ratio)
+    val_idx, train_idx = order[:num_val], order[num_val:]
+
+    head = IntentClassificationHead(features.shape[1], len(labels))
+    optimizer = torch.optim.AdamW(head.parameters(), lr=learning_rate, weight_decay=0.01)
+    loss_fn = nn.CrossEntropyLoss()
+
+    for epoch in range(epochs):
+        head.train()
+        perm = train_idx[torch.randperm(len(train_idx), generator=generator)]
+        total_loss = 0.0
+
+        for start in range(0, len(perm), batch_size):
+            idx = perm[start:start + batch_size]
+            logits = head(features[idx])
+            loss = loss_fn(logits, targets[idx])
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(idx)
+
+        logger.info(f"Intent head epoch {epoch + 1}/{epochs} - loss: {total_loss / max(len(perm), 1):.4f}")
+
+    metrics = {"num_examples": len(examples), "labels": labels}
+
+    head.eval()
+    if num_val > 0:
+        with torch.no_grad():
+            predictions = head(features[val_idx]).argmax(dim=-1)
+        metrics["val_accuracy"] = (predictions == targets[val_idx]).float().mean().item()
+        logger.info(f"Intent head validation accuracy: {metrics['val_accuracy']:.4f}")
+
+    return head, labels, metrics
+
+
+def save_intent_head(head: IntentClassificationHead, labels: List[str], save_dir: str) -> str:
+    """Save head weights and label names to `save_dir/intent_head.pt`"""
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, INTENT_HEAD_FILENAME)
+
+    torch.save({
+        "weight": head.classifier.weight.detach().cpu(),
+        "bias": head.classifier.bias.detach().cpu(),
+        "labels": list(labels),
+        "hidden_size": head.classifier.in_features,
+    }, save_path)
+
+    logger.info(f"Intent head saved to: {save_path}")
+    return save_path
+
+
+def load_intent_head(path: str, device: str = "cpu") -> Tuple[IntentClassificationHead, List[str]]:
+    """Load an intent head saved by save_intent_head (file or directory)"""
+    if os.path.isdir(path):
+        path = os.path.join(path, INTENT_HEAD_FILENAME)
+
+    checkpoint = torch.load(path, map_location=device, weights_only=True)
+    labels = checkpoint["labels"]
+
+    head = IntentClassificationHead(checkpoint["hidden_size"], len(labels), dropout=0.0)
+    head.classifier.weight.data.copy_(checkpoint["weight"])
+    head.classifier.bias.data.copy_(checkpoint["bias"])
+    head.to(device).eval()
+
+    return head, labels
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Low-memory LoRA merge and export
+Merges saved LoRA adapters into the base model's safetensors shard by shard
+(memory-mapped reads, CPU only, peak memory about one shard) and writes a
+vLLM-ready directory with an integrity manifest (`merge_manifest.json`)
+
+Usage:
+    python -m qwen_finetune.training.merge_lora --adapter-path models/lora_adapters \
+        --output-path models/merged
+    python -m qwen_finetune.training.merge_lora --verify models/merged
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple, Any
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_PREFIX = "base_model.model."
+MANIFEST_NAME = "merge_manifest.json"
+INDEX_NAME = "model.safetensors.index.json"
+
+# Files from the adapter directory that must not end up in the merged model
+ADAPTER_FILES = {"adapter_config.json", "adapter_model.safetensors", "adapter_model.bin", "README.md"}
+# Non-weight files copied from the base model (config, generation config, tokenizer)
+BASE_FILE_SUFFIXES = (".json", ".txt", ".jinja", ".model", ".tiktoken")
+
+
+def resolve_model_dir(name_or_path: str, revision: Optional[str] = None) -> str:
+    """Local directory of a model, downloading only safetensors + config/tokenizer files from the Hub"""
+    if os.path.isdir(name_or_path):
+        return name_or_path
+
+    from huggingface_hub import snapshot_download
+    logger.info(f"Downloading base model: {name_or_path}")
+    return snapshot_download(
+        name_or_path,
+        revision=revision,
+        allow_patterns=["*.safetensors", *(f"*{suffix}" for suffix in BASE_FILE_SUFFIXES)],
+    )
+
+
+def file_sha256(path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _pattern_value(patterns: Dict[str, Any], module_name: str, default: Any) -> Any:
+    """PEFT rank_pattern / alpha_pattern lookup (key matches the end of the module name)"""
+    for pattern, value in (patterns or {}).items():
+        if re.match(rf"(.*\.)?{pattern}$", module_name):
+            return value
+    return default
+
+
+def lora_scaling(adapter_config: Dict[str, Any], module_name: str) -> float:
+    """alpha / r (alpha / sqrt(r) with rsLoRA) for one adapted module"""
+    r = _pattern_value(adapter_config.get("rank_pattern"), module_name, adapter_config["r"])
+    alpha = _pattern_value(adapter_config.get("alpha_pattern"), module_name, adapter_config["lora_alpha"])
+    return alpha / (r ** 0.5 if adapter_config.get("use_rslora") else r)
+
+
+def load_adapter(adapter_path: str) -> Tuple[Dict[str, Any], Dict[str, Tuple], Dict[str, torch.Tensor]]:
+    """
+    Adapter config, LoRA factors and full-tensor replacements keyed by base weight name
+
+    LoRA factors map `<module>.weight` to (A, B, scaling); other adapter
+    tensors (modules_to_save, trained biases) replace the base tensor of
+    the same name.
+    """
+    with open(os.path.join(adapter_path, "adapter_config.json"), 'r', encoding='utf-8') as f:
+        adapter_config = json.load(f)
+
+    if adapter_config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Only LoRA adapters can be merged, got {adapter_config.get('peft_type')}")
+    if adapter_config.get("use_dora"):
+        raise ValueError("DoRA adapters are not supported by the streaming merge")
+
+    tensors = load_file(os.path.join(adapter_path, "adapter_model.safetensors"), device="cpu")
+
+    factors: Dict[str, Dict[str, torch.Tensor]] = {}
+    replacements: Dict[str, torch.Tensor] = {}
+    for key, tensor in tensors.items():
+        name = key[len(ADAPTER_PREFIX):] if key.startswith(ADAPTER_PREFIX) else key
+        match = re.match(r"(.+)\.lora_([AB])\.weight$", name)
+        if match:
+            factors.setdefault(match.group(1), {})[match.group(2)] = tensor
+        elif ".lora_" in name:
+            raise ValueError(f"Unsupported LoRA tensor (embedding LoRA / LoRA bias): {key}")
+        else:
+            replacements[name.replace(".modules_to_save", "")] = tensor
+
+    lora = {}
+    for module_name, pair in factors.items():
+        if set(pair) != {"A", "B"}:
+            raise ValueError(f"Incomplete LoRA factors for {module_name}")
+        lora[f"{module_name}.weight"] = (pair["A"], pair["B"], lora_scaling(adapter_config, module_name))
+
+    return adapter_config, lora, replacements
+
+
+def merge_tensor(weight: torch.Tensor, lora_a: torch.Tensor, lora_b: torch.Tensor, scaling: float,
+                 fan_in_fan_out: bool = False) -> torch.Tensor:
+    """W + scaling * B @ A, computed in float32 and cast back to the weight dtype"""
+    delta = (lora_b.float() @ lora_a.float()) * scaling
+    if fan_in_fan_out:
+        delta = delta.T
+    return (weight.float() + delta).to(weight.dtype)
+
+
+def _weight_shards(base_dir: str) -> List[str]:
+    index_path = os.path.join(base_dir, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return sorted(set(json.load(f)["weight_map"].values()))
+    if os.path.exists(os.path.join(base_dir, "model.safetensors")):
+        return ["model.safetensors"]
+    raise FileNotFoundError(f"No safetensors weights in {base_dir}")
+
+
+def _copy_support_files(base_dir: str, adapter_path: str, output_path: str) -> None:
+    """Config and tokenizer files; the adapter directory's tokenizer (with our chat template) wins"""
+    for source_dir in (base_dir, adapter_path):
+        for name in os.listdir(source_dir):
+            source = os.path.join(source_dir, name)
+            if (os.path.isfile(source) and name.endswith(BASE_FILE_SUFFIXES)
+                    and name not in ADAPTER_FILES and name not in (INDEX_NAME, MANIFEST_NAME)):
+                shutil.copyfile(source, os.path.join(output_path, name))
+
+
+def merge_lora_checkpoint(base_model: str, adapter_path: str, output_path: str,
+                          revision: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Merge LoRA adapters into base safetensors without loading the model
+
+    Each base shard is read through a memory map, adapted tensors get
+    W + scaling * B @ A, and the shard is written out before the next one
+    is opened. Shard names and the weight index are kept, so the output
+    loads in transformers and vLLM like the base checkpoint.
+    """
+    start = time.time()
+    base_dir = resolve_model_dir(base_model, revision)
+
+    with open(os.path.join(base_dir, "config.json"), 'r', encoding='utf-8') as f:
+        if "quantization_config" in json.load(f):
+            raise ValueError(f"{base_model} is a quantized checkpoint, merge into the full-precision base model")
+
+    adapter_config, lora, replacements = load_adapter(adapter_path)
+    fan_in_fan_out = adapter_config.get("fan_in_fan_out", False)
+    logger.info(f"🔀 Merging {len(lora)} LoRA modules (r={adapter_config['r']}, alpha={adapter_config['lora_alpha']}) "
+                f"into {base_model}")
+
+    os.makedirs(output_path, exist_ok=True)
+    pending = set(lora) | set(replacements)
+    files: Dict[str, Dict[str, Any]] = {}
+    dtypes = set()
+
+    shards = _weight_shards(base_dir)
+    for number, shard in enumerate(shards, 1):
+        tensors: Dict[str, torch.Tensor] = {}
+        with safe_open(os.path.join(base_dir, shard), framework="pt", device="cpu") as f:
+            metadata = f.metadata() or {}
+            for key in f.keys():
+                tensor = f.get_tensor(key)
+                if key in lora:
+                    lora_a, lora_b, scaling = lora[key]
+                    tensor = merge_tensor(tensor, lora_a, lora_b, scaling, fan_in_fan_out)
+                elif key in replacements:
+                    tensor = replacements[key].to(tensor.dtype)
+                pending.discard(key)
+                dtypes.add(str(tensor.dtype).replace("torch.", ""))
+                tensors[key] = tensor.contiguous()
+
+        shard_path = os.path.join(output_path, shard)
+        save_file(tensors, shard_path, metadata={**metadata, "format": "pt"})
+        del tensors
+        files[shard] = {"bytes": os.path.getsize(shard_path), "sha256": file_sha256(shard_path)}
+        logger.info(f"   [{number}/{len(shards)}] {shard} ({files[shard]['bytes'] / 1e9:.2f} GB)")
+
+    if pending:
+        raise ValueError(f"Adapter tensors without a matching base weight: {sorted(pending)[:5]}")
+
+    if os.path.exists(os.path.join(base_dir, INDEX_NAME)):
+        shutil.copyfile(os.path.join(base_dir, INDEX_NAME), os.path.join(output_path, INDEX_NAME))
+    _copy_support_files(base_dir, adapter_path, output_path)
+
+    for name in sorted(os.listdir(output_path)):
+        path = os.path.join(output_path, name)
+        if name not in files and name != MANIFEST_NAME and os.path.isfile(path):
+            files[name] = {"bytes": os.path.getsize(path), "sha256": file_sha256(path)}
+
+    manifest = {
+        "base_model": base_model,
+        "revision": revision,
+        "adapter_path": adapter_path,
+        "adapter_sha256": file_sha256(os.path.join(adapter_path, "adapter_model.safetensors")),
+        "lora": {
+            key: adapter_config.get(key)
+            for key in ("r", "lora_alpha", "use_rslora", "target_modules", "rank_pattern", "alpha_pattern")
+        },
+        "merged_modules": len(lora),
+        "replaced_tensors": len(replacements),
+        "dtype": sorted(dtypes),
+        "files": dict(sorted(files.items())),
+        "merge_time_s": round(time.time() - start, 1),
+    }
+    with open(os.path.join(output_path, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(f"✅ Merged model saved to: {output_path} ({manifest['merge_time_s']}s)")
+    return manifest
+
+
+def verify_manifest(output_path: str) -> List[str]:
+    """Files whose size or sha256 differs from the manifest (empty list = intact)"""
+    with open(os.path.join(output_path, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    problems = []
+    for name, expected in manifest["files"].items():
+        path = os.path.join(output_path, name)
+        if not os.path.exists(path):
+            problems.append(f"{name}: missing")
+        elif os.path.getsize(path) != expected["bytes"] or file_sha256(path) != expected["sha256"]:
+            problems.append(f"{name}: checksum mismatch")
+    return problems
+
+
+def main():
+    """Streaming LoRA merge CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Merge LoRA adapters into base safetensors shard by shard (CPU only)")
+    parser.add_argument("--adapter-path", default="models/lora_adapters")
+    parser.add_argument("--base-model", default=None, help="Default: base_model_name_or_path from adapter_config.json")
+    parser.add_argument("--revision", default=None)
+    parser.add_argument("--output-path", default="models/merged")
+    parser.add_argument("--verify", metavar="MODEL_DIR", default=None, help="Only check a merged directory against its manifest")
+    args = parser.parse_args()
+
+    if args.verify:
+        problems = verify_manifest(args.verify)
+        for problem in problems:
+            logger.error(f"❌ {problem}")
+        if problems:
+            raise SystemExit(1)
+        logger.info(f"✅ {args.verify} matches {MANIFEST_NAME}")
+        return
+
+    base_model = args.base_model
+    if base_model is None:
+        with open(os.path.join(args.adapter_path, "adapter_config.json"), 'r', encoding='utf-8') as f:
+            base_model = json.load(f)["base_model_name_or_path"]
+
+    merge_lora_checkpoint(base_model, args.adapter_path, args.output_path, revision=args.revision)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Quantized export pipeline for fine-tuned Qwen models
+Quantizes a merged checkpoint (AWQ / GPTQ / FP8), calibrating on our own
+conversation data, and writes a serving-ready directory plus a comparison
+report (size, load time, tokens/s, intent agreement) against the fp16 model
+
+Usage:
+    python -m qwen_finetune.training.quantize_model --method awq \
+        --model-path models/merged --output-path models/quantized-awq
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import gc
+import json
+import time
+import random
+import shutil
+import argparse
+import logging
+import multiprocessing
+from queue import Empty
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Any
+
+from qwen_finetune.utils.intents import extract_intent
+
+logger = logging.getLogger(__name__)
+
+# Value to put in ServingConfig.quantization for each export method.
+# llm-compressor checkpoints (gptq, fp8) are auto-detected by vLLM from config.json
+SERVING_QUANTIZATION = {
+    "awq": "awq",
+    "gptq": None,
+    "fp8": None,
+}
+
+
+@dataclass
+class QuantizeConfig:
+    """Configuration for quantized export"""
+
+    # Input / output
+    model_path: str = "models/merged"
+    output_path: str = "models/quantized"
+    method: str = "awq"  # "awq", "gptq", "fp8"
+
+    # Calibration data
+    calibration_data_path: str = "data/pika_data.json"
+    chat_template_path: str = "data/chat_template.txt"
+    num_calibration_samples: int = 128
+    max_calibration_length: int = 512
+    seed: int = 3407
+
+    # AWQ / GPTQ parameters
+    bits: int = 4
+    group_size: int = 128
+
+    # Comparison report (runs both models through vLLM)
+    run_benchmark: bool = True
+    benchmark_samples: int = 64
+    benchmark_max_tokens: int = 32
+    max_model_len: int = 2048
+    gpu_memory_utilization: float = 0.4
+    benchmark_timeout_s: float = 1800.0  # Per model, covers vLLM load + generation
+
+
+def _directory_size(path: str) -> int:
+    """Total size in bytes of all files under `path`"""
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def _benchmark_worker(model_path: str, quantization: Optional[str], prompts: List[str],
+                      max_tokens: int, max_model_len: int, gpu_memory_utilization: float,
+                      queue) -> None:
+    """Load one model in vLLM and time greedy generation (runs in a fresh process)"""
+    try:
+        from vllm import LLM, SamplingParams
+
+        start = time.time()
+        llm = LLM(
+            model=model_path,
+            quantization=quantization,
+            max_model_len=max_model_len,
+            gpu_memory_utilization=gpu_memory_utilization,
+            trust_remote_code=True,
+        )
+        load_time = time.time() - start
+
+        sampling_params = SamplingParams(temperature=0.0, max_tokens=max_tokens)
+        start = time.time()
+        outputs = llm.generate(prompts, sampling_params)
+        generation_time = time.time() - start
+
+        generated_tokens = sum(len(output.outputs[0].token_ids) for output in outputs)
+        queue.put({
+            "load_time_s": load_time,
+            "generation_time_s": generation_time,
+            "generated_tokens": generated_tokens,
+            "tokens_per_second": generated_tokens / generation_time if generation_time > 0 else 0.0,
+            "outputs": [output.outputs[0].text.strip() for output in outputs],
+        })
+    except Exception as e:
+        queue.put({"error": str(e)})
+
+
+class ModelQuantizer:
+    """Quantize a merged checkpoint and compare it against the original"""
+
+    def __init__(self, config: QuantizeConfig):
+        if config.method not in SERVING_QUANTIZATION:
+            raise ValueError(f"Unknown quantization method: {config.method}")
+
+        self.config = config
+        self.tokenizer = None
+        self.calibration_texts: List[str] = []
+        self.benchmark_prompts: List[str] = []
+
+    def load_tokenizer(self):
+        """Load the merged model's tokenizer with our ChatML template"""
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.config.model_path, trust_remote_code=True)
+        if os.path.exists(self.config.chat_template_path):
+            with open(self.config.chat_template_path, 'r', encoding='utf-8') as f:
+                self.tokenizer.chat_template = f.read().strip()
+        return self.tokenizer
+
+    def load_calibration_data(self) -> List[str]:
+        """
+        Sample calibration texts and benchmark prompts from our conversations
+
+        Calibration uses full conversations (what the model sees in training);
+        benchmark prompts are the same conversations cut before the last
+        assistant turn, ending with the generation prompt.
+        """
+        logger.info(f"Loading calibration data from: {self.config.calibration_data_path}")
+
+        with open(self.config.calibration_data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        conversations = [
+            item["conversations"] for item in data
+            if isinstance(item, dict) and isinstance(item.get("conversations"), list) and item["conversations"]
+        ]
+        if not conversations:
+            raise ValueError("No conversations found for calibration")
+
+        random.Random(self.config.seed).shuffle(conversations)
+
+        self.calibration_texts = [
+            self.tokenizer.apply_chat_template(convo, tokenize=False, add_generation_prompt=False)
+            for convo in conversations[:self.config.num_calibration_samples]
+        ]
+
+        # Prefer conversations not used for calibration when there are enough
+        held_out = conversations[self.config.num_calibration_samples:] or conversations
+        self.benchmark_prompts = []
+        for convo in held_out:
+            last_assistant = max(
+                (i for i, turn in enumerate(convo) if turn.get("role") == "assistant"),
+                default=len(convo)
+            )
+            if last_assistant == 0:
+                continue
+            self.benchmark_prompts.append(self.tokenizer.apply_chat_template(
+                convo[:last_assistant], tokenize=False, add_generation_prompt=True
+            ))
+            if len(self.benchmark_prompts) >= self.config.benchmark_samples:
+                break
+
+        logger.info(f"Calibration samples: {len(self.calibration_texts)}, "
+                    f"benchmark prompts: {len(self.benchmark_prompts)}")
+        return self.calibration_texts
+
+    def quantize(self) -> str:
+        """Run the configured quantization method and write a serving-ready directory"""
+        logger.info(f"Quantizing {self.config.model_path} with {self.config.method.upper()}...")
+        os.makedirs(self.config.output_path, exist_ok=True)
+        start = time.time()
+
+        if self.config.method == "awq":
+            self._quantize_awq()
+        elif self.config.method == "gptq":
+            self._quantize_llmcompressor(calibrate=True)
+        else:
+            self._quantize_llmcompressor(calibrate=False)
+
+        self.tokenizer.save_pretrained(self.config.output_path)
+        if os.path.exists(self.config.chat_template_path):
+            shutil.copy(self.config.chat_template_path, os.path.join(self.config.output_path, "chat_template.txt"))
+
+        gc.collect()
+        try:
+            import torch
+            torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+        logger.info(f"✅ Quantized model saved to {self.config.output_path} ({time.time() - start:.1f}s)")
+        return self.config.output_path
+
+    def _quantize_awq(self) -> None:
+        """AWQ via AutoAWQ (served with quantization='awq')"""
+        from awq import AutoAWQForCausalLM
+
+        model = AutoAWQForCausalLM.from_pretrained(self.config.model_path, safetensors=True)
+        model.quantize(
+            self.tokenizer,
+            quant_config={
+                "zero_point": True,
+                "q_group_size": self.config.group_size,
+                "w_bit": self.config.bits,
+                "version": "GEMM",
+            },
+            calib_data=self.calibration_texts,
+            max_calib_samples=len(self.calibration_texts),
+            max_calib_seq_len=self.config.max_calibration_length,
+        )
+        model.save_quantized(self.config.output_path)
+
+    def _quantize_llmcompressor(self, calibrate: bool) -> None:
+        """GPTQ (W4A16) or FP8 dynamic via llm-compressor (compressed-tensors format)"""
+        from transformers import AutoModelForCausalLM
+        from llmcompressor.modifiers.quantization import GPTQModifier, QuantizationModifier
+        try:
+            from llmcompressor import oneshot
+        except ImportError:
+            from llmcompressor.transformers import oneshot
+
+        model = AutoModelForCausalLM.from_pretrained(
+            self.config.model_path, torch_dtype="auto", device_map="auto", trust_remote_code=True
+        )
+
+        if calibrate:
+            from datasets import Dataset
+
+            dataset = Dataset.from_dict({"text": self.calibration_texts}).map(
+                lambda batch: self.tokenizer(
+                    batch["text"],
+                    truncation=True,
+                    max_length=self.config.max_calibration_length,
+                    add_special_tokens=False,
+                ),
+                batched=True,
+                remove_columns=["text"],
+            )
+            recipe = GPTQModifier(
+                targets="Linear",
+                scheme=f"W{self.config.bits}A16",
+                ignore=["lm_head"],
+            )
+            oneshot(
+                model=model,
+                dataset=dataset,
+                recipe=recipe,
+                max_seq_length=self.config.max_calibration_length,
+                num_calibration_samples=len(self.calibration_texts),
+            )
+        else:
+            # FP8 dynamic needs no calibration data
+            recipe = QuantizationModifier(targets="Linear", scheme="FP8_DYNAMIC", ignore=["lm_head"])
+            oneshot(model=model, recipe=recipe)
+
+        model.save_pretrained(self.config.output_path, save_compressed=True)
+
+    def _benchmark(self, model_path: str, quantization: Optional[str]) -> Dict[str, Any]:
+        """Benchmark one model in a spawned process so GPU memory is fully released"""
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        process = context.Process(
+            target=_benchmark_worker,
+            args=(model_path, quantization, self.benchmark_prompts, self.config.benchmark_max_tokens,
+                  self.config.max_model_len, self.config.gpu_memory_utilization, queue),
+        )
+        process.start()
+
+        # Poll so a worker killed without posting (CUDA abort, OOM kill) fails instead of hanging
+        deadline = time.time() + self.config.benchmark_timeout_s
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=5.0)
+            except Empty:
+                if not process.is_alive():
+                    try:
+                        result = queue.get(timeout=1.0)  # Posted right before exiting
+                    except Empty:
+                        process.join()
+                        raise RuntimeError(f"Benchmark process for {model_path} died with exit code "
+                                           f"{process.exitcode} without reporting a result")
+                elif time.time() > deadline:
+                    process.terminate()
+                    process.join()
+                    raise RuntimeError(f"Benchmark for {model_path} timed out after "
+                                       f"{self.config.benchmark_timeout_s:.0f}s")
+        process.join()
+
+        if "error" in result:
+            raise RuntimeError(f"Benchmark failed for {model_path}: {result['error']}")
+        return result
+
+    def compare(self) -> Dict[str, Any]:
+        """Compare size, load time, tokens/s and intent agreement against the fp16 model"""
+        report = {
+            "method": self.config.method,
+            "config": asdict(self.config),
+            "serving": {
+                "model_path": self.config.output_path,
+                "quantization": SERVING_QUANTIZATION[self.config.method],
+            },
+            "reference": {"size_bytes": _directory_size(self.config.model_path)},
+            "quantized": {"size_bytes": _directory_size(self.config.output_path)},
+        }
+        report["size_ratio"] = report["quantized"]["size_bytes"] / max(report["reference"]["size_bytes"], 1)
+
+        if self.config.run_benchmark and self.benchmark_prompts:
+            logger.info("Benchmarking reference model...")
+            reference = self._benchmark(self.config.model_path, None)
+            logger.info("Benchmarking quantized model...")
+            quantized = self._benchmark(self.config.output_path, SERVING_QUANTIZATION[self.config.method])
+
+            ref_outputs, quant_outputs = reference.pop("outputs"), quantized.pop("outputs")
+            report["reference"].update(reference)
+            report["quantized"].update(quantized)
+
+            pairs = [(extract_intent(a), extract_intent(b)) for a, b in zip(ref_outputs, quant_outputs)]
+            labelled = [(a, b) for a, b in pairs if a is not None]
+            report["intent_agreement"] = (
+                sum(a == b for a, b in labelled) / len(labelled) if labelled else None
+            )
+            report["intent_coverage"] = len(labelled) / len(pairs)
+            report["exact_match_rate"] = sum(a == b for a, b in zip(ref_outputs, quant_outputs)) / len(ref_outputs)
+            report["speedup"] = quantized["tokens_per_second"] / max(reference["tokens_per_second"], 1e-9)
+            report["examples"] = [
+                {"reference": a, "quantized": b} for a, b in list(zip(ref_outputs, quant_outputs))[:5]
+            ]
+
+        report_path = os.path.join(self.config.output_path, "quantization_report.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        self._log_report(report)
+        logger.info(f"Report saved to: {report_path}")
+        return report
+
+    @staticmethod
+    def _log_report(report: Dict[str, Any]) -> None:
+        """Log a short comparison summary"""
+        ref, quant = report["reference"], report["quantized"]
+        logger.info("=" * 50)
+        logger.info(f"QUANTIZATION REPORT ({report['method'].upper()})")
+        logger.info("=" * 50)
+        logger.info(f"Size: {ref['size_bytes'] / 1e9:.2f} GB -> {quant['size_bytes'] / 1e9:.2f} GB "
+                    f"({report['size_ratio']:.2%})")
+        if "tokens_per_second" in quant:
+            logger.info(f"Load time: {ref['load_time_s']:.1f}s -> {quant['load_time_s']:.1f}s")
+            logger.info(f"Tokens/s: {ref['tokens_per_second']:.1f} -> {quant['tokens_per_second']:.1f}")
+            if report["intent_agreement"] is not None:
+                logger.info(f"Intent agreement: {report['intent_agreement']:.2%} "
+                            f"(coverage {report['intent_coverage']:.0%})")
+            logger.info(f"Exact output match: {report['exact_match_rate']:.2%}")
+        logger.info(f"Serve with: model_path={report['serving']['model_path']}, "
+                    f"quantization={report['serving']['quantization']}")
+        logger.info("=" * 50)
+
+    def run(self) -> Dict[str, Any]:
+        """Full pipeline: calibration data -> quantize -> compare"""
+        self.load_tokenizer()
+        self.load_calibration_data()
+        self.quantize()
+        return self.compare()
+
+
+def main():
+    """Quantized export CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    defaults = QuantizeConfig()
+    parser = argparse.ArgumentParser(description="Quantize a merged Qwen checkpoint for vLLM serving")
+    parser.add_argument("--method", choices=sorted(SERVING_QUANTIZATION), default=defaults.method)
+    parser.add_argument("--model-path", default=defaults.model_path)
+    parser.add_argument("--output-path", default=None, help="Defaults to models/quantized-<method>")
+    parser.add_argument("--calibration-data", default=defaults.calibration_data_path)
+    parser.add_argument("--chat-template", default=defaults.chat_template_path)
+    parser.add_argument("--num-calibration-samples", type=int, default=defaults.num_calibration_samples)
+    parser.add_argument("--max-calibration-length", type=int, default=defaults.max_calibration_length)
+    parser.add_argument("--bits", type=int, default=defaults.bits)
+    parser.add_argument("--group-size", type=int, default=defaults.group_size)
+    parser.add_argument("--benchmark-samples", type=int, default=defaults.benchmark_samples)
+    parser.add_argument("--benchmark-max-tokens", type=int, default=defaults.benchmark_max_tokens)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=defaults.gpu_memory_utilization)
+    parser.add_argument("--benchmark-timeout", type=float, default=defaults.benchmark_timeout_s,
+                        help="Seconds per model before the benchmark is aborted")
+    parser.add_argument("--skip-benchmark", action="store_true", help="Only quantize, no comparison run")
+    args = parser.parse_args()
+
+    config = QuantizeConfig(
+        model_path=args.model_path,
+        output_path=args.output_path or f"models/quantized-{args.method}",
+        method=args.method,
+        calibration_data_path=args.calibration_data,
+        chat_template_path=args.chat_template,
+        num_calibration_samples=args.num_calibration_samples,
+        max_calibration_length=args.max_calibration_length,
+        bits=args.bits,
+        group_size=args.group_size,
+        run_benchmark=not args.skip_benchmark,
+        benchmark_samples=args.benchmark_samples,
+        benchmark_max_tokens=args.benchmark_max_tokens,
+        gpu_memory_utilization=args.gpu_memory_utilization,
+        benchmark_timeout_s=args.benchmark_timeout,
+    )
+
+    ModelQuantizer(config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+In-process LoRA hyperparameter sweep
+Loads the base model and tokenized dataset once, then trains fresh LoRA
+adapters per trial (rank, alpha, learning rate, target modules, ...),
+evaluates each on the held-out val split (`eval_data_path`) and writes a
+results table
+
+Usage:
+    python -m qwen_finetune.training.sweep --config configs/sweep_config.yaml
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import gc
+import csv
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import logging
+from dataclasses import fields, replace
+from typing import Dict, List, Any
+
+import yaml
+import torch
+
+from qwen_finetune.training.finetune_standard_lora import (
+    StandardFineTuneConfig,
+    StandardQwenFineTuner,
+    load_standard_config,
+)
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FIELDS = {f.name for f in fields(StandardFineTuneConfig)}
+
+
+def build_trials(search_space: Dict[str, List[Any]], strategy: str = "grid",
+                 num_trials: int = 10, seed: int = 3407) -> List[Dict[str, Any]]:
+    """Grid (every combination) or random (`num_trials` distinct combinations) trials"""
+    unknown = set(search_space) - CONFIG_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown config fields in search space: {sorted(unknown)}")
+
+    keys = list(search_space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(search_space[k] for k in keys))]
+    if strategy == "grid":
+        return grid
+    if strategy == "random":
+        return random.Random(seed).sample(grid, min(num_trials, len(grid)))
+    raise ValueError(f"Unknown sweep strategy: {strategy}")
+
+
+def format_value(value: Any) -> str:
+    if isinstance(value, list):
+        return ",".join(str(v).replace("_proj", "") for v in value)
+    if isinstance(value, float):
+        return f"{value:.2e}" if value < 1e-2 else f"{value:g}"
+    return str(value)
+
+
+class LoRASweep:
+    """Runs trials on one shared base model (adapters are unloaded between trials)"""
+
+    def __init__(self, base_config: StandardFineTuneConfig, output_dir: str = "outputs/sweep",
+                 template_path: str = "data/chat_template.txt"):
+        if base_config.distributed != "none":
+            raise ValueError("The sweep runs in one process, set distributed: none")
+
+        self.base_config = base_config
+        self.output_dir = output_dir
+        self.template_path = template_path
+        self.results: List[Dict[str, Any]] = []
+
+        self.tuner = StandardQwenFineTuner(base_config)
+        self.base_model = None
+        self.train_dataset = None
+        self.eval_dataset = None
+
+    def setup(self) -> None:
+        """Load the base model, tokenizer and tokenized dataset once"""
+        start = time.time()
+        self.tuner.load_model_and_tokenizer()
+        self.base_model = self.tuner.model.unload()
+        logger.info(f"Base model loaded in {time.time() - start:.1f}s")
+
+        # Score on the conversation-level val split: a random split of the tokenized rows would put
+        # overlapping sliding-window samples of the same conversation on both sides
+        self.eval_dataset = self.tuner.load_eval_dataset(self.template_path)
+        if self.eval_dataset is None:
+            raise ValueError(
+                f"The sweep needs a held-out val split at eval_data_path='{self.base_config.eval_data_path}' "
+                "(run `make split-data`)"
+            )
+        self.train_dataset = self.tuner.load_tokenized_dataset(self.base_config.data_path, self.template_path)
+        train_rows = "streamed" if self.base_config.streaming else len(self.train_dataset)
+        logger.info(f"Sweep data: {train_rows} train / {len(self.eval_dataset)} val rows")
+
+    def run_trial(self, index: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        name = f"trial_{index:02d}"
+        trial_dir = os.path.join(self.output_dir, name)
+        config = replace(
+            self.base_config,
+            **params,
+            output_dir=trial_dir,
+            save_model=False,
+            train_intent_head=False,
+            wandb_run_name=f"{self.base_config.wandb_run_name or 'sweep'}-{name}",
+        )
+        logger.info(f"🧪 {name}: " + ", ".join(f"{k}={format_value(v)}" for k, v in params.items()))
+
+        # Same seed per trial so adapters start from comparable initializations
+        torch.manual_seed(config.seed)
+        self.tuner.config = config
+        self.tuner.model = self.base_model
+        self.tuner.apply_lora()
+
+        result: Dict[str, Any] = {"trial": name, **params}
+        try:
+            self.tuner.create_trainer(self.train_dataset)
+            start = time.time()
+            stats = self.tuner.train()
+            result["train_loss"] = round(stats.training_loss, 4)
+            result["train_time_s"] = round(time.time() - start, 1)
+
+            metrics = self.tuner.trainer.evaluate(eval_dataset=self.eval_dataset)
+            result["eval_loss"] = round(metrics["eval_loss"], 4)
+            result["eval_perplexity"] = round(math.exp(min(metrics["eval_loss"], 50)), 3)
+            result["trainable_params"] = sum(p.numel() for p in self.tuner.model.parameters() if p.requires_grad)
+
+            summary_path = os.path.join(trial_dir, "throughput_summary.json")
+            if os.path.exists(summary_path):
+                with open(summary_path, 'r', encoding='utf-8') as f:
+                    result["tokens_per_s"] = json.load(f).get("tokens_per_s")
+        except Exception as e:
+            logger.error(f"{name} failed: {e}")
+            result["error"] = str(e)
+        finally:
+            # Drop the adapters and everything the trainer holds, keep the base weights
+            self.base_model = self.tuner.model.unload()
+            self.tuner.model = self.base_model
+            self.tuner.trainer = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        self.results.append(result)
+        return result
+
+    def run(self, trials: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if self.base_model is None:
+            self.setup()
+
+        start = time.time()
+        for index, params in enumerate(trials):
+            self.run_trial(index, params)
+        logger.info(f"Sweep of {len(trials)} trials finished in {time.time() - start:.1f}s")
+
+        self.save_results()
+        return self.results
+
+    def ranked(self) -> List[Dict[str, Any]]:
+        return sorted(self.results, key=lambda r: r.get("eval_loss", float("inf")))
+
+    def save_results(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        ranked = self.ranked()
+
+        with open(os.path.join(self.output_dir, "sweep_results.json"), 'w', encoding='utf-8') as f:
+            json.dump(ranked, f, ensure_ascii=False, indent=2)
+
+        columns = list(dict.fromkeys(key for result in ranked for key in result))
+        with open(os.path.join(self.output_dir, "sweep_results.csv"), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows({k: format_value(v) if isinstance(v, list) else v for k, v in r.items()} for r in ranked)
+
+        logger.info(f"Sweep results saved to: {self.output_dir}/sweep_results.{{json,csv}}")
+
+    def results_table(self, param_keys: List[str]) -> str:
+        """Markdown table sorted by held-out loss"""
+        columns = ["trial", *param_keys, "train_loss", "eval_loss", "eval_perplexity", "tokens_per_s", "train_time_s"]
+        lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+        for result in self.ranked():
+            if "error" in result:
+                cells = [result["trial"], *(format_value(result.get(k)) for k in param_keys)]
+                lines.append("| " + " | ".join(cells) + f" | ❌ {result['error'][:60]} |")
+                continue
+            lines.append("| " + " | ".join(format_value(result.get(k, "-")) for k in columns) + " |")
+        return "\n".join(lines)
+
+
+def main():
+    """Sweep CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="In-process LoRA hyperparameter sweep")
+    parser.add_argument("--config", default="configs/sweep_config.yaml")
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        sweep_config = yaml.safe_load(f) or {}
+
+    base_config = load_standard_config(sweep_config.get("base_config", "configs/training_config_standard.yaml"))
+    overrides = sweep_config.get("overrides") or {}
+    base_config = replace(base_config, **overrides)
+
+    search_space = sweep_config.get("search_space") or {}
+    trials = build_trials(
+        search_space,
+        strategy=sweep_config.get("strategy", "grid"),
+        num_trials=sweep_config.get("num_trials", 10),
+        seed=base_config.seed,
+    )
+
+    sweep = LoRASweep(
+        base_config,
+        output_dir=sweep_config.get("output_dir", "outputs/sweep"),
+        template_path=sweep_config.get("template_path", "data/chat_template.txt"),
+    )
+    sweep.run(trials)
+
+    print(f"\n📊 Sweep results ({len(trials)} trials, {base_config.max_steps} steps each, sorted by eval_loss)\n")
+    print(sweep.results_table(list(search_space)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Token-budget dynamic batching
+Groups samples of similar tokenized length and fills each batch up to a
+padded-token budget (`max_tokens_per_batch`) instead of a fixed batch size,
+with token-level loss normalization so variable batch sizes weigh every
+supervised token equally
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import random
+import logging
+from typing import Dict, List, Iterator, Optional, Sequence, Any
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Sampler
+from transformers import Trainer
+
+from qwen_finetune.utils.packing import IGNORE_INDEX
+
+logger = logging.getLogger(__name__)
+
+NUM_TOKENS_KEY = "num_tokens"
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Length-grouped batches bounded by a padded-token budget
+
+    Indices are shuffled, split into buckets of `bucket_size` samples and
+    sorted by length inside each bucket, then cut into batches whose padded
+    size (batch size x longest sample) stays within `max_tokens`. The batch
+    order is shuffled again so lengths do not drift over an epoch. A sample
+    longer than the budget forms a batch of its own.
+
+    `batch_size` is None so accelerate shards whole batches across processes
+    without assuming a fixed size.
+    """
+
+    def __init__(self, lengths: Sequence[int], max_tokens: int, shuffle: bool = True, seed: int = 3407,
+                 bucket_size: int = 1000, max_batch_size: Optional[int] = None, drop_last: bool = False):
+        if max_tokens <= 0:
+            raise ValueError(f"max_tokens must be positive, got {max_tokens}")
+
+        self.lengths = [int(length) for length in lengths]
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.drop_last = drop_last
+        self.batch_size = None
+        self.epoch = 0
+        self._batches: Optional[List[List[int]]] = None
+
+        oversized = sum(1 for length in self.lengths if length > max_tokens)
+        if oversized:
+            logger.warning(f"{oversized} samples exceed max_tokens_per_batch={max_tokens} and form single-sample batches")
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def _make_batches(self) -> List[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches: List[List[int]] = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+
+            batch: List[int] = []
+            longest = 0
+            for index in bucket:
+                length = self.lengths[index]
+                full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+                if batch and (full or max(longest, length) * (len(batch) + 1) > self.max_tokens):
+                    batches.append(batch)
+                    batch, longest = [], 0
+                batch.append(index)
+                longest = max(longest, length)
+            if batch:
+                batches.append(batch)
+
+        # Batch sizes vary by design; the final batch is incomplete if another sample of its length still fits
+        if self.drop_last and batches and self._has_room(batches[-1]):
+            batches.pop()
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def _has_room(self, batch: List[int]) -> bool:
+        if self.max_batch_size is not None and len(batch) >= self.max_batch_size:
+            return False
+        return max(self.lengths[i] for i in batch) * (len(batch) + 1) <= self.max_tokens
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches if self._batches is not None else self._make_batches()
+        self._batches = None
+        yield from batches
+
+    def __len__(self) -> int:
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return len(self._batches)
+
+    def stats(self) -> Dict[str, float]:
+        """Batch count, mean batch size and padding ratio of the current epoch"""
+        batches = self._batches if self._batches is not None else self._make_batches()
+        real = sum(self.lengths[i] for batch in batches for i in batch)
+        padded = sum(len(batch) * max(self.lengths[i] for i in batch) for batch in batches)
+        return {
+            "num_batches": len(batches),
+            "mean_batch_size": len(self.lengths) / max(len(batches), 1),
+            "padding_ratio": 1 - real / max(padded, 1),
+        }
+
+
+class TokenCountingCollator:
+    """Wrap a collator and add the number of real (unpadded) tokens to each batch"""
+
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        num_tokens = sum(len(feature["input_ids"]) for feature in features)
+        batch = self.collator(features)
+        batch[NUM_TOKENS_KEY] = torch.tensor(num_tokens, dtype=torch.long)
+        return batch
+
+
+class TokenBudgetTrainer(Trainer):
+    """
+    Trainer with token-budget batches
+
+    - The train dataloader uses TokenBudgetBatchSampler
+    - Loss is the sum of token cross-entropies divided by the number of
+      supervised tokens in the whole accumulation window (`num_items_in_batch`),
+      so a batch of 40 short samples and one of 2 long samples contribute per
+      token, not per batch
+    - Logs padding_ratio and tokens_per_step (real tokens per optimizer step,
+      per device)
+    """
+
+    def __init__(self, *args, max_tokens_per_batch: int, bucket_size: int = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.bucket_size = bucket_size
+        # compute_loss normalizes by num_items_in_batch itself; stops training_step
+        # from dividing by gradient_accumulation_steps again
+        self.model_accepts_loss_kwargs = True
+        self._real_tokens = 0
+        self._padded_tokens = 0
+        self._last_logged_step = 0
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+
+        lengths = [len(ids) for ids in self.train_dataset["input_ids"]]
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            self.max_tokens_per_batch,
+            seed=self.args.seed,
+            bucket_size=self.bucket_size,
+            drop_last=self.args.dataloader_drop_last,
+        )
+        stats = batch_sampler.stats()
+        logger.info(
+            f"Token-budget batching: {stats['num_batches']} batches/epoch, "
+            f"mean batch size {stats['mean_batch_size']:.1f}, padding {stats['padding_ratio']:.1%}"
+        )
+
+        num_workers = self.args.dataloader_num_workers
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=TokenCountingCollator(self.data_collator),
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers and num_workers > 0,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        num_tokens = inputs.pop(NUM_TOKENS_KEY, None)
+        if num_tokens is not None and model.training:
+            self._real_tokens += int(num_tokens)
+            self._padded_tokens += inputs["input_ids"].numel()
+
+        labels = inputs.pop("labels")
+        outputs = model(**inputs)
+
+        logits = outputs.logits[..., :-1, :].float()
+        shift_labels = labels[..., 1:].to(logits.device)
+        loss = F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)),
+            shift_labels.reshape(-1),
+            ignore_index=IGNORE_INDEX,
+            reduction="sum",
+        )
+
+        # Training passes the window's token count summed over processes; evaluation passes None
+        global_count = num_items_in_batch is not None
+        if not global_count:
+            num_items_in_batch = shift_labels.ne(IGNORE_INDEX).sum()
+        if torch.is_tensor(num_items_in_batch):
+            num_items_in_batch = num_items_in_batch.to(loss.device)
+        loss = loss / num_items_in_batch
+
+        # DDP averages gradients, so undo the division by the other processes' tokens (training only)
+        if global_count and self.args.average_tokens_across_devices and self.accelerator.num_processes > 1:
+            loss = loss * self.accelerator.num_processes
+
+        outputs["loss"] = loss
+        return (loss, outputs) if return_outputs else loss
+
+    def log(self, logs: Dict[str, float], *args, **kwargs) -> None:
+        steps = self.state.global_step - self._last_logged_step
+        if "loss" in logs and steps > 0 and self._padded_tokens:
+            logs["padding_ratio"] = round(1 - self._real_tokens / self._padded_tokens, 4)
+            logs["tokens_per_step"] = round(self._real_tokens / steps, 1)
+            self._real_tokens = self._padded_tokens = 0
+            self._last_logged_step = self.state.global_step
+        super().log(logs, *args, **kwargs)
+
@@ -10,11 +10,317 @@ Date: 2025
 import json
 import re
 import os
-from typing import List, Dict, Any, Union, Optional
+import hashlib
+import itertools
+import multiprocessing
+from array import array
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, Dict, Any, Sequence, Set, Tuple, Union, Optional
 import logging
 
+import numpy as np
+
+from .dataset_io import (
+    iter_records, load_records, write_records, load_error_index, error_index_path, is_jsonl, is_columnar
+)
+
 logger = logging.getLogger(__name__)
 
+# Individual conversion errors logged before only the per-format counts are reported
+MAX_LOGGED_CONVERSION_ERRORS = 20
+
+# Inputs smaller than this convert in-process by default: starting a worker
+# pool costs more than it saves on a few thousand conversations
+MIN_PARALLEL_CONVERSION_BYTES = 32 * 1024 * 1024
+
+
+def _iter_conversion_chunks(input_path: str, chunk_size: int,
+                            skip_invalid: bool = False) -> Iterator[Tuple[Sequence[int], List[Any], bool]]:
+    """
+    (item indices, items, raw) chunks; JSONL lines stay unparsed (raw) for the workers
+
+    Indices are positions in the input file (as in the error index), so
+    they still point at the right item when `skip_invalid` leaves some out.
+    """
+    invalid = load_error_index(input_path) if skip_invalid else None
+    if invalid:
+        logger.info(f"Skipping {len(invalid)} invalid records listed in {error_index_path(input_path)}")
+    if is_jsonl(input_path):
+        with open(input_path, 'r', encoding='utf-8') as f:
+            yield from _chunk_items((line for line in f if line.strip()), chunk_size, invalid, raw=True)
+    else:
+        yield from _chunk_items(iter_records(input_path), chunk_size, invalid, raw=False)
+
+
+def _chunk_items(items: Iterable[Any], chunk_size: int, invalid: Optional[Set[int]],
+                 raw: bool) -> Iterator[Tuple[Sequence[int], List[Any], bool]]:
+    numbered = enumerate(items)
+    if invalid:
+        numbered = ((index, item) for index, item in numbered if index not in invalid)
+    while True:
+        chunk = list(itertools.islice(numbered, chunk_size))
+        if not chunk:
+            return
+        first, last = chunk[0][0], chunk[-1][0]
+        # Contiguous chunks (no skipped items) send a range instead of every index
+        indices = range(first, last + 1) if last - first + 1 == len(chunk) else [index for index, _ in chunk]
+        yield indices, [item for _, item in chunk], raw
+
+
+def _convert_chunk(task: Tuple[Tuple[Sequence[int], List[Any], bool], str, bool]) -> Tuple[List[Any], Dict[str, Dict[str, int]], List[Tuple[int, str]]]:
+    """
+    Worker: convert one chunk to ChatML records (or compact JSONL lines)
+
+    Returns the converted chunk, per-format counts and (index, message)
+    for items that failed; unparseable JSONL lines count as 'invalid_json'.
+    """
+    (indices, items, raw), input_format, serialize = task
+    converted: List[Any] = []
+    counts: Dict[str, Dict[str, int]] = {}
+    errors: List[Tuple[int, str]] = []
+
+    for index, item in zip(indices, items):
+        if raw:
+            try:
+                item = json.loads(item)
+            except json.JSONDecodeError as e:
+                counts.setdefault("invalid_json", {"converted": 0, "empty": 0, "errors": 0})["errors"] += 1
+                errors.append((index, f"invalid JSON: {e}"))
+                continue
+
+        fmt = DataProcessor._detect_item_format(item) if input_format == "auto" else input_format
+        fmt_counts = counts.setdefault(fmt, {"converted": 0, "empty": 0, "errors": 0})
+        try:
+            conversations = DataProcessor._convert_item_to_chatml(item, fmt)
+        except Exception as e:
+            fmt_counts["errors"] += 1
+            errors.append((index, f"{fmt}: {e}"))
+            continue
+
+        if not conversations:
+            fmt_counts["empty"] += 1
+            continue
+        fmt_counts["converted"] += 1
+        record = {"conversations": conversations}
+        converted.append(json.dumps(record, ensure_ascii=False) + "\n" if serialize else record)
+
+    return converted, counts, errors
+
+
+def _ordered_imap(pool, func: Callable, tasks: Iterable, max_pending: int) -> Iterator[Any]:
+    """
+    Pool.imap with backpressure: results in task order, at most `max_pending`
+    tasks submitted ahead (Pool.imap would read the whole input eagerly)
+    """
+    pending: deque = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# Token length percentiles reported by analyze_data
+TOKEN_PERCENTILES = (50, 90, 95, 99)
+
+SPLIT_NAMES = ("train", "val", "test")
+SPLIT_MANIFEST = "split_manifest.json"
+SPLIT_GROUPS = "split_groups.jsonl"  # [group, split] per conversation of a stratified split, reused on append
+
+
+def _hash_draw(group: Any, seed: int) -> float:
+    """Uniform draw in [0, 1) from blake2b(seed, group), stable across runs and machines"""
+    digest = hashlib.blake2b(f"{seed}:{group}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+
+def hash_split(group: Any, ratios: Tuple[float, float, float], seed: int = 3407) -> str:
+    """Split for a conversation ID: a uniform draw from blake2b(seed, ID), stable across runs and machines"""
+    draw = _hash_draw(group, seed)
+    cumulative = 0.0
+    for name, ratio in zip(SPLIT_NAMES, ratios):
+        cumulative += ratio
+        if draw < cumulative:
+            return name
+    return SPLIT_NAMES[-1]
+
+
+def stratified_hash_split(groups: Dict[Any, Dict[str, int]], ratios: Tuple[float, float, float],
+                          seed: int = 3407, totals: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[Any, str]:
+    """
+    Split per group, stratified: {group: {stratum: samples}} -> {group: split}
+
+    Groups are taken in hash order and each goes to the split where its
+    strata are furthest below the ratios (sample counts relative to each
+    stratum's size, starting from `totals` when appending). Every stratum
+    ends up at the ratios up to a few groups, whatever the input order.
+    """
+    sizes: Dict[str, int] = {}
+    counts: Dict[str, Dict[str, int]] = {}
+    for stratum, split_counts in (totals or {}).items():
+        counts[stratum] = dict(split_counts)
+        sizes[stratum] = sum(split_counts.values())
+    for strata in groups.values():
+        for stratum, samples in strata.items():
+            sizes[stratum] = sizes.get(stratum, 0) + samples
+            counts.setdefault(stratum, dict.fromkeys(SPLIT_NAMES, 0))
+
+    active = [(name, ratio) for name, ratio in zip(SPLIT_NAMES, ratios) if ratio > 0]
+    assignment: Dict[Any, str] = {}
+    for group in sorted(groups, key=lambda group: _hash_draw(group, seed)):
+        strata = groups[group]
+        split = min(active, key=lambda item: sum(
+            samples / sizes[stratum] * (counts[stratum][item[0]] + samples) / item[1]
+            for stratum, samples in strata.items()
+        ))[0]
+        assignment[group] = split
+        for stratum, samples in strata.items():
+            counts[stratum][split] += samples
+    return assignment
+
+
+def _file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _length_summary(lengths: np.ndarray) -> Dict[str, Any]:
+    """Count, total, mean, percentiles and a log2-bucket histogram of token lengths"""
+    if not len(lengths):
+        return {"count": 0, "total": 0}
+
+    summary: Dict[str, Any] = {
+        "count": int(len(lengths)),
+        "total": int(lengths.sum()),
+        "mean": round(float(lengths.mean()), 1),
+        "max": int(lengths.max()),
+    }
+    for percentile, value in zip(TOKEN_PERCENTILES, np.percentile(lengths, TOKEN_PERCENTILES)):
+        summary[f"p{percentile}"] = int(np.ceil(value))
+
+    # Buckets [0, 1), [1, 2), [2, 4), [4, 8), ... up to the longest sample
+    edges = np.concatenate([[0], 2 ** np.arange(int(np.log2(max(summary["max"], 1))) + 2)])
+    counts, _ = np.histogram(lengths, bins=edges)
+    summary["histogram"] = {
+        f"{low}-{high - 1}": int(count) for low, high, count in zip(edges[:-1], edges[1:], counts) if count
+    }
+    return summary
+
+
+def padding_waste(lengths: np.ndarray, batch_size: int, sort: bool = False, seed: int = 3407) -> float:
+    """Fraction of padded batch tokens that are padding (dynamic padding to the batch maximum)"""
+    if not len(lengths):
+        return 0.0
+    lengths = np.sort(lengths) if sort else np.random.default_rng(seed).permutation(lengths)
+    starts = np.arange(0, len(lengths), batch_size)
+    batch_max = np.maximum.reduceat(lengths, starts)
+    batch_rows = np.diff(np.append(starts, len(lengths)))
+    return float(1 - lengths.sum() / (batch_max * batch_rows).sum())
+
+
+class _TokenLengthCounter:
+    """Batched token counting per role and per chat-formatted conversation for analyze_data"""
+
+    def __init__(self, tokenizer: Any, chat_template_path: Optional[str] = None, batch_size: int = 1000):
+        from .formatting import ChatTemplateFormatter
+
+        if isinstance(tokenizer, str):
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer, trust_remote_code=True)
+        if chat_template_path:
+            with open(chat_template_path, 'r', encoding='utf-8') as f:
+                tokenizer.chat_template = f.read().strip()
+
+        self.tokenizer = tokenizer
+        self.formatter = ChatTemplateFormatter(tokenizer)
+        self.batch_size = batch_size
+        self.pending_turns: Dict[str, List[str]] = {}
+        self.pending_sequences: List[str] = []
+        self.turn_lengths: Dict[str, List[np.ndarray]] = {}
+        self.sequence_lengths: List[np.ndarray] = []
+
+    def _count(self, texts: List[str], add_special_tokens: bool) -> np.ndarray:
+        input_ids = self.tokenizer(texts, add_special_tokens=add_special_tokens, return_attention_mask=False)["input_ids"]
+        return np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+
+    def add(self, turns: Any) -> None:
+        from .formatting import normalize_conversation
+
+        messages = normalize_conversation(turns)
+        if not messages:
+            return
+
+        for message in messages:
+            pending = self.pending_turns.setdefault(message["role"], [])
+            pending.append(message["content"])
+            if len(pending) >= self.batch_size:
+                self._flush_role(message["role"])
+
+        # Full training sequence, tokenized the way the trainers do
+        self.pending_sequences.append(self.formatter.render(messages))
+        if len(self.pending_sequences) >= self.batch_size:
+            self._flush_sequences()
+
+    def _flush_role(self, role: str) -> None:
+        if self.pending_turns.get(role):
+            self.turn_lengths.setdefault(role, []).append(self._count(self.pending_turns[role], False))
+            self.pending_turns[role] = []
+
+    def _flush_sequences(self) -> None:
+        if self.pending_sequences:
+            self.sequence_lengths.append(self._count(self.pending_sequences, True))
+            self.pending_sequences = []
+
+    def summary(self, max_seq_length: int, batch_size: int) -> Dict[str, Any]:
+        for role in list(self.pending_turns):
+            self._flush_role(role)
+        self._flush_sequences()
+
+        sequences = np.concatenate(self.sequence_lengths) if self.sequence_lengths else np.zeros(0, dtype=np.int64)
+        roles = {role: _length_summary(np.concatenate(chunks)) for role, chunks in sorted(self.turn_lengths.items())}
+        clipped = np.minimum(sequences, max_seq_length)
+        total = int(sequences.sum())
+
+        result: Dict[str, Any] = {
+            "sequences": _length_summary(sequences),
+            "roles": roles,
+            "max_seq_length": max_seq_length,
+            "truncated_sequences": int((sequences > max_seq_length).sum()),
+            "truncated_tokens": int((sequences - clipped).sum()),
+            "system_token_share": round(roles.get("system", {}).get("total", 0) / total, 4) if total else 0.0,
+            "batch_size": batch_size,
+            "padding_waste": round(padding_waste(clipped, batch_size), 4),
+            "padding_waste_length_grouped": round(padding_waste(clipped, batch_size, sort=True), 4),
+        }
+        if len(sequences):
+            # Smallest multiple of 128 that fits 99% of the sequences
+            result["suggested_max_seq_length"] = int(np.ceil(result["sequences"]["p99"] / 128) * 128)
+        return result
+
+
+def _log_token_stats(tokens: Dict[str, Any]) -> None:
+    sequences = tokens["sequences"]
+    if not sequences["count"]:
+        logger.info("  No conversations to tokenize")
+        return
+
+    logger.info(f"  Sequence tokens: mean {sequences['mean']}, p50 {sequences['p50']}, p90 {sequences['p90']}, "
+                f"p95 {sequences['p95']}, p99 {sequences['p99']}, max {sequences['max']}")
+    for role, summary in tokens["roles"].items():
+        logger.info(f"  {role} turn tokens: mean {summary['mean']}, p50 {summary['p50']}, p99 {summary['p99']}, "
+                    f"max {summary['max']}")
+    logger.info(f"  Sequence length histogram: {sequences['histogram']}")
+    logger.info(f"  Truncated at max_seq_length={tokens['max_seq_length']}: {tokens['truncated_sequences']} sequences "
+                f"({tokens['truncated_tokens']} tokens)")
+    logger.info(f"  System prompt share of tokens: {tokens['system_token_share']:.1%}")
+    logger.info(f"  Padding waste (batch_size={tokens['batch_size']}): {tokens['padding_waste']:.1%} random order, "
+                f"{tokens['padding_waste_length_grouped']:.1%} length-grouped")
+    logger.info(f"  Suggested max_seq_length (p99): {tokens['suggested_max_seq_length']}")
+
 
 class DataProcessor:
     """Process and validate data for Qwen fine-tuning"""
@@ -23,65 +329,128 @@ class DataProcessor:
     def convert_to_chatml_format(
         input_path: str,
         output_path: str,
-        input_format: str = "auto"
-    ) -> None:
+        input_format: str = "auto",
+        num_workers: Optional[int] = None,
+        chunk_size: int = 1000,
+        skip_invalid: bool = False
+    ) -> Dict[str, Dict[str, int]]:
         """
         Convert various data formats to ChatML conversation format
         
+        The input is streamed in chunks that worker processes convert in
+        parallel; chunks are written back in input order, and at most a few
+        chunks per worker are in flight, so memory stays flat whatever the
+        file size. JSONL input lines are parsed in the workers, and a .jsonl
+        output path gets compact JSONL serialized there too.
+        
         Args:
-            input_path: Path to input data file
-            output_path: Path to save converted data
-            input_format: Input format ('auto', 'alpaca', 'sharegpt', 'conversations')
+            input_path: Path to input data file (JSON array or JSONL)
+            output_path: Path to save converted data (.jsonl recommended)
+            input_format: Input format ('auto', 'alpaca', 'sharegpt', 'conversations');
+                'auto' detects the format of every item, so mixed dumps convert correctly
+            num_workers: Worker processes (default: in-process below
+                MIN_PARALLEL_CONVERSION_BYTES of input, else CPU count; 1 = in-process)
+            chunk_size: Items per worker task
+            skip_invalid: Leave out items listed in the input's error index (see validate_data)
+            
+        Returns:
+            Per-format counts: {format: {"converted", "empty", "errors"}}
         """
         logger.info(f"Converting data from {input_path} to ChatML format")
         
         try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            if not isinstance(data, list):
-                raise ValueError("Input data must be a list")
-                
-            # Auto-detect format if needed
-            if input_format == "auto":
-                input_format = DataProcessor._detect_format(data)
-                logger.info(f"Detected format: {input_format}")
-            
-            processed_data = []
-            
-            for i, item in enumerate(data):
-                try:
-                    conversations = DataProcessor._convert_item_to_chatml(item, input_format)
-                    if conversations:
-                        processed_data.append({"conversations": conversations})
-                except Exception as e:
-                    logger.warning(f"Error processing item {i}: {e}")
-                    continue
-                    
-            # Save processed data
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(processed_data, f, ensure_ascii=False, indent=2)
+            if num_workers is None:
+                small = os.path.getsize(input_path) < MIN_PARALLEL_CONVERSION_BYTES
+                num_workers = 1 if small else os.cpu_count() or 1
+            serialize = is_jsonl(output_path)
+            stats: Dict[str, Dict[str, int]] = {}
+            logged_errors = 0
+            
+            def merge(result):
+                nonlocal logged_errors
+                lines, counts, errors = result
+                for fmt, fmt_counts in counts.items():
+                    total = stats.setdefault(fmt, {"converted": 0, "empty": 0, "errors": 0})
+                    for key, value in fmt_counts.items():
+                        total[key] += value
+                for index, message in errors:
+                    if logged_errors < MAX_LOGGED_CONVERSION_ERRORS:
+                        logger.warning(f"Error processing item {index}: {message}")
+                    logged_errors += 1
+                return lines
+            
+            tasks = (
+                (chunk, input_format, serialize)
+                for chunk in _iter_conversion_chunks(input_path, chunk_size, skip_invalid)
+            )
+            
+            if num_workers <= 1:
+                results = (merge(_convert_chunk(task)) for task in tasks)
+                written = DataProcessor._write_converted(results, output_path, serialize)
+            else:
+                with multiprocessing.Pool(num_workers) as pool:
+                    results = _ordered_imap(pool, _convert_chunk, tasks, max_pending=2 * num_workers)
+                    written = DataProcessor._write_converted(
+                        (merge(result) for result in results), output_path, serialize
+                    )
+            
+            for fmt, counts in sorted(stats.items()):
+                logger.info(f"   {fmt}: {counts['converted']} converted, {counts['empty']} empty, "
+                            f"{counts['errors']} errors")
+            if logged_errors > MAX_LOGGED_CONVERSION_ERRORS:
+                logger.warning(f"⚠️ {logged_errors - MAX_LOGGED_CONVERSION_ERRORS} more conversion errors not shown")
                 
-            logger.info(f"✅ Converted {len(processed_data)} samples to {output_path}")
+            logger.info(f"✅ Converted {written} samples to {output_path}")
+            return stats
             
         except Exception as e:
             logger.error(f"Error converting data: {e}")
             raise
             
     @staticmethod
-    def _detect_format(data: List[Dict]) -> str:
-        """Auto-detect data format"""
+    def _write_converted(chunks, output_path: str, serialize: bool) -> int:
+        """Write converted chunks: pre-serialized JSONL lines, or records via write_records"""
+        if not serialize:
+            return write_records((record for chunk in chunks for record in chunk), output_path)
+            
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        count = 0
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for lines in chunks:
+                f.writelines(lines)
+                count += len(lines)
+        return count
+            
+    @staticmethod
+    def _detect_format(data: List[Dict], sample_size: int = 100) -> str:
+        """Auto-detect data format (most common format among the first items)"""
         if not data:
             return "conversations"
             
-        sample = data[0]
+        counts: Dict[str, int] = {}
+        for item in data[:sample_size]:
+            fmt = DataProcessor._detect_item_format(item)
+            counts[fmt] = counts.get(fmt, 0) + 1
+        return max(counts, key=counts.get)
+        
+    @staticmethod
+    def _detect_item_format(item: Any) -> str:
+        """Auto-detect the format of a single item"""
+        if isinstance(item, list):
+            return "sharegpt"
+        if not isinstance(item, dict):
+            return "conversations"
         
-        if "conversations" in sample:
+        if "conversations" in item:
+            turns = item["conversations"]
+            first = turns[0] if isinstance(turns, list) and turns else None
+            if isinstance(first, dict) and "from" in first and "role" not in first:
+                return "sharegpt"
             return "conversations"
-        elif "instruction" in sample:
+        elif "instruction" in item:
             return "alpaca"
-        elif "from" in sample or "human" in str(sample):
+        elif "from" in item or "human" in str(item):
             return "sharegpt"
         else:
             return "conversations"
@@ -150,13 +519,19 @@ class DataProcessor:
             return "user"
             
     @staticmethod
-    def validate_data(data_path: str, strict: bool = False) -> bool:
+    def validate_data(data_path: str, strict: bool = False, num_workers: Optional[int] = None) -> bool:
         """
         Validate ChatML conversation data format
         
+        Records are checked against a compiled msgspec schema (JSONL in
+        parallel byte ranges) and every invalid item is written to the error
+        index `<data_path>.errors.json`, which `skip_invalid=True` loaders and
+        the trainers use to drop bad rows without validating again.
+        
         Args:
             data_path: Path to data file
-            strict: Whether to use strict validation
+            strict: Whether to use strict validation (all items valid, known roles only)
+            num_workers: Worker processes for JSONL files (default: CPU count)
             
         Returns:
             bool: True if validation passes
@@ -164,34 +539,15 @@ class DataProcessor:
         logger.info(f"Validating data: {data_path}")
         
         try:
-            with open(data_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            if not isinstance(data, list):
-                logger.error("❌ Data must be a list of conversation objects")
+            from .validation import validate_file, log_report
+            
+            report = validate_file(data_path, strict=strict, num_workers=num_workers)
+            log_report(report)
+            
+            if strict and report["valid"] < report["total"]:
+                logger.error(f"❌ Validation failed at item {report['errors'][0]['index']}")
                 return False
-                
-            valid_samples = 0
-            total_samples = len(data)
-            
-            for i, item in enumerate(data):
-                try:
-                    if not DataProcessor._validate_conversation_item(item, strict):
-                        if strict:
-                            logger.error(f"❌ Validation failed at item {i}")
-                            return False
-                        else:
-                            logger.warning(f"⚠️ Item {i} has validation issues")
-                    else:
-                        valid_samples += 1
-                        
-                except Exception as e:
-                    logger.warning(f"⚠️ Error validating item {i}: {e}")
-                    if strict:
-                        return False
-                        
-            logger.info(f"✅ Validation completed: {valid_samples}/{total_samples} valid samples")
-            return valid_samples > 0
+            return report["valid"] > 0
             
         except Exception as e:
             logger.error(f"❌ Validation failed: {e}")
@@ -324,16 +680,36 @@ class DataProcessor:
         logger.info(f"✅ Created {num_samples} sample conversations in {output_path}")
         
     @staticmethod
-    def analyze_data(data_path: str) -> Dict[str, Any]:
-        """Analyze conversation data and return statistics"""
+    def analyze_data(
+        data_path: str,
+        tokenizer: Any = None,
+        max_seq_length: int = 2048,
+        batch_size: int = 8,
+        chat_template_path: Optional[str] = None,
+        tokenize_batch_size: int = 1000
+    ) -> Dict[str, Any]:
+        """
+        Analyze conversation data and return statistics
+        
+        With a tokenizer, token lengths are computed in batches into NumPy
+        arrays: percentiles and log2 histograms per role and for the full
+        chat-formatted sequence, truncation at `max_seq_length`, the system
+        prompt's share of tokens, and the padding waste of `batch_size`
+        batches (random order vs. length-grouped).
+        
+        Args:
+            data_path: Path to data file (JSON array or JSONL)
+            tokenizer: Tokenizer object or model name/path (None = character stats only)
+            max_seq_length: Training / serving sequence length to check truncation against
+            batch_size: Batch size for the padding waste estimate
+            chat_template_path: Chat template to set on the tokenizer (e.g. data/chat_template.txt)
+            tokenize_batch_size: Texts per tokenizer call
+        """
         logger.info(f"Analyzing data: {data_path}")
         
         try:
-            with open(data_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
             stats = {
-                "total_conversations": len(data),
+                "total_conversations": 0,
                 "total_turns": 0,
                 "roles": {},
                 "avg_turns_per_conversation": 0,
@@ -341,7 +717,13 @@ class DataProcessor:
                 "empty_conversations": 0
             }
             
-            for conversation in data:
+            counter = None
+            if tokenizer is not None:
+                counter = _TokenLengthCounter(tokenizer, chat_template_path, tokenize_batch_size)
+            content_lengths = array("q")
+            
+            for conversation in iter_records(data_path):
+                stats["total_conversations"] += 1
                 if "conversations" not in conversation:
                     stats["empty_conversations"] += 1
                     continue
@@ -358,15 +740,20 @@ class DataProcessor:
                     content = turn.get("content", "")
                     
                     stats["roles"][role] = stats["roles"].get(role, 0) + 1
-                    stats["content_lengths"].append(len(content))
+                    content_lengths.append(len(content))
+                    
+                if counter is not None:
+                    counter.add(turns)
                     
             if stats["total_conversations"] > 0:
                 stats["avg_turns_per_conversation"] = stats["total_turns"] / stats["total_conversations"]
                 
-            if stats["content_lengths"]:
-                stats["avg_content_length"] = sum(stats["content_lengths"]) / len(stats["content_lengths"])
-                stats["min_content_length"] = min(stats["content_lengths"])
-                stats["max_content_length"] = max(stats["content_lengths"])
+            lengths = np.frombuffer(content_lengths, dtype=np.int64) if content_lengths else np.zeros(0, dtype=np.int64)
+            stats["content_lengths"] = lengths.tolist()
+            if len(lengths):
+                stats["avg_content_length"] = float(lengths.mean())
+                stats["min_content_length"] = int(lengths.min())
+                stats["max_content_length"] = int(lengths.max())
             
             logger.info(f"📊 Data Analysis Results:")
             logger.info(f"  Total conversations: {stats['total_conversations']}")
@@ -375,62 +762,307 @@ class DataProcessor:
             logger.info(f"  Role distribution: {stats['roles']}")
             logger.info(f"  Average content length: {stats.get('avg_content_length', 0):.2f} characters")
             
+            if counter is not None:
+                stats["tokens"] = counter.summary(max_seq_length, batch_size)
+                _log_token_stats(stats["tokens"])
+            
             return stats
             
         except Exception as e:
             logger.error(f"Error analyzing data: {e}")
             raise
             
+    @staticmethod
+    def deduplicate(
+        input_path: str,
+        output_path: str,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        shingle_size: int = 3,
+        index_path: Optional[str] = None,
+        report_path: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Remove near-duplicate conversations (MinHash LSH, streaming)
+        
+        Args:
+            input_path: Path to input data file (.json or .jsonl)
+            output_path: Path to save deduplicated data
+            threshold: Estimated Jaccard similarity at which samples count as duplicates
+            num_perm: MinHash signature size
+            shingle_size: Words per shingle
+            index_path: SQLite file for the LSH index (None = in memory)
+            report_path: Cluster report path (default: <output>.dedup_report.json)
+            
+        Returns:
+            Dedup report (totals and largest removed clusters)
+        """
+        logger.info(f"Deduplicating data: {input_path}")
+        
+        try:
+            from .dedup import deduplicate_file
+            return deduplicate_file(
+                input_path,
+                output_path,
+                threshold=threshold,
+                num_perm=num_perm,
+                shingle_size=shingle_size,
+                index_path=index_path,
+                report_path=report_path,
+            )
+            
+        except Exception as e:
+            logger.error(f"Error deduplicating data: {e}")
+            raise
+            
     @staticmethod
     def split_data(
         input_path: str,
         train_ratio: float = 0.8,
         val_ratio: float = 0.1,
         test_ratio: float = 0.1,
-        output_dir: str = "data"
-    ) -> None:
-        """Split data into train/validation/test sets"""
+        output_dir: str = "data",
+        seed: int = 3407,
+        group_key: Optional[str] = None,
+        stratify_key: Optional[str] = None,
+        append: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Split data into train/validation/test sets
+        
+        By default the data is shuffled in memory (seeded) and cut by ratio
+        (per `stratify_key` value when set). With `group_key` the split
+        streams instead: every record goes to the split picked by a stable
+        hash of (seed, record[group_key]), so all samples of one conversation
+        land in the same split, one pass needs constant memory, and
+        re-running or appending new data never moves existing samples.
+        
+        Adding `stratify_key` to `group_key` takes two passes and memory per
+        conversation: the first counts each conversation's samples per value,
+        then whole conversations are placed so that every value stays at the
+        split ratios (see stratified_hash_split). The placement is saved to
+        split_groups.jsonl; appends keep known conversations in their split
+        and only place new ones.
+        
+        Args:
+            input_path: Path to input data file
+            train_ratio / val_ratio / test_ratio: Split ratios (must sum to 1.0)
+            output_dir: Directory for train/val/test files
+            seed: Shuffle seed, or hash salt in streaming mode
+            group_key: Conversation ID field for the streaming hash split (e.g. 'conversationID');
+                records without it are hashed by their conversation content
+            stratify_key: Field (e.g. 'user_intent') to keep at the split ratios within each value
+            append: Streaming mode only: append to existing .jsonl splits (same settings required;
+                a source already in the manifest, by content hash, is refused)
+            
+        Returns:
+            Sample counts per split (and the split manifest in streaming mode)
+        """
         logger.info(f"Splitting data from {input_path}")
         
         if abs(train_ratio + val_ratio + test_ratio - 1.0) > 1e-6:
             raise ValueError("Ratios must sum to 1.0")
             
+        if group_key:
+            return DataProcessor._split_by_hash(
+                input_path, (train_ratio, val_ratio, test_ratio), output_dir,
+                seed, group_key, stratify_key, append
+            )
+        if append:
+            raise ValueError("append needs the streaming split (set group_key)")
+            
         try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_records(input_path)
                 
             import random
-            random.shuffle(data)
+            rng = random.Random(seed)
+            strata: Dict[str, List[Any]] = {}
+            for record in data:
+                stratum = str(record.get(stratify_key)) if stratify_key and isinstance(record, dict) else ""
+                strata.setdefault(stratum, []).append(record)
             
-            total = len(data)
-            train_end = int(total * train_ratio)
-            val_end = train_end + int(total * val_ratio)
-            
-            train_data = data[:train_end]
-            val_data = data[train_end:val_end]
-            test_data = data[val_end:]
+            train_data, val_data, test_data = [], [], []
+            for records in strata.values():
+                rng.shuffle(records)
+                total = len(records)
+                train_end = int(total * train_ratio)
+                val_end = train_end + int(total * val_ratio)
+                train_data += records[:train_end]
+                val_data += records[train_end:val_end]
+                test_data += records[val_end:]
+            if len(strata) > 1:
+                for split_data in (train_data, val_data, test_data):
+                    rng.shuffle(split_data)
             
             # Save splits
             os.makedirs(output_dir, exist_ok=True)
             
+            # Keep the input format (.json, .jsonl, .parquet or .arrow)
+            ext = os.path.splitext(input_path)[1] if is_jsonl(input_path) or is_columnar(input_path) else ".json"
             splits = [
-                (train_data, f"{output_dir}/train.json"),
-                (val_data, f"{output_dir}/val.json"),
-                (test_data, f"{output_dir}/test.json")
+                (train_data, f"{output_dir}/train{ext}"),
+                (val_data, f"{output_dir}/val{ext}"),
+                (test_data, f"{output_dir}/test{ext}")
             ]
             
             for split_data, split_path in splits:
-                with open(split_path, 'w', encoding='utf-8') as f:
-                    json.dump(split_data, f, ensure_ascii=False, indent=2)
+                write_records(split_data, split_path)
                     
             logger.info(f"✅ Data split completed:")
-            logger.info(f"  Train: {len(train_data)} samples -> {output_dir}/train.json")
-            logger.info(f"  Val: {len(val_data)} samples -> {output_dir}/val.json")
-            logger.info(f"  Test: {len(test_data)} samples -> {output_dir}/test.json")
+            logger.info(f"  Train: {len(train_data)} samples -> {output_dir}/train{ext}")
+            logger.info(f"  Val: {len(val_data)} samples -> {output_dir}/val{ext}")
+            logger.info(f"  Test: {len(test_data)} samples -> {output_dir}/test{ext}")
+            
+            return {"train": len(train_data), "val": len(val_data), "test": len(test_data)}
+            
+        except Exception as e:
+            logger.error(f"Error splitting data: {e}")
+            raise
+            
+    @staticmethod
+    def _split_by_hash(
+        input_path: str,
+        ratios: Tuple[float, float, float],
+        output_dir: str,
+        seed: int,
+        group_key: str,
+        stratify_key: Optional[str],
+        append: bool
+    ) -> Dict[str, Any]:
+        """Streaming group split into <output_dir>/{train,val,test}.jsonl plus split_manifest.json"""
+        manifest_path = os.path.join(output_dir, SPLIT_MANIFEST)
+        settings = {"seed": seed, "ratios": list(ratios), "group_key": group_key, "stratify_key": stratify_key}
+        
+        try:
+            source_sha256 = _file_sha256(input_path)
+            manifest: Dict[str, Any] = {**settings, "sources": [],
+                                        "counts": dict.fromkeys(SPLIT_NAMES, 0), "strata": {}}
+            if append and os.path.exists(manifest_path):
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                previous = {key: manifest.get(key) for key in settings}
+                if previous != settings:
+                    raise ValueError(f"Cannot append with different split settings: {previous} != {settings}")
+                for source in manifest["sources"]:
+                    if source.get("sha256") == source_sha256:
+                        raise ValueError(f"{input_path} was already appended (same content as {source['path']})")
+            
+            def record_group(record):
+                group = record.get(group_key)
+                if group is None:
+                    return json.dumps(record.get("conversations"), ensure_ascii=False, sort_keys=True), True
+                return group, False
+            
+            groups_path = os.path.join(output_dir, SPLIT_GROUPS)
+            assignment, placed = None, {}
+            if stratify_key:
+                known = DataProcessor._load_split_groups(groups_path) if append and manifest["sources"] else {}
+                groups: Dict[str, Dict[str, int]] = {}
+                for record in iter_records(input_path, skip_errors=True):
+                    if isinstance(record, dict):
+                        strata = groups.setdefault(str(record_group(record)[0]), {})
+                        stratum = str(record.get(stratify_key))
+                        strata[stratum] = strata.get(stratum, 0) + 1
+                        
+                # New samples of known conversations count towards the totals the new ones are placed against
+                totals = {stratum: dict(counts) for stratum, counts in manifest["strata"].items()}
+                for group in groups.keys() & known.keys():
+                    for stratum, samples in groups[group].items():
+                        totals.setdefault(stratum, dict.fromkeys(SPLIT_NAMES, 0))[known[group]] += samples
+                unseen = {group: strata for group, strata in groups.items() if group not in known}
+                placed = stratified_hash_split(unseen, ratios, seed, totals)
+                assignment = {group: known[group] for group in groups if group in known}
+                assignment.update(placed)
+                del groups, unseen, known
+                    
+            os.makedirs(output_dir, exist_ok=True)
+            paths = {name: os.path.join(output_dir, f"{name}.jsonl") for name in SPLIT_NAMES}
+            files = {name: open(path, 'a' if append else 'w', encoding='utf-8') for name, path in paths.items()}
+            
+            counts = dict.fromkeys(SPLIT_NAMES, 0)
+            strata: Dict[str, Dict[str, int]] = {}
+            content_hashed = 0
+            try:
+                for record in iter_records(input_path, skip_errors=True):
+                    if not isinstance(record, dict):
+                        continue
+                    group, by_content = record_group(record)
+                    content_hashed += by_content
+                        
+                    split = assignment[str(group)] if assignment is not None else hash_split(group, ratios, seed)
+                    files[split].write(json.dumps(record, ensure_ascii=False) + "\n")
+                    counts[split] += 1
+                    if stratify_key:
+                        stratum = str(record.get(stratify_key))
+                        strata.setdefault(stratum, dict.fromkeys(SPLIT_NAMES, 0))[split] += 1
+            finally:
+                for f in files.values():
+                    f.close()
+                    
+            for name in SPLIT_NAMES:
+                manifest["counts"][name] += counts[name]
+            for stratum, stratum_counts in strata.items():
+                totals = manifest["strata"].setdefault(stratum, dict.fromkeys(SPLIT_NAMES, 0))
+                for name in SPLIT_NAMES:
+                    totals[name] += stratum_counts[name]
+            manifest["sources"].append({"path": input_path, "sha256": source_sha256,
+                                        "samples": sum(counts.values()), **counts})
+            
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            if stratify_key:
+                with open(groups_path, 'a' if append else 'w', encoding='utf-8') as f:
+                    f.writelines(json.dumps([group, split], ensure_ascii=False) + "\n" for group, split in placed.items())
+                    
+            if append:
+                leaked = DataProcessor.find_split_leaks(output_dir, group_key)
+                if leaked:
+                    logger.error(f"❌ {len(leaked)} groups are in more than one split after the append, e.g. {leaked[:5]}")
+                
+            if content_hashed:
+                logger.warning(f"⚠️ {content_hashed} records without '{group_key}' were split by conversation content")
+            mode = ('appended' if append else 'hash split') + (f", stratified by '{stratify_key}'" if stratify_key else "")
+            logger.info(f"✅ Data split completed ({mode} by '{group_key}'):")
+            for name in SPLIT_NAMES:
+                logger.info(f"  {name.capitalize()}: +{counts[name]} samples -> {paths[name]} "
+                            f"({manifest['counts'][name]} total)")
+            for stratum, totals in sorted(manifest["strata"].items()):
+                total = sum(totals.values())
+                shares = ", ".join(f"{name} {totals[name] / total:.1%}" for name in SPLIT_NAMES)
+                logger.info(f"  {stratify_key}={stratum}: {total} samples ({shares})")
+                
+            return {**counts, "manifest": manifest}
             
         except Exception as e:
             logger.error(f"Error splitting data: {e}")
             raise
+            
+    @staticmethod
+    def _load_split_groups(groups_path: str) -> Dict[str, str]:
+        """Stored group -> split placement of a stratified split"""
+        if not os.path.exists(groups_path):
+            raise ValueError(f"Cannot append to a stratified split without {groups_path}, re-split without append")
+        with open(groups_path, 'r', encoding='utf-8') as f:
+            return dict(json.loads(line) for line in f if line.strip())
+            
+    @staticmethod
+    def find_split_leaks(output_dir: str, group_key: str) -> List[str]:
+        """Groups (by `group_key`, else conversation content) found in more than one of <output_dir>/{train,val,test}.jsonl"""
+        seen: Dict[str, str] = {}
+        leaked: Set[str] = set()
+        for name in SPLIT_NAMES:
+            path = os.path.join(output_dir, f"{name}.jsonl")
+            if not os.path.exists(path):
+                continue
+            for record in iter_records(path, skip_errors=True):
+                if not isinstance(record, dict):
+                    continue
+                group = record.get(group_key)
+                if group is None:
+                    group = json.dumps(record.get("conversations"), ensure_ascii=False, sort_keys=True)
+                if seen.setdefault(str(group), name) != name:
+                    leaked.add(str(group))
+        return sorted(leaked)
 
 
 def main():
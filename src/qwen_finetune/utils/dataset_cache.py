@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of tokenized training datasets
+Keys on the data file, chat template, tokenizer, max_seq_length and the
+dataset recipe; entries are stored as memory-mapped Arrow and shared by
+both trainers
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from typing import Dict, Optional, Any
+
+from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+# Bump when the formatting/tokenization code changes what gets cached
+CACHE_VERSION = 1
+
+META_FILENAME = "cache_meta.json"
+
+
+def file_fingerprint(path: str, chunk_size: int = 1 << 20) -> str:
+    """sha256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    sha256 of everything that changes token ids
+
+    Uses the fast tokenizer's serialized model/normalizer/pre-tokenizer
+    (ignoring runtime padding/truncation settings), so the same vocabulary
+    loaded from different repos (e.g. unsloth/... vs Qwen/...) shares entries.
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        state = json.loads(backend.to_str())
+        state.pop("padding", None)
+        state.pop("truncation", None)
+    else:
+        state = {
+            "vocab": sorted(tokenizer.get_vocab().items()),
+            "class": type(tokenizer).__name__,
+        }
+    state["special_tokens"] = sorted(str(token) for token in tokenizer.all_special_tokens)
+
+    return hashlib.sha256(json.dumps(state, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class TokenizedDatasetCache:
+    """On-disk cache of tokenized datasets (one `save_to_disk` directory per key)"""
+
+    def __init__(self, cache_dir: str = "cache/tokenized_datasets"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, data_path: str, template_text: str, tokenizer, max_seq_length: int,
+                 recipe: Optional[Dict[str, Any]] = None) -> str:
+        """Cache key for one (data, template, tokenizer, length, recipe) combination"""
+        parts = {
+            "version": CACHE_VERSION,
+            "data": file_fingerprint(data_path),
+            "template": hashlib.sha256(template_text.encode("utf-8")).hexdigest(),
+            "tokenizer": tokenizer_fingerprint(tokenizer),
+            "max_seq_length": max_seq_length,
+            "recipe": recipe or {},
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key: str) -> Optional[Dataset]:
+        """Memory-mapped dataset for `key`, or None on a miss"""
+        path = self.path(key)
+        if not os.path.exists(os.path.join(path, META_FILENAME)):
+            return None
+
+        start = time.time()
+        dataset = Dataset.load_from_disk(path)
+        logger.info(f"✅ Tokenized dataset cache hit: {path} ({len(dataset)} rows, {time.time() - start:.2f}s)")
+        return dataset
+
+    def save(self, key: str, dataset: Dataset, metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Write `dataset` under `key` (atomic rename, so concurrent runs never read partial entries)"""
+        path = self.path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+        dataset.save_to_disk(tmp_path)
+        with open(os.path.join(tmp_path, META_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump({
+                "key": key,
+                "num_rows": len(dataset),
+                "columns": dataset.column_names,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                **(metadata or {}),
+            }, f, ensure_ascii=False, indent=2)
+
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another run saved the same key first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        logger.info(f"Tokenized dataset cached: {path}")
+        return path
@@ -0,0 +1,639 @@
+#!/usr/bin/env python3
+"""
+Dataset I/O for conversation corpora
+JSONL as a first-class format next to JSON arrays, columnar Parquet / Arrow
+files (nested message lists, column projection, predicate filtering,
+memory-mapped reads), streaming converters and a streaming training dataset
+with a bounded shuffle buffer
+
+Usage:
+    python -m qwen_finetune.utils.dataset_io to-jsonl data/pika_data.json data/pika_data.jsonl
+    python -m qwen_finetune.utils.dataset_io convert data/pika_data.json data/pika_data.parquet
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import random
+import argparse
+import itertools
+import logging
+from typing import Dict, List, Iterator, Iterable, Callable, Optional, Set, Any
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:  # Record I/O works without torch; streaming training needs it
+    IterableDataset, get_worker_info = object, None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pads
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet / Arrow files need pyarrow (installed with datasets)
+    pa = pc = pads = pq = None
+
+logger = logging.getLogger(__name__)
+
+JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".arrow",)
+TABULAR_EXTENSIONS = (".xlsx", ".xls", ".csv")
+
+# Records per Parquet row group / Arrow record batch when writing
+COLUMNAR_BATCH_SIZE = 10000
+
+# Spreadsheet column holding the JSON conversation (parsed datasets)
+CONVERSATION_COLUMN = "BOT_RESPONSE_CONVERSATION_with_USER"
+
+# Element type of the `conversations` column; `target` is the multi-target flag.
+# Other turn keys in the data (e.g. ShareGPT from/value) are appended when writing
+TURN_TYPE = pa.struct([
+    ("role", pa.string()),
+    ("content", pa.string()),
+    ("target", pa.bool_()),
+]) if pa else None
+
+
+def is_jsonl(path: str) -> bool:
+    """True for line-delimited JSON files (by extension)"""
+    return path.lower().endswith(JSONL_EXTENSIONS)
+
+
+def is_parquet(path: str) -> bool:
+    return path.lower().endswith(PARQUET_EXTENSIONS)
+
+
+def is_arrow(path: str) -> bool:
+    return path.lower().endswith(ARROW_EXTENSIONS)
+
+
+def is_columnar(path: str) -> bool:
+    """True for Parquet / Arrow files (by extension)"""
+    return is_parquet(path) or is_arrow(path)
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("Parquet / Arrow datasets need pyarrow: pip install pyarrow")
+
+
+def _iter_json_array(f, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """Yield the elements of a top-level JSON array without loading the whole file"""
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size).lstrip("\ufeff \t\r\n")
+    if not buffer.startswith("["):
+        raise ValueError("Data must be a JSON array (or use .jsonl)")
+
+    pos, eof = 1, False
+    while True:
+        # Skip separators, refilling the buffer when it runs out
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+
+        if pos >= len(buffer):
+            raise ValueError("Unterminated JSON array")
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        yield item
+        pos = end
+
+
+def error_index_path(path: str) -> str:
+    """Where the validator writes the error index of a data file"""
+    return f"{path}.errors.json"
+
+
+def file_fingerprint(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_error_index(path: str) -> Optional[Set[int]]:
+    """
+    Indices of invalid records from the error index written by
+    `qwen_finetune.utils.validation` (None if there is none, or the data
+    file changed since it was validated)
+    """
+    index_path = error_index_path(path)
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get("fingerprint") != file_fingerprint(path):
+        logger.warning(f"Ignoring stale error index {index_path} (data changed since validation)")
+        return None
+    return {error["index"] for error in index["errors"]}
+
+
+def _invalid_indices(path: str, skip_invalid: bool, filters: Any = None) -> Optional[Set[int]]:
+    if not skip_invalid:
+        return None
+    invalid = load_error_index(path)
+    if invalid and filters is not None and is_columnar(path):
+        raise ValueError("skip_invalid cannot be combined with filters on Parquet / Arrow files")
+    if invalid:
+        logger.info(f"Skipping {len(invalid)} invalid records listed in {error_index_path(path)}")
+    return invalid
+
+
+def _iter_json_records(path: str, skip_errors: bool = False, skip: Optional[Set[int]] = None) -> Iterator[Dict[str, Any]]:
+    """Records of a JSON array / JSONL file; `skip` holds record indices (non-blank lines) to leave out"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if not is_jsonl(path):
+            for index, item in enumerate(_iter_json_array(f)):
+                if not skip or index not in skip:
+                    yield item
+            return
+
+        index = -1
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            index += 1
+            if skip and index in skip:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                if not skip_errors:
+                    raise ValueError(f"{path}:{line_number}: invalid JSON: {e}") from e
+                logger.warning(f"Skipping invalid JSON at {path}:{line_number}: {e}")
+
+
+def _filter_expression(filters: Any) -> Any:
+    """{column: value or list of values} (ANDed) as a pyarrow expression; expressions pass through"""
+    if filters is None or isinstance(filters, pc.Expression):
+        return filters
+
+    expression = None
+    for column, value in filters.items():
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        term = pc.field(column).isin(values)
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def _matches(record: Any, filters: Dict[str, Any]) -> bool:
+    """Dict filters applied to a JSON record"""
+    if not isinstance(record, dict):
+        return False
+    for column, value in filters.items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if record.get(column) not in values:
+            return False
+    return True
+
+
+def _clean_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the null struct fields Arrow adds to turns (e.g. `target` outside multi-target data)"""
+    turns = row.get("conversations")
+    if isinstance(turns, list):
+        row["conversations"] = [
+            {key: value for key, value in turn.items() if value is not None} if isinstance(turn, dict) else turn
+            for turn in turns
+        ]
+    return row
+
+
+def read_table(path: str, columns: Optional[List[str]] = None, filters: Any = None) -> "pa.Table":
+    """
+    Read a Parquet / Arrow file as an Arrow table
+
+    Arrow files are memory-mapped (zero-copy). Parquet reads decode only
+    `columns` and skip row groups whose statistics rule out `filters`
+    ({column: value or list of values}, or a pyarrow.compute expression).
+    """
+    _require_pyarrow()
+    expression = _filter_expression(filters)
+
+    if is_arrow(path):
+        table = pa.ipc.open_stream(pa.memory_map(path)).read_all()
+        if expression is not None:
+            table = table.filter(expression)
+        return table.select(columns) if columns else table
+
+    return pq.read_table(path, columns=columns, filters=expression, memory_map=True)
+
+
+def _iter_columnar(path: str, columns: Optional[List[str]] = None, filters: Any = None) -> Iterator[Dict[str, Any]]:
+    """Stream rows of a Parquet / Arrow file one record batch at a time"""
+    _require_pyarrow()
+    expression = _filter_expression(filters)
+
+    if is_arrow(path):
+        for batch in pa.ipc.open_stream(pa.memory_map(path)):
+            table = pa.Table.from_batches([batch])
+            if expression is not None:
+                table = table.filter(expression)
+            for row in (table.select(columns) if columns else table).to_pylist():
+                yield _clean_row(row)
+        return
+
+    for batch in pads.dataset(path, format="parquet").to_batches(columns=columns, filter=expression):
+        for row in batch.to_pylist():
+            yield _clean_row(row)
+
+
+def iter_records(path: str, skip_errors: bool = False, columns: Optional[List[str]] = None,
+                 filters: Any = None, skip_invalid: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    Stream records from a .json array, a .jsonl file or a Parquet / Arrow file
+
+    With `skip_errors`, malformed JSONL lines are logged and skipped instead
+    of raising. `columns` keeps only those fields and `filters` keeps records
+    matching {column: value or list of values}; for columnar files both are
+    pushed down to pyarrow (which also accepts a pyarrow.compute expression).
+    With `skip_invalid`, records listed in the file's error index are left
+    out without being parsed or re-validated.
+    """
+    invalid = _invalid_indices(path, skip_invalid, filters)
+
+    if is_columnar(path):
+        for index, record in enumerate(_iter_columnar(path, columns, filters)):
+            if not invalid or index not in invalid:
+                yield record
+        return
+
+    if filters is not None and not isinstance(filters, dict):
+        raise ValueError("Filter expressions need a Parquet / Arrow file, use a dict for JSON data")
+
+    for record in _iter_json_records(path, skip_errors, invalid):
+        if filters and not _matches(record, filters):
+            continue
+        yield {column: record.get(column) for column in columns} if columns and isinstance(record, dict) else record
+
+
+def load_records(path: str, columns: Optional[List[str]] = None, filters: Any = None,
+                 skip_invalid: bool = False) -> List[Dict[str, Any]]:
+    """Load all records from a .json array, a .jsonl file or a Parquet / Arrow file"""
+    if is_columnar(path):
+        invalid = _invalid_indices(path, skip_invalid, filters)
+        rows = read_table(path, columns, filters).to_pylist()
+        return [_clean_row(row) for index, row in enumerate(rows) if not invalid or index not in invalid]
+    return list(iter_records(path, columns=columns, filters=filters, skip_invalid=skip_invalid))
+
+
+def load_conversation_dataset(path: str, columns: Optional[List[str]] = None, filters: Any = None,
+                              skip_invalid: bool = False):
+    """
+    HF Dataset over a data file
+
+    Arrow files open memory-mapped without a copy, Parquet is decoded straight
+    into Arrow (no Python objects); JSON / JSONL go through Dataset.from_list.
+    With `skip_invalid`, rows in the file's error index are dropped.
+    """
+    from datasets import Dataset
+
+    if not is_columnar(path):
+        return Dataset.from_list(load_records(path, columns, filters, skip_invalid))
+
+    invalid = _invalid_indices(path, skip_invalid, filters)
+    if is_arrow(path) and filters is None:
+        dataset = Dataset.from_file(path)
+        dataset = dataset.select_columns(columns) if columns else dataset
+    else:
+        dataset = Dataset(read_table(path, columns, filters))
+    if invalid:
+        dataset = dataset.select([index for index in range(len(dataset)) if index not in invalid])
+    return dataset
+
+
+def _turns(records: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for record in records:
+        turns = record.get("conversations")
+        if isinstance(turns, list):
+            yield from (turn for turn in turns if isinstance(turn, dict))
+
+
+def _turn_type(records: List[Dict[str, Any]]) -> "pa.DataType":
+    """TURN_TYPE plus any other turn keys in the batch (a fixed struct would silently drop them)"""
+    extra = [key for key in dict.fromkeys(key for turn in _turns(records) for key in turn)
+             if TURN_TYPE.get_field_index(key) < 0]
+    if not extra:
+        return TURN_TYPE
+    inferred = pa.array([{key: turn.get(key) for key in extra} for turn in _turns(records)]).type
+    fields = [TURN_TYPE.field(i) for i in range(TURN_TYPE.num_fields)]
+    for field in (inferred.field(i) for i in range(inferred.num_fields)):
+        fields.append(field.with_type(pa.string()) if pa.types.is_null(field.type) else field)
+    return pa.struct(fields)
+
+
+def _columnar_schema(records: List[Dict[str, Any]]) -> "pa.Schema":
+    """Schema inferred from the first batch: conversations as a turn struct, all-null columns as strings"""
+    # from_pylist alone would only take the keys of the first record
+    keys = list(dict.fromkeys(key for record in records for key in record))
+    fields = []
+    for field in pa.Table.from_pydict({key: [record.get(key) for record in records] for key in keys}).schema:
+        if field.name == "conversations":
+            field = pa.field(field.name, pa.list_(_turn_type(records)))
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _write_columnar(records: Iterable[Dict[str, Any]], path: str, batch_size: int = COLUMNAR_BATCH_SIZE) -> int:
+    """Write records as zstd Parquet or as an Arrow stream (the format HF datasets memory-maps)"""
+    _require_pyarrow()
+    records = iter(records)
+    writer, schema = None, None
+    dropped: set = set()
+    dropped_turn_keys: set = set()
+    count = 0
+
+    try:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            if schema is None:
+                schema = _columnar_schema(batch)
+                writer = (pq.ParquetWriter(path, schema, compression="zstd") if is_parquet(path)
+                          else pa.ipc.new_stream(path, schema))
+
+            extra = {key for record in batch for key in record} - set(schema.names) - dropped
+            if extra:
+                logger.warning(f"Fields missing from the first {batch_size} records are not written: {sorted(extra)}")
+                dropped |= extra
+            if "conversations" in schema.names:
+                turn_type = schema.field("conversations").type.value_type
+                extra = {key for turn in _turns(batch) for key in turn
+                         if turn_type.get_field_index(key) < 0} - dropped_turn_keys
+                if extra:
+                    logger.warning(f"Turn fields missing from the first {batch_size} records are not written: {sorted(extra)}")
+                    dropped_turn_keys |= extra
+
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        empty = pa.schema([pa.field("conversations", pa.list_(TURN_TYPE))]).empty_table()
+        if is_parquet(path):
+            pq.write_table(empty, path)
+        else:
+            with pa.ipc.new_stream(path, empty.schema) as stream:
+                stream.write_table(empty)
+    return count
+
+
+def write_records(records: Iterable[Dict[str, Any]], path: str) -> int:
+    """
+    Write records as JSONL (.jsonl), Parquet (.parquet), an Arrow stream (.arrow)
+    or an indented JSON array (anything else); returns the count
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if is_columnar(path):
+        return _write_columnar(records, path)
+
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        if is_jsonl(path):
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+        else:
+            f.write("[")
+            for record in records:
+                # Same layout as json.dump(records, indent=2), written incrementally
+                f.write(",\n  " if count else "\n  ")
+                f.write(json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+                count += 1
+            f.write("\n]" if count else "]")
+    return count
+
+
+def convert_json_to_jsonl(input_path: str, output_path: str) -> int:
+    """Stream a JSON array file into JSONL (one record per line)"""
+    count = write_records(iter_records(input_path), output_path)
+    logger.info(f"✅ Converted {count} records: {input_path} -> {output_path}")
+    return count
+
+
+def iter_tabular_records(path: str, columns: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Conversation records from our parsed .xlsx / .csv exports
+
+    `conversations` is parsed from the JSON conversation column (or built
+    from last_robot_answer / last_user_answer); the other columns are kept
+    as-is, by default every column with a plain identifier name.
+    """
+    import re
+    import pandas as pd
+
+    df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_excel(path)
+    if columns is None:
+        columns = [
+            column for column in df.columns
+            if isinstance(column, str) and re.fullmatch(r"[A-Za-z_]\w*", column)
+            and column != CONVERSATION_COLUMN and not column.startswith("Unnamed")
+        ]
+    df = df.astype(object).where(df.notna(), None)
+
+    for row in df.to_dict(orient="records"):
+        conversation = None
+        if isinstance(row.get(CONVERSATION_COLUMN), str):
+            try:
+                conversation = json.loads(row[CONVERSATION_COLUMN])
+            except json.JSONDecodeError:
+                conversation = None
+        if not isinstance(conversation, list):
+            robot, user = row.get("last_robot_answer"), row.get("last_user_answer")
+            conversation = []
+            if isinstance(robot, str) and isinstance(user, str):
+                conversation = [{"role": "assistant", "content": robot}, {"role": "user", "content": user}]
+
+        yield {"conversations": conversation, **{column: row.get(column) for column in columns}}
+
+
+def convert_records(input_path: str, output_path: str, columns: Optional[List[str]] = None,
+                    filters: Any = None) -> int:
+    """Stream any supported input (.json/.jsonl/.parquet/.arrow/.xlsx/.csv) into any output format"""
+    if input_path.lower().endswith(TABULAR_EXTENSIONS):
+        records = iter_tabular_records(input_path, columns)
+        if filters:
+            records = (record for record in records if _matches(record, filters))
+    else:
+        records = iter_records(input_path, columns=columns, filters=filters)
+
+    count = write_records(records, output_path)
+    logger.info(f"✅ Converted {count} records: {input_path} ({os.path.getsize(input_path) / 1e6:.1f} MB) -> "
+                f"{output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+    return count
+
+
+class JsonlConversationStream(IterableDataset):
+    """
+    Streaming training dataset over a JSONL file
+
+    - Records are read line by line and passed through `transform`
+      (returning None drops the record)
+    - Dataloader workers own disjoint lines (line_index % num_workers),
+      so sharding is deterministic and nothing is read twice
+    - A bounded shuffle buffer, seeded by (seed, epoch, worker), gives
+      reproducible approximate shuffling; call set_epoch() to reshuffle
+    """
+
+    def __init__(self, path: str, transform: Optional[Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]] = None,
+                 shuffle_buffer_size: int = 10000, seed: int = 3407):
+        if not is_jsonl(path):
+            raise ValueError(f"Streaming needs a JSONL file (convert with `to-jsonl`): {path}")
+
+        self.path = path
+        self.transform = transform
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _iter_shard(self, worker_id: int, num_workers: int) -> Iterator[Dict[str, Any]]:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_index, line in enumerate(f):
+                if line_index % num_workers != worker_id or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Skipping invalid JSON at {self.path}:{line_index + 1}: {e}")
+                    continue
+
+                sample = self.transform(record) if self.transform else record
+                if sample is not None:
+                    yield sample
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        samples = self._iter_shard(worker_id, num_workers)
+
+        if self.shuffle_buffer_size <= 1:
+            yield from samples
+            return
+
+        rng = random.Random(hash((self.seed, self.epoch, worker_id)))
+        buffer: List[Dict[str, Any]] = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            index = rng.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def build_streaming_dataset(tokenizer, path: str, max_length: int, multi_target: bool = False,
+                            multi_target_attention: str = "window", shuffle_buffer_size: int = 10000, seed: int = 3407) -> JsonlConversationStream:
+    """Streaming dataset yielding tokenized samples (plain ChatML or multi-target)"""
+    from qwen_finetune.utils.formatting import ChatTemplateFormatter, tokenize_texts
+    from qwen_finetune.utils.multi_target import encode_multi_target, normalize_multi_target_conversation
+    from qwen_finetune.utils.packing import IGNORE_INDEX
+
+    formatter = ChatTemplateFormatter(tokenizer)
+
+    def plain_sample(record):
+        texts = formatter.format_batch([record.get("conversations")]) if isinstance(record, dict) else []
+        if not texts:
+            return None
+        tokenized = tokenize_texts(tokenizer, texts, max_length)
+        return {key: values[0] for key, values in tokenized.items()}
+
+    def multi_target_sample(record):
+        convo = normalize_multi_target_conversation(record.get("conversations") if isinstance(record, dict) else None)
+        if not any(turn["target"] for turn in convo):
+            return None
+        encoded = encode_multi_target(
+            tokenizer, convo, max_length,
+            compact_positions=multi_target_attention == "window", formatter=formatter,
+        )
+        if all(label == IGNORE_INDEX for label in encoded["labels"]):
+            return None
+        if multi_target_attention != "window":
+            return {"input_ids": encoded["input_ids"], "labels": encoded["labels"]}
+        return encoded
+
+    logger.info(f"Streaming dataset from {path} (shuffle buffer {shuffle_buffer_size})")
+    return JsonlConversationStream(
+        path,
+        transform=multi_target_sample if multi_target else plain_sample,
+        shuffle_buffer_size=shuffle_buffer_size,
+        seed=seed,
+    )
+
+
+def main():
+    """Dataset I/O CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Conversation dataset I/O")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    to_jsonl = subparsers.add_parser("to-jsonl", help="Convert a JSON array file to JSONL (streaming)")
+    to_jsonl.add_argument("input")
+    to_jsonl.add_argument("output")
+
+    convert = subparsers.add_parser("convert", help="Convert between .json/.jsonl/.parquet/.arrow (and from .xlsx/.csv)")
+    convert.add_argument("input")
+    convert.add_argument("output")
+    convert.add_argument("--columns", nargs="+", default=None, help="Columns to keep (default: all)")
+    convert.add_argument("--filter", nargs="+", default=[], metavar="COLUMN=VALUE",
+                         help="Keep matching records (repeat a column to allow several values)")
+
+    count = subparsers.add_parser("count", help="Count records in a .json/.jsonl/.parquet/.arrow file")
+    count.add_argument("input")
+
+    args = parser.parse_args()
+
+    if args.command == "to-jsonl":
+        convert_json_to_jsonl(args.input, args.output)
+    elif args.command == "convert":
+        filters: Dict[str, List[str]] = {}
+        for item in args.filter:
+            column, _, value = item.partition("=")
+            try:
+                value = json.loads(value)  # numbers / booleans, e.g. conversationID=12345
+            except json.JSONDecodeError:
+                pass
+            filters.setdefault(column, []).append(value)
+        convert_records(args.input, args.output, columns=args.columns, filters=filters or None)
+    elif args.command == "count":
+        if is_parquet(args.input):
+            print(pq.ParquetFile(args.input).metadata.num_rows)
+        else:
+            print(sum(1 for _ in iter_records(args.input)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate removal for conversation data
+MinHash signatures over word shingles of the normalized conversation text
+(system prompt excluded), LSH banding to find candidates and a streaming
+single pass that keeps the first sample of every near-duplicate cluster.
+A sample is only a duplicate if its final turn matches as well, so the same
+context with a different kid reply or target is kept. The LSH index can
+live in memory or in SQLite for datasets larger than RAM.
+
+Usage:
+    python -m qwen_finetune.utils.dedup data/pika_data.jsonl data/pika_data.dedup.jsonl --threshold 0.8
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import argparse
+import logging
+import unicodedata
+from typing import Dict, List, Iterator, Optional, Tuple, Any
+
+import numpy as np
+
+from .dataset_io import iter_records, write_records
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+PREVIEW_CHARS = 120  # End of the text (the last turns) shown per sample in the report
+MAX_REPORTED_MEMBERS = 20  # Removed samples kept per cluster for the report (the rest are only counted)
+
+
+def conversation_lines(record: Dict[str, Any]) -> List[str]:
+    """Lowercased, NFC-normalized non-system turns as "role: content" (punctuation dropped)"""
+    lines = []
+    for turn in record.get("conversations") or []:
+        if not isinstance(turn, dict) or str(turn.get("role", "")).lower() == "system":
+            continue
+        words = _WORD_RE.findall(unicodedata.normalize("NFC", str(turn.get("content", ""))).lower())
+        lines.append(f"{turn.get('role', 'user')}: {' '.join(words)}")
+    return lines
+
+
+def shingles(text: str, size: int = 3) -> np.ndarray:
+    """32-bit hashes of word `size`-grams (the whole text when it is shorter)"""
+    words = text.split()
+    grams = [" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))]
+    return np.unique(np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64))
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows) with bands x rows <= num_perm whose S-curve midpoint (1/b)^(1/r) is closest to threshold"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        midpoint = (1 / bands) ** (1 / rows)
+        # Slightly favour recall: a candidate is verified on the full signature anyway
+        error = abs(midpoint - threshold) + (0.01 if midpoint > threshold else 0)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """MinHash with `num_perm` universal hash permutations (same seed = same signatures)"""
+
+    def __init__(self, num_perm: int = 128, seed: int = 3407):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        # uint64 arithmetic wraps around; as in datasketch this is still a good permutation family
+        with np.errstate(over="ignore"):
+            permuted = (hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    return float(np.mean(sig_a == sig_b))
+
+
+class MemoryLSHIndex:
+    """Band buckets and signatures of kept samples, in memory"""
+
+    def __init__(self):
+        self.buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self.signatures: Dict[int, np.ndarray] = {}
+        self.previews: Dict[int, str] = {}
+        self.cluster_sizes: Dict[int, int] = {}
+        self.members: Dict[int, List[Dict[str, Any]]] = {}
+
+    def candidates(self, band_keys: List[bytes]) -> List[int]:
+        found = []
+        for band, key in enumerate(band_keys):
+            found.extend(self.buckets.get((band, key), ()))
+        return list(dict.fromkeys(found))
+
+    def signature(self, doc_id: int) -> np.ndarray:
+        return self.signatures[doc_id]
+
+    def preview(self, doc_id: int) -> str:
+        return self.previews.get(doc_id, "")
+
+    def add(self, doc_id: int, band_keys: List[bytes], signature: np.ndarray, preview: str) -> None:
+        for band, key in enumerate(band_keys):
+            self.buckets.setdefault((band, key), []).append(doc_id)
+        self.signatures[doc_id] = signature
+        self.previews[doc_id] = preview
+
+    def add_duplicate(self, representative: int, member: Dict[str, Any]) -> None:
+        self.cluster_sizes[representative] = self.cluster_sizes.get(representative, 0) + 1
+        members = self.members.setdefault(representative, [])
+        if len(members) < MAX_REPORTED_MEMBERS:
+            members.append(member)
+
+    def num_clusters(self) -> int:
+        return len(self.cluster_sizes)
+
+    def largest_clusters(self, limit: int) -> List[Tuple[int, int, List[Dict[str, Any]]]]:
+        """(representative, removed count, first removed samples), largest first"""
+        largest = sorted(self.cluster_sizes.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(rep, count, self.members[rep]) for rep, count in largest]
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteLSHIndex:
+    """Same index in a SQLite file, so memory stays flat however large the dataset is"""
+
+    def __init__(self, path: str, commit_every: int = 10000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE buckets (band INTEGER, key BLOB, doc INTEGER)")
+        self.conn.execute("CREATE INDEX buckets_key ON buckets (band, key)")
+        self.conn.execute("CREATE TABLE docs (doc INTEGER PRIMARY KEY, signature BLOB, preview TEXT, removed INTEGER)")
+        self.conn.execute("CREATE TABLE members (rep INTEGER, doc INTEGER, similarity REAL, preview TEXT)")
+        self.conn.execute("CREATE INDEX members_rep ON members (rep)")
+        self.commit_every = commit_every
+        self._pending = 0
+
+    def candidates(self, band_keys: List[bytes]) -> List[int]:
+        found = []
+        for band, key in enumerate(band_keys):
+            found.extend(row[0] for row in self.conn.execute(
+                "SELECT doc FROM buckets WHERE band = ? AND key = ?", (band, key)
+            ))
+        return list(dict.fromkeys(found))
+
+    def signature(self, doc_id: int) -> np.ndarray:
+        row = self.conn.execute("SELECT signature FROM docs WHERE doc = ?", (doc_id,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.uint32)
+
+    def preview(self, doc_id: int) -> str:
+        row = self.conn.execute("SELECT preview FROM docs WHERE doc = ?", (doc_id,)).fetchone()
+        return row[0] if row else ""
+
+    def add(self, doc_id: int, band_keys: List[bytes], signature: np.ndarray, preview: str) -> None:
+        self.conn.executemany(
+            "INSERT INTO buckets VALUES (?, ?, ?)",
+            [(band, key, doc_id) for band, key in enumerate(band_keys)],
+        )
+        self.conn.execute("INSERT INTO docs VALUES (?, ?, ?, 0)", (doc_id, signature.tobytes(), preview))
+        self._tick()
+
+    def _tick(self) -> None:
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.conn.commit()
+            self._pending = 0
+
+    def add_duplicate(self, representative: int, member: Dict[str, Any]) -> None:
+        self.conn.execute("UPDATE docs SET removed = removed + 1 WHERE doc = ?", (representative,))
+        count = self.conn.execute("SELECT removed FROM docs WHERE doc = ?", (representative,)).fetchone()[0]
+        if count <= MAX_REPORTED_MEMBERS:
+            self.conn.execute(
+                "INSERT INTO members VALUES (?, ?, ?, ?)",
+                (representative, member["id"], member["similarity"], member["preview"]),
+            )
+        self._tick()
+
+    def num_clusters(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM docs WHERE removed > 0").fetchone()[0]
+
+    def largest_clusters(self, limit: int) -> List[Tuple[int, int, List[Dict[str, Any]]]]:
+        """(representative, removed count, first removed samples), largest first"""
+        largest = self.conn.execute(
+            "SELECT doc, removed FROM docs WHERE removed > 0 ORDER BY removed DESC, doc LIMIT ?", (limit,)
+        ).fetchall()
+        return [
+            (rep, count, [
+                {"id": doc, "similarity": similarity, "preview": preview}
+                for doc, similarity, preview in self.conn.execute(
+                    "SELECT doc, similarity, preview FROM members WHERE rep = ? ORDER BY doc", (rep,)
+                )
+            ])
+            for rep, count in largest
+        ]
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate filter
+
+    Every sample gets two signatures: the whole conversation and its final
+    turn. The first is split into LSH bands; samples sharing a band with an
+    earlier kept sample are candidates, and a candidate whose estimated
+    Jaccard similarity reaches `threshold` on both signatures marks the
+    sample as a duplicate of that kept sample (its cluster representative).
+    Only kept samples are indexed.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 3,
+                 index_path: Optional[str] = None, seed: int = 3407):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.index = SqliteLSHIndex(index_path) if index_path else MemoryLSHIndex()
+
+        self.seen = 0
+        self.kept = 0
+
+    def band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).digest()
+            for band in range(self.bands)
+        ]
+
+    def check(self, record: Dict[str, Any]) -> Optional[Tuple[int, float]]:
+        """(representative id, similarity) if the record duplicates a kept one, else None (and index it)"""
+        doc_id = self.seen
+        self.seen += 1
+
+        lines = conversation_lines(record)
+        text = "\n".join(lines)
+        num_perm = self.hasher.num_perm
+        signature = np.concatenate([
+            self.hasher.signature(shingles(text, self.shingle_size)),
+            self.hasher.signature(shingles(lines[-1] if lines else "", self.shingle_size)),
+        ])
+        band_keys = self.band_keys(signature[:num_perm])
+
+        best = None
+        for candidate in self.index.candidates(band_keys):
+            other = self.index.signature(candidate)
+            score = similarity(signature[:num_perm], other[:num_perm])
+            last_turn_score = similarity(signature[num_perm:], other[num_perm:])
+            if min(score, last_turn_score) >= self.threshold and (best is None or score > best[1]):
+                best = (candidate, score)
+
+        if best is not None:
+            # Clusters live in the index: only counts and the first few members per representative
+            self.index.add_duplicate(
+                best[0], {"id": doc_id, "similarity": round(best[1], 3), "preview": text[-PREVIEW_CHARS:]}
+            )
+            return best
+
+        self.index.add(doc_id, band_keys, signature, text[-PREVIEW_CHARS:])
+        self.kept += 1
+        return None
+
+    def filter(self, records: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Yield the records that are not near-duplicates of an earlier one"""
+        for record in records:
+            if self.check(record) is None:
+                yield record
+
+    def report(self, max_clusters: int = 200) -> Dict[str, Any]:
+        """Totals plus the largest removed clusters (representative and removed samples)"""
+        removed = self.seen - self.kept
+        return {
+            "threshold": self.threshold,
+            "num_perm": self.hasher.num_perm,
+            "bands": self.bands,
+            "rows_per_band": self.rows,
+            "total": self.seen,
+            "kept": self.kept,
+            "removed": removed,
+            "removed_fraction": round(removed / max(self.seen, 1), 4),
+            "clusters": self.index.num_clusters(),
+            "largest_clusters": [
+                {
+                    "representative_id": rep,
+                    "representative": self.index.preview(rep),
+                    "size": count + 1,
+                    "removed": members,
+                }
+                for rep, count, members in self.index.largest_clusters(max_clusters)
+            ],
+        }
+
+    def close(self) -> None:
+        self.index.close()
+
+
+def _label(record: Dict[str, Any]) -> Optional[str]:
+    label = record.get("user_intent", record.get("intent"))
+    return str(label).strip().lower() if label is not None else None
+
+
+def deduplicate_file(input_path: str, output_path: str, threshold: float = 0.8, num_perm: int = 128,
+                     shingle_size: int = 3, index_path: Optional[str] = None,
+                     report_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Stream `input_path` into `output_path` without near-duplicates and write a cluster report
+
+    Records are read and written one at a time (.json array or .jsonl);
+    with `index_path` the LSH index is kept in SQLite instead of memory.
+    Label counts (user_intent / intent) before and after are in the report
+    to check that coverage is kept.
+    """
+    start = time.time()
+    dedup = NearDuplicateFilter(threshold, num_perm, shingle_size, index_path)
+    labels_before: Dict[str, int] = {}
+    labels_after: Dict[str, int] = {}
+
+    def records() -> Iterator[Dict[str, Any]]:
+        for record in iter_records(input_path, skip_errors=True):
+            label = _label(record)
+            if label:
+                labels_before[label] = labels_before.get(label, 0) + 1
+            if dedup.check(record) is None:
+                if label:
+                    labels_after[label] = labels_after.get(label, 0) + 1
+                yield record
+            if dedup.seen % 10000 == 0:
+                logger.info(f"   {dedup.seen} samples, {dedup.seen - dedup.kept} near-duplicates")
+
+    try:
+        write_records(records(), output_path)
+        report = dedup.report()
+    finally:
+        dedup.close()
+
+    report.update({"input_path": input_path, "output_path": output_path, "time_s": round(time.time() - start, 1)})
+    if labels_before:
+        report["labels_before"] = labels_before
+        report["labels_after"] = labels_after
+
+    report_path = report_path or os.path.splitext(output_path)[0] + ".dedup_report.json"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    logger.info(f"✅ Dedup: kept {report['kept']}/{report['total']} samples "
+                f"({report['removed']} near-duplicates in {report['clusters']} clusters, "
+                f"threshold {threshold}) -> {output_path}")
+    logger.info(f"   Report: {report_path}")
+    return report
+
+
+def main():
+    """Dedup CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Remove near-duplicate conversations (MinHash LSH)")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity to count as duplicate")
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--shingle-size", type=int, default=3, help="Words per shingle")
+    parser.add_argument("--index-path", default=None, help="SQLite file for the LSH index (datasets larger than RAM)")
+    parser.add_argument("--report", default=None, help="Default: <output>.dedup_report.json")
+    args = parser.parse_args()
+
+    deduplicate_file(args.input, args.output, args.threshold, args.num_perm, args.shingle_size,
+                     args.index_path, args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Shared chat formatting and tokenization stage
+Role normalization, chat-template rendering without Jinja for ChatML-style
+templates, batched tokenization and automatic num_proc sizing, used by both
+trainers and the server
+
+Usage (throughput benchmark):
+    python -m qwen_finetune.utils.formatting --data data/pika_data.json \
+        --tokenizer Qwen/Qwen2.5-7B-Instruct --template data/chat_template.txt
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+from typing import Dict, List, Optional, Any
+
+from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+ROLE_ALIASES = {
+    "system": "system",
+    "user": "user",
+    "human": "user",
+    "assistant": "assistant",
+    "gpt": "assistant",
+    "bot": "assistant",
+}
+
+# Placeholder contents used to probe a chat template's structure
+_PROBE_CONTENT = "\x00PROBE{}\x00"
+
+
+def normalize_role(role: Any) -> str:
+    """Map role aliases to system/user/assistant (unknown roles become user)"""
+    return ROLE_ALIASES.get(str(role).strip().lower(), "user")
+
+
+def normalize_conversation(convo: Any) -> List[Dict[str, str]]:
+    """Keep valid turns with normalized roles and stripped content"""
+    if not isinstance(convo, list):
+        return []
+
+    return [
+        {"role": normalize_role(turn["role"]), "content": str(turn["content"]).strip()}
+        for turn in convo
+        if isinstance(turn, dict) and "role" in turn and "content" in turn
+    ]
+
+
+def render_chatml(messages: List[Any], add_generation_prompt: bool = False) -> str:
+    """Canonical ChatML prompt (messages may be dicts or objects with role/content)"""
+    parts = []
+    for message in messages:
+        role = message.get("role") if isinstance(message, dict) else message.role
+        content = message.get("content") if isinstance(message, dict) else message.content
+        parts.append(f"<|im_start|>{normalize_role(role)}\n{content}<|im_end|>\n")
+
+    if add_generation_prompt:
+        parts.append("<|im_start|>assistant\n")
+    return "".join(parts)
+
+
+class ChatTemplateFormatter:
+    """
+    Render conversations with the tokenizer's chat template
+
+    At construction the template is probed: if every message renders as
+    `prefix[role] + content + suffix[role]` independently of its neighbours
+    (true for our ChatML template), rendering is plain string concatenation.
+    Otherwise every call goes through Jinja (`apply_chat_template`).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._parts: Optional[Dict[str, tuple]] = None
+        self._generation_suffix = ""
+        self._compile()
+
+    @property
+    def is_fast(self) -> bool:
+        return self._parts is not None
+
+    def _jinja(self, messages: List[Dict[str, str]], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt
+        )
+
+    def _compile(self) -> None:
+        try:
+            parts = {}
+            for role in ("system", "user", "assistant"):
+                rendered = self._jinja([{"role": role, "content": _PROBE_CONTENT.format(0)}], False)
+                prefix, sep, suffix = rendered.partition(_PROBE_CONTENT.format(0))
+                if not sep or _PROBE_CONTENT.format(0) in suffix:
+                    return
+                parts[role] = (prefix, suffix)
+
+            probe = [
+                {"role": role, "content": _PROBE_CONTENT.format(i)}
+                for i, role in enumerate(["system", "user", "assistant", "user", "assistant", "user"])
+            ]
+            plain = self._jinja(probe, False)
+            with_prompt = self._jinja(probe, True)
+            self._parts = parts
+
+            if self.render(probe) != plain or not with_prompt.startswith(plain):
+                self._parts = None
+                return
+            self._generation_suffix = with_prompt[len(plain):]
+        except Exception as e:
+            self._parts = None
+            logger.warning(f"Chat template probe failed, using Jinja rendering: {e}")
+        finally:
+            logger.info(f"Chat formatting: {'fast path (no Jinja)' if self.is_fast else 'Jinja template'}")
+
+    def render(self, messages: List[Dict[str, str]], add_generation_prompt: bool = False) -> str:
+        """Render normalized messages exactly as apply_chat_template would"""
+        if self._parts is None:
+            return self._jinja(messages, add_generation_prompt)
+
+        text = "".join(
+            self._parts[message["role"]][0] + message["content"] + self._parts[message["role"]][1]
+            for message in messages
+        )
+        return text + self._generation_suffix if add_generation_prompt else text
+
+    def format_batch(self, convos: List[Any]) -> List[str]:
+        """Normalize and render a batch of conversations (invalid/empty ones are dropped)"""
+        texts = []
+        for convo in convos:
+            messages = normalize_conversation(convo)
+            if messages:
+                texts.append(self.render(messages))
+        return texts
+
+
+def auto_num_proc(num_rows: int, rows_per_proc: int = 2000, max_proc: Optional[int] = None) -> Optional[int]:
+    """Worker count for datasets.map: None (in-process) for small datasets, else up to the CPU count"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    num_proc = min(cpus, max_proc or cpus, num_rows // rows_per_proc)
+    return num_proc if num_proc > 1 else None
+
+
+def format_dataset(tokenizer, dataset: Dataset, text_field: str = "text",
+                   num_proc: Optional[int] = None) -> Dataset:
+    """Turn a dataset with a `conversations` column into rendered texts"""
+    formatter = ChatTemplateFormatter(tokenizer)
+    num_proc = num_proc or auto_num_proc(len(dataset))
+
+    formatted = dataset.map(
+        lambda batch: {text_field: formatter.format_batch(batch["conversations"])},
+        batched=True,
+        batch_size=1000,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        desc="Formatting conversations",
+    )
+    return formatted.filter(lambda x: len(x[text_field].strip()) > 0, num_proc=num_proc)
+
+
+def tokenize_texts(tokenizer, texts: List[str], max_length: int) -> Dict[str, List[List[int]]]:
+    """Batched causal-LM tokenization (labels = input_ids)"""
+    tokenized = tokenizer(
+        texts,
+        truncation=True,
+        padding=False,
+        max_length=max_length,
+        return_overflowing_tokens=False,
+    )
+    tokenized["labels"] = [list(ids) for ids in tokenized["input_ids"]]
+    return tokenized
+
+
+def tokenize_text_dataset(tokenizer, dataset: Dataset, max_length: int, text_field: str = "text",
+                          num_proc: Optional[int] = None) -> Dataset:
+    """Tokenize a formatted-text dataset in batches"""
+    return dataset.map(
+        lambda batch: tokenize_texts(tokenizer, batch[text_field], max_length),
+        batched=True,
+        batch_size=1000,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc or auto_num_proc(len(dataset)),
+        desc="Tokenizing dataset",
+    )
+
+
+def benchmark(tokenizer, convos: List[Any], max_length: int = 2048, num_proc: Optional[int] = None) -> Dict[str, Any]:
+    """Samples/s of Jinja vs. fast formatting, batched tokenization and the full datasets pipeline"""
+    formatter = ChatTemplateFormatter(tokenizer)
+    results: Dict[str, Any] = {"samples": len(convos), "fast_path": formatter.is_fast}
+
+    def rate(start: float) -> float:
+        return len(convos) / max(time.perf_counter() - start, 1e-9)
+
+    normalized = [normalize_conversation(convo) for convo in convos]
+
+    start = time.perf_counter()
+    jinja_texts = [formatter._jinja(messages, False) for messages in normalized if messages]
+    results["jinja_format_samples_per_s"] = rate(start)
+
+    start = time.perf_counter()
+    texts = formatter.format_batch(convos)
+    results["fast_format_samples_per_s"] = rate(start)
+    results["fast_matches_jinja"] = texts == jinja_texts
+
+    start = time.perf_counter()
+    for i in range(0, len(texts), 1000):
+        tokenize_texts(tokenizer, texts[i:i + 1000], max_length)
+    results["batched_tokenize_samples_per_s"] = rate(start)
+
+    dataset = Dataset.from_list([{"conversations": convo} for convo in convos])
+    results["num_proc"] = num_proc or auto_num_proc(len(dataset))
+    start = time.perf_counter()
+    tokenize_text_dataset(tokenizer, format_dataset(tokenizer, dataset, num_proc=num_proc), max_length, num_proc=num_proc)
+    results["pipeline_samples_per_s"] = rate(start)
+
+    return results
+
+
+def main():
+    """Formatting/tokenization throughput benchmark CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Benchmark chat formatting and tokenization throughput")
+    parser.add_argument("--data", default="data/pika_data.json", help="JSON list with a 'conversations' field")
+    parser.add_argument("--tokenizer", default="Qwen/Qwen2.5-7B-Instruct")
+    parser.add_argument("--template", default="data/chat_template.txt")
+    parser.add_argument("--max-length", type=int, default=2048)
+    parser.add_argument("--num-proc", type=int, default=None, help="Default: sized automatically")
+    parser.add_argument("--repeat", type=int, default=1, help="Repeat the data N times for a larger benchmark")
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    if os.path.exists(args.template):
+        with open(args.template, 'r', encoding='utf-8') as f:
+            tokenizer.chat_template = f.read().strip()
+
+    with open(args.data, 'r', encoding='utf-8') as f:
+        convos = [item.get("conversations") for item in json.load(f) if isinstance(item, dict)] * args.repeat
+
+    results = benchmark(tokenizer, convos, args.max_length, args.num_proc)
+
+    print(f"\n📊 Formatting benchmark ({results['samples']} samples, num_proc={results['num_proc']})")
+    print(f"   Jinja format:        {results['jinja_format_samples_per_s']:,.0f} samples/s")
+    print(f"   Fast format:         {results['fast_format_samples_per_s']:,.0f} samples/s "
+          f"(fast path: {results['fast_path']}, identical output: {results['fast_matches_jinja']})")
+    print(f"   Batched tokenize:    {results['batched_tokenize_samples_per_s']:,.0f} samples/s")
+    print(f"   Format + tokenize:   {results['pipeline_samples_per_s']:,.0f} samples/s (datasets pipeline)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Incremental dataset builds
+Runs convert -> validate -> split -> format -> tokenize over one or more
+sources, caching each item's converted record and token ids in SQLite under
+a fingerprint of its content, so a refresh only converts and tokenizes new or
+changed items. Splits use the same conversation hash as
+`DataProcessor.split_data(group_key=...)`, tokenized splits are registered in
+the trainers' tokenized-dataset cache, and entries no longer produced by a
+build are garbage-collected
+
+Usage:
+    python -m qwen_finetune.utils.incremental data/pika_data.json exports/2025-08-*.jsonl \
+        --output-dir data/build --tokenizer Qwen/Qwen2.5-7B-Instruct
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import itertools
+import logging
+from typing import Dict, List, Iterable, Iterator, Optional, Tuple, Any
+
+import numpy as np
+
+from .dataset_io import iter_records, iter_tabular_records, TABULAR_EXTENSIONS
+from .data_processor import DataProcessor, SPLIT_NAMES, hash_split
+from .validation import check_record
+
+logger = logging.getLogger(__name__)
+
+# Bump when conversion/validation changes what gets cached per item
+CONVERT_VERSION = 1
+
+MANIFEST_NAME = "build_manifest.json"
+
+# Source fields consumed by the format converters; other scalar fields are kept as metadata
+FORMAT_FIELDS = {"conversations", "instruction", "input", "output"}
+
+# The trainers' recipe for plain (unpacked, single-target) tokenized datasets
+PLAIN_RECIPE = {"packing": False, "multi_target": False}
+
+MAX_INVALID_EXAMPLES = 20
+SQLITE_MAX_PARAMS = 500
+
+
+def item_key(item: Any, input_format: str) -> str:
+    """Content fingerprint of a source item (and the conversion settings applied to it)"""
+    canonical = json.dumps(item, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{CONVERT_VERSION}:{input_format}:{canonical}".encode("utf-8")).hexdigest()[:32]
+
+
+def iter_source(path: str) -> Iterator[Any]:
+    """Records of a data file, including the parsed .xlsx / .csv exports"""
+    if path.lower().endswith(TABULAR_EXTENSIONS):
+        return iter_tabular_records(path)
+    return iter_records(path, skip_errors=True)
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ItemCache:
+    """SQLite store of converted records and token ids, keyed by item fingerprint"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS records "
+            "(key TEXT PRIMARY KEY, record TEXT, problem TEXT, last_seen INTEGER)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens "
+            "(key TEXT, recipe TEXT, input_ids BLOB, last_seen INTEGER, PRIMARY KEY (key, recipe))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS builds (build INTEGER PRIMARY KEY, created_at TEXT)")
+
+    def next_build(self) -> int:
+        cursor = self.conn.execute("INSERT INTO builds (created_at) VALUES (?)", (time.strftime("%Y-%m-%d %H:%M:%S"),))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def _select(self, query: str, keys: List[str], *params: Any) -> List[Tuple]:
+        rows = []
+        for begin in range(0, len(keys), SQLITE_MAX_PARAMS):
+            chunk = keys[begin:begin + SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(self.conn.execute(query.format(placeholders), (*params, *chunk)))
+        return rows
+
+    def get_items(self, keys: List[str]) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """key -> (record JSON, problem)"""
+        rows = self._select("SELECT key, record, problem FROM records WHERE key IN ({})", keys)
+        return {key: (record, problem) for key, record, problem in rows}
+
+    def put_items(self, rows: List[Tuple[str, Optional[str], Optional[str]]], build: int) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+            [(*row, build) for row in rows],
+        )
+
+    def get_tokens(self, keys: List[str], recipe: str) -> Dict[str, Optional[bytes]]:
+        """key -> int32 token ids (None for items that format to an empty text)"""
+        rows = self._select("SELECT key, input_ids FROM tokens WHERE recipe = ? AND key IN ({})", keys, recipe)
+        return dict(rows)
+
+    def put_tokens(self, rows: List[Tuple[str, Optional[bytes]]], recipe: str, build: int) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+            [(key, recipe, input_ids, build) for key, input_ids in rows],
+        )
+
+    def touch(self, table: str, keys: List[str], build: int, recipe: Optional[str] = None) -> None:
+        """Mark cache hits as used by this build"""
+        where = "recipe = ? AND key = ?" if recipe else "key = ?"
+        self.conn.executemany(
+            f"UPDATE {table} SET last_seen = ? WHERE {where}",
+            [(build, recipe, key) if recipe else (build, key) for key in keys],
+        )
+
+    def collect_garbage(self, min_build: int) -> Dict[str, int]:
+        """Delete entries not used since `min_build`"""
+        removed = {
+            name: self.conn.execute(f"DELETE FROM {table} WHERE last_seen < ?", (min_build,)).rowcount
+            for name, table in (("items", "records"), ("tokens", "tokens"))
+        }
+        self.conn.commit()
+        return removed
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+class _TokenizedSplitWriter:
+    """Arrow stream of input_ids / attention_mask / labels, the layout tokenize_text_dataset produces"""
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.path = path
+        ids_type = pa.list_(pa.int64())
+        self.schema = pa.schema([("input_ids", ids_type), ("attention_mask", ids_type), ("labels", ids_type)])
+        self.writer = pa.ipc.new_stream(path, self.schema)
+        self.rows = 0
+
+    def write(self, sequences: List[np.ndarray]) -> None:
+        if not sequences:
+            return
+        pa = self.pa
+        offsets = pa.array(np.concatenate([[0], np.cumsum([len(ids) for ids in sequences])]), type=pa.int32())
+        values = np.concatenate(sequences).astype(np.int64)
+        input_ids = pa.ListArray.from_arrays(offsets, pa.array(values))
+        attention_mask = pa.ListArray.from_arrays(offsets, pa.array(np.ones_like(values)))
+        self.writer.write_batch(pa.record_batch([input_ids, attention_mask, input_ids], schema=self.schema))
+        self.rows += len(sequences)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class IncrementalDatasetBuilder:
+    """
+    Build train/val/test splits from sources, reusing per-item work across builds
+
+    Every build rewrites `<output_dir>/{train,val,test}.jsonl` (and, with a
+    tokenizer, `tokenized/<split>.arrow`) from cached records; only items
+    whose fingerprint is new are converted, validated and tokenized. Invalid
+    items are left out and listed in the manifest.
+    """
+
+    def __init__(self, output_dir: str = "data/build", cache_path: str = "cache/incremental_build.sqlite",
+                 input_format: str = "auto", ratios: Tuple[float, float, float] = (0.8, 0.1, 0.1),
+                 seed: int = 3407, group_key: str = "conversationID", tokenizer: Any = None,
+                 chat_template_path: str = "data/chat_template.txt", max_seq_length: int = 2048,
+                 dataset_cache_dir: Optional[str] = "cache/tokenized_datasets", keep_builds: int = 0,
+                 chunk_size: int = 1000):
+        if abs(sum(ratios) - 1.0) > 1e-6:
+            raise ValueError("Ratios must sum to 1.0")
+
+        self.output_dir = output_dir
+        self.input_format = input_format
+        self.ratios = tuple(ratios)
+        self.seed = seed
+        self.group_key = group_key
+        self.max_seq_length = max_seq_length
+        self.dataset_cache_dir = dataset_cache_dir
+        self.keep_builds = keep_builds
+        self.chunk_size = chunk_size
+        self.cache = ItemCache(cache_path)
+
+        self.tokenizer = None
+        self.recipe = None
+        if tokenizer is not None:
+            self._setup_tokenizer(tokenizer, chat_template_path)
+
+    def _setup_tokenizer(self, tokenizer: Any, chat_template_path: str) -> None:
+        from .formatting import ChatTemplateFormatter
+        from .dataset_cache import CACHE_VERSION, tokenizer_fingerprint
+
+        if isinstance(tokenizer, str):
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer, trust_remote_code=True)
+        with open(chat_template_path, 'r', encoding='utf-8') as f:
+            self.chat_template = f.read().strip()
+        tokenizer.chat_template = self.chat_template
+
+        self.tokenizer = tokenizer
+        self.formatter = ChatTemplateFormatter(tokenizer)
+        parts = {
+            "version": CACHE_VERSION,
+            "template": hashlib.sha256(self.chat_template.encode("utf-8")).hexdigest(),
+            "tokenizer": tokenizer_fingerprint(tokenizer),
+            "max_seq_length": self.max_seq_length,
+        }
+        self.recipe = hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+    def convert(self, item: Any) -> Tuple[Optional[str], Optional[str]]:
+        """(record JSON, problem) for one source item"""
+        fmt = DataProcessor._detect_item_format(item) if self.input_format == "auto" else self.input_format
+        try:
+            conversations = DataProcessor._convert_item_to_chatml(item, fmt)
+        except Exception as e:
+            return None, f"{fmt}: {e}"
+
+        record: Dict[str, Any] = {"conversations": conversations}
+        if isinstance(item, dict):
+            record.update({
+                key: value for key, value in item.items()
+                if key not in FORMAT_FIELDS and (value is None or isinstance(value, (str, int, float, bool)))
+            })
+
+        problem = check_record(record)
+        return json.dumps(record, ensure_ascii=False), f"{problem[0]}: {problem[1]}" if problem else None
+
+    def _split(self, record_json: str) -> str:
+        # The group is read here rather than cached with the record, so changing group_key applies to cached items
+        record = json.loads(record_json)
+        group = record.get(self.group_key)
+        if group is None:
+            # Same content fallback as DataProcessor.split_data
+            group = json.dumps(record.get("conversations"), ensure_ascii=False, sort_keys=True)
+        return hash_split(group, self.ratios, self.seed)
+
+    def _tokenize(self, keys: List[str], records: List[str], build: int, stats: Dict[str, int]) -> List[Optional[np.ndarray]]:
+        """Token ids per record (None when the formatted text is empty), tokenizing cache misses only"""
+        from .formatting import tokenize_texts
+
+        cached = self.cache.get_tokens(keys, self.recipe)
+        self.cache.touch("tokens", [key for key in keys if key in cached], build, self.recipe)
+
+        misses = [(key, record) for key, record in zip(keys, records) if key not in cached]
+        if misses:
+            texts = [self.formatter.format_batch([json.loads(record).get("conversations")]) for _, record in misses]
+            texts = [batch[0] if batch else "" for batch in texts]
+            nonempty = [i for i, text in enumerate(texts) if text.strip()]
+            tokenized = tokenize_texts(self.tokenizer, [texts[i] for i in nonempty], self.max_seq_length)
+            new = {key: None for key, _ in misses}
+            for i, input_ids in zip(nonempty, tokenized["input_ids"]):
+                new[misses[i][0]] = np.asarray(input_ids, dtype=np.int32).tobytes()
+            self.cache.put_tokens(list(new.items()), self.recipe, build)
+            cached.update(new)
+            stats["tokenized_new"] += len(misses)
+
+        return [None if cached[key] is None else np.frombuffer(cached[key], dtype=np.int32) for key in keys]
+
+    def build(self, sources: List[str]) -> Dict[str, Any]:
+        """Run one build over `sources` (in order) and write the splits and manifest"""
+        start = time.time()
+        build = self.cache.next_build()
+        os.makedirs(self.output_dir, exist_ok=True)
+        logger.info(f"🧱 Incremental build {build}: {len(sources)} sources -> {self.output_dir}")
+
+        stats: Dict[str, int] = dict.fromkeys(["items", "new", "reused", "invalid", "tokenized_new"], 0)
+        counts = dict.fromkeys(SPLIT_NAMES, 0)
+        invalid_examples: List[Dict[str, Any]] = []
+        source_stats: List[Dict[str, Any]] = []
+
+        paths = {name: os.path.join(self.output_dir, f"{name}.jsonl") for name in SPLIT_NAMES}
+        files = {name: open(path, 'w', encoding='utf-8') for name, path in paths.items()}
+        token_writers: Dict[str, _TokenizedSplitWriter] = {}
+        if self.tokenizer is not None:
+            os.makedirs(os.path.join(self.output_dir, "tokenized"), exist_ok=True)
+            token_writers = {
+                name: _TokenizedSplitWriter(os.path.join(self.output_dir, "tokenized", f"{name}.arrow"))
+                for name in SPLIT_NAMES
+            }
+
+        try:
+            for source in sources:
+                source_start = time.time()
+                before = dict(stats)
+                index = 0
+                for chunk in _batched(iter_source(source), self.chunk_size):
+                    keys = [item_key(item, self.input_format) for item in chunk]
+                    cached = self.cache.get_items(keys)
+                    self.cache.touch("records", [key for key in keys if key in cached], build)
+
+                    new_rows = []
+                    for key, item in zip(keys, chunk):
+                        if key not in cached:
+                            cached[key] = self.convert(item)
+                            new_rows.append((key, *cached[key]))
+                    self.cache.put_items(new_rows, build)
+                    stats["new"] += len(new_rows)
+                    stats["reused"] += len(chunk) - len(new_rows)
+                    stats["items"] += len(chunk)
+
+                    valid: Dict[str, List[Tuple[str, str]]] = {name: [] for name in SPLIT_NAMES}
+                    for offset, key in enumerate(keys):
+                        record_json, problem = cached[key]
+                        if problem:
+                            stats["invalid"] += 1
+                            if len(invalid_examples) < MAX_INVALID_EXAMPLES:
+                                invalid_examples.append({"source": source, "index": index + offset, "problem": problem})
+                            continue
+                        valid[self._split(record_json)].append((key, record_json))
+
+                    for name, rows in valid.items():
+                        files[name].writelines(record_json + "\n" for _, record_json in rows)
+                        counts[name] += len(rows)
+                        if token_writers and rows:
+                            sequences = self._tokenize([key for key, _ in rows], [record for _, record in rows], build, stats)
+                            token_writers[name].write([ids for ids in sequences if ids is not None])
+
+                    self.cache.conn.commit()
+                    index += len(chunk)
+
+                source_stats.append({
+                    "path": source,
+                    "items": stats["items"] - before["items"],
+                    "new": stats["new"] - before["new"],
+                    "invalid": stats["invalid"] - before["invalid"],
+                    "time_s": round(time.time() - source_start, 2),
+                })
+                logger.info(f"   {source}: {source_stats[-1]['items']} items, {source_stats[-1]['new']} new")
+        finally:
+            for f in files.values():
+                f.close()
+            for writer in token_writers.values():
+                writer.close()
+
+        splits: Dict[str, Dict[str, Any]] = {name: {"path": paths[name], "samples": counts[name]} for name in SPLIT_NAMES}
+        if token_writers:
+            for name, writer in token_writers.items():
+                splits[name]["tokenized_path"] = writer.path
+                splits[name]["tokenized_rows"] = writer.rows
+                if self.dataset_cache_dir:
+                    splits[name]["dataset_cache_key"] = self._register_tokenized(paths[name], writer.path)
+
+        removed = self.cache.collect_garbage(build - self.keep_builds)
+        manifest = {
+            "build": build,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "settings": {
+                "input_format": self.input_format,
+                "ratios": list(self.ratios),
+                "seed": self.seed,
+                "group_key": self.group_key,
+                "max_seq_length": self.max_seq_length if self.tokenizer is not None else None,
+                "token_recipe": self.recipe,
+            },
+            "sources": source_stats,
+            **stats,
+            "splits": splits,
+            "invalid_examples": invalid_examples,
+            "gc_removed": removed,
+            "time_s": round(time.time() - start, 2),
+        }
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        logger.info(
+            f"✅ Build {build}: {stats['items']} items ({stats['new']} new, {stats['reused']} cached, "
+            f"{stats['invalid']} invalid), {stats['tokenized_new']} tokenized, "
+            f"{counts['train']}/{counts['val']}/{counts['test']} train/val/test, "
+            f"{removed['items']} stale entries removed, {manifest['time_s']}s"
+        )
+        return manifest
+
+    def _register_tokenized(self, data_path: str, arrow_path: str) -> str:
+        """Save a tokenized split under the key the trainers compute for `data_path`"""
+        from datasets import Dataset
+        from .dataset_cache import TokenizedDatasetCache
+
+        cache = TokenizedDatasetCache(self.dataset_cache_dir)
+        key = cache.make_key(data_path, self.chat_template, self.tokenizer, self.max_seq_length, PLAIN_RECIPE)
+        if cache.load(key) is None:
+            cache.save(key, Dataset.from_file(arrow_path),
+                       {"data_path": data_path, "recipe": PLAIN_RECIPE, "source": "incremental build"})
+        return key
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+def main():
+    """Incremental dataset build CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Incremental convert/validate/split/tokenize with per-item caching")
+    parser.add_argument("sources", nargs="+", help=".json/.jsonl/.parquet/.arrow/.xlsx/.csv files, in order")
+    parser.add_argument("--output-dir", default="data/build")
+    parser.add_argument("--cache-path", default="cache/incremental_build.sqlite")
+    parser.add_argument("--input-format", default="auto", choices=["auto", "conversations", "alpaca", "sharegpt"])
+    parser.add_argument("--ratios", type=float, nargs=3, default=[0.8, 0.1, 0.1], metavar=("TRAIN", "VAL", "TEST"))
+    parser.add_argument("--seed", type=int, default=3407)
+    parser.add_argument("--group-key", default="conversationID")
+    parser.add_argument("--tokenizer", default=None, help="Also tokenize (model name or path)")
+    parser.add_argument("--chat-template", default="data/chat_template.txt")
+    parser.add_argument("--max-seq-length", type=int, default=2048)
+    parser.add_argument("--dataset-cache-dir", default="cache/tokenized_datasets",
+                        help="Trainers' tokenized-dataset cache to register splits in ('' disables)")
+    parser.add_argument("--keep-builds", type=int, default=0,
+                        help="Keep cache entries last used up to N builds ago (0 = only the current build)")
+    args = parser.parse_args()
+
+    builder = IncrementalDatasetBuilder(
+        output_dir=args.output_dir,
+        cache_path=args.cache_path,
+        input_format=args.input_format,
+        ratios=tuple(args.ratios),
+        seed=args.seed,
+        group_key=args.group_key,
+        tokenizer=args.tokenizer,
+        chat_template_path=args.chat_template,
+        max_seq_length=args.max_seq_length,
+        dataset_cache_dir=args.dataset_cache_dir or None,
+        keep_builds=args.keep_builds,
+    )
+    try:
+        builder.build(args.sources)
+    finally:
+        builder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Intent label helpers shared by training and serving
+Keeps the Pika user-intent label set in one place
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import re
+import json
+from typing import Optional
+
+# User intent types produced by the fast-response labelling prompt
+INTENT_LABELS = ["positive", "negative", "neutral", "fallback", "silence"]
+
+_INTENT_WORD_RE = re.compile(r"\b(" + "|".join(INTENT_LABELS) + r")\b")
+
+
+def normalize_intent(value) -> Optional[str]:
+    """Normalize a raw intent value to one of INTENT_LABELS (or None)"""
+    if value is None:
+        return None
+
+    intent = str(value).strip().lower()
+    if intent in INTENT_LABELS:
+        return intent
+
+    return None
+
+
+def extract_intent(text: str) -> Optional[str]:
+    """
+    Extract an intent label from model output
+
+    Handles JSON outputs ({"user_intent": ...} / {"intent": ...}, optionally
+    wrapped in a markdown code block) and falls back to the first label word
+    that appears in the text.
+    """
+    if not text:
+        return None
+
+    cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", str(text).strip())
+    try:
+        data = json.loads(cleaned)
+        if isinstance(data, dict):
+            intent = normalize_intent(data.get("user_intent", data.get("intent")))
+            if intent is not None:
+                return intent
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    match = _INTENT_WORD_RE.search(str(text).lower())
+    return match.group(1) if match else None
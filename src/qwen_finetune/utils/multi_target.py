@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Multi-target conversation training
+One sequence per conversation with loss on every assistant message marked
+`"target": true`, instead of one sliding-window sample per turn
+
+Data format:
+    {"conversations": [
+        {"role": "system", "content": "..."},
+        {"role": "assistant", "content": "<bot turn>"},
+        {"role": "user", "content": "<user turn>"},
+        {"role": "assistant", "content": "<fast response>", "target": true},
+        ...
+    ]}
+
+A turn ends with each target message. Attention modes:
+- "causal": plain causal attention over the whole conversation
+- "window": a token of turn t sees the system prompt, context (non-target)
+  tokens of turns t-W+1..t and only its own target message, matching the
+  visible context of the W-turn sliding-window samples
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import bisect
+import logging
+from typing import Dict, List, Any, Optional
+
+import torch
+from datasets import Dataset
+
+from qwen_finetune.utils.packing import IGNORE_INDEX, ASSISTANT_SPAN_RE
+from qwen_finetune.utils.formatting import ChatTemplateFormatter, normalize_role
+
+logger = logging.getLogger(__name__)
+
+# Token types
+TOKEN_SYSTEM = 0
+TOKEN_CONTEXT = 1
+TOKEN_TARGET = 2
+
+ATTENTION_MODES = ["window", "causal"]
+
+
+def normalize_multi_target_conversation(convo: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Normalize roles/content and keep the target flag (only on assistant turns)"""
+    normalized = []
+    for turn in convo or []:
+        if not isinstance(turn, dict) or "role" not in turn or "content" not in turn:
+            continue
+
+        role = normalize_role(turn["role"])
+        normalized.append({
+            "role": role,
+            "content": str(turn["content"]).strip(),
+            "target": bool(turn.get("target")) and role == "assistant",
+        })
+    return normalized
+
+
+def encode_multi_target(tokenizer, convo: List[Dict[str, Any]], max_length: int,
+                        compact_positions: bool = False,
+                        formatter: Optional[ChatTemplateFormatter] = None) -> Dict[str, List[int]]:
+    """
+    Tokenize one multi-target conversation
+
+    Returns input_ids, labels (target assistant bodies only), position_ids,
+    turn_ids and token_types. With `compact_positions`, target tokens do not
+    advance the position counter, so each target sits right after its context
+    as it would in a sliding-window sample.
+    """
+    messages = [{"role": turn["role"], "content": turn["content"]} for turn in convo]
+    formatter = formatter or ChatTemplateFormatter(tokenizer)
+
+    # Character span of every message, from prefix renders of the template
+    boundaries = [0]
+    for k in range(1, len(messages) + 1):
+        prefix = formatter.render(messages[:k])
+        boundaries.append(len(prefix))
+    text = prefix
+
+    encoded = tokenizer(
+        text,
+        truncation=True,
+        max_length=max_length,
+        padding=False,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+    )
+
+    # Per-message token type, turn id and (for targets) the supervised body span
+    message_types, message_turns, target_spans = [], [], {}
+    turn = 0
+    for k, turn_data in enumerate(convo):
+        message_turns.append(turn)
+        if turn_data["role"] == "system":
+            message_types.append(TOKEN_SYSTEM)
+        elif turn_data["target"]:
+            message_types.append(TOKEN_TARGET)
+            match = ASSISTANT_SPAN_RE.search(text, boundaries[k], boundaries[k + 1])
+            if match:
+                target_spans[k] = match.span(1)
+            turn += 1
+        else:
+            message_types.append(TOKEN_CONTEXT)
+
+    input_ids = encoded["input_ids"]
+    labels, token_types, turn_ids, position_ids = [], [], [], []
+    context_position = 0
+    target_position = 0
+    previous_message = -1
+    for token_id, (start, _) in zip(input_ids, encoded["offset_mapping"]):
+        k = min(max(bisect.bisect_right(boundaries, start) - 1, 0), len(convo) - 1)
+        token_type = message_types[k]
+        token_types.append(token_type)
+        turn_ids.append(message_turns[k])
+
+        span = target_spans.get(k)
+        labels.append(token_id if span and span[0] <= start < span[1] else IGNORE_INDEX)
+
+        if compact_positions and token_type == TOKEN_TARGET:
+            if k != previous_message:
+                target_position = context_position
+            position_ids.append(target_position)
+            target_position += 1
+        else:
+            position_ids.append(context_position)
+            context_position += 1
+        previous_message = k
+
+    if not compact_positions:
+        position_ids = list(range(len(input_ids)))
+
+    return {
+        "input_ids": input_ids,
+        "labels": labels,
+        "position_ids": position_ids,
+        "turn_ids": turn_ids,
+        "token_types": token_types,
+    }
+
+
+def window_attention_mask(turn_ids: torch.Tensor, token_types: torch.Tensor, window: int) -> torch.Tensor:
+    """Boolean [L, L] mask (True = may attend) for the window attention mode"""
+    length = turn_ids.shape[0]
+    positions = torch.arange(length)
+    causal = positions[None, :] <= positions[:, None]
+
+    query_turn, key_turn = turn_ids[:, None], turn_ids[None, :]
+    key_type = token_types[None, :]
+
+    visible = (
+        (key_type == TOKEN_SYSTEM)
+        | ((key_type == TOKEN_CONTEXT) & (key_turn > query_turn - window))
+        | ((key_type == TOKEN_TARGET) & (key_turn == query_turn))
+    )
+    return causal & visible
+
+
+def window_equivalent_tokens(token_types: List[int], turn_ids: List[int], window: int) -> int:
+    """Tokens the same targets would cost as separate sliding-window samples"""
+    system = sum(1 for t in token_types if t == TOKEN_SYSTEM)
+    context_per_turn: Dict[int, int] = {}
+    target_per_turn: Dict[int, int] = {}
+    for token_type, turn in zip(token_types, turn_ids):
+        if token_type == TOKEN_CONTEXT:
+            context_per_turn[turn] = context_per_turn.get(turn, 0) + 1
+        elif token_type == TOKEN_TARGET:
+            target_per_turn[turn] = target_per_turn.get(turn, 0) + 1
+
+    return sum(
+        system + target + sum(context_per_turn.get(t, 0) for t in range(turn - window + 1, turn + 1))
+        for turn, target in target_per_turn.items()
+    )
+
+
+class MultiTargetDataCollator:
+    """Pad multi-target samples and build the window attention mask (additive, in `dtype`)"""
+
+    def __init__(self, pad_token_id: int, window: int = 3, dtype: torch.dtype = torch.float32):
+        self.pad_token_id = pad_token_id
+        self.window = window
+        self.dtype = dtype
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        batch_size = len(features)
+        seq_len = max(len(feature["input_ids"]) for feature in features)
+
+        input_ids = torch.full((batch_size, seq_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, seq_len), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, seq_len), dtype=torch.long)
+        allowed = torch.zeros((batch_size, seq_len, seq_len), dtype=torch.bool)
+
+        for b, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[b, :length] = torch.tensor(feature["input_ids"], dtype=torch.long)
+            labels[b, :length] = torch.tensor(feature["labels"], dtype=torch.long)
+            position_ids[b, :length] = torch.tensor(feature["position_ids"], dtype=torch.long)
+            allowed[b, :length, :length] = window_attention_mask(
+                torch.tensor(feature["turn_ids"]), torch.tensor(feature["token_types"]), self.window
+            )
+
+            # Padding attends to itself only so softmax stays finite
+            pad = torch.arange(length, seq_len)
+            allowed[b, pad, pad] = True
+
+        attention_mask = torch.zeros((batch_size, 1, seq_len, seq_len), dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed.unsqueeze(1), torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
+
+
+def build_multi_target_dataset(tokenizer, dataset: Dataset, max_length: int, attention: str = "window",
+                               window: int = 3, num_proc: Optional[int] = None) -> Dataset:
+    """
+    Tokenize a dataset of multi-target conversations
+
+    In "causal" mode only input_ids/labels are kept, so the result can go
+    through the regular or packed collators; "window" mode keeps the
+    per-token turn ids and types for MultiTargetDataCollator.
+    """
+    if attention not in ATTENTION_MODES:
+        raise ValueError(f"Unknown multi-target attention mode: {attention}")
+
+    formatter = ChatTemplateFormatter(tokenizer)
+    
+    def encode_batch(batch):
+        columns = {"input_ids": [], "labels": [], "position_ids": [], "turn_ids": [], "token_types": []}
+        for convo in batch["conversations"]:
+            normalized = normalize_multi_target_conversation(convo)
+            if not any(turn["target"] for turn in normalized):
+                continue
+            encoded = encode_multi_target(
+                tokenizer, normalized, max_length, compact_positions=attention == "window", formatter=formatter
+            )
+            if all(label == IGNORE_INDEX for label in encoded["labels"]):
+                continue
+            for key in columns:
+                columns[key].append(encoded[key])
+        return columns
+
+    tokenized = dataset.map(
+        encode_batch,
+        batched=True,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        desc="Tokenizing multi-target conversations",
+    )
+
+    sequence_tokens = sum(len(ids) for ids in tokenized["input_ids"])
+    targets = sum(len({t for t, k in zip(turns, types) if k == TOKEN_TARGET})
+                  for turns, types in zip(tokenized["turn_ids"], tokenized["token_types"]))
+    windowed_tokens = sum(window_equivalent_tokens(types, turns, window)
+                          for turns, types in zip(tokenized["turn_ids"], tokenized["token_types"]))
+    logger.info(
+        f"Multi-target dataset: {len(tokenized)} conversations, {targets} targets, "
+        f"{sequence_tokens} tokens (vs {windowed_tokens} as {window}-turn windows, "
+        f"{windowed_tokens / max(sequence_tokens, 1):.1f}x fewer)"
+    )
+
+    if attention == "causal":
+        tokenized = tokenized.remove_columns(["position_ids", "turn_ids", "token_types"])
+    return tokenized
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Sequence packing utilities for fine-tuning
+Packs short ChatML samples into full-length rows with position-ID resets,
+per-sample attention isolation and assistant-only labels
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import re
+import bisect
+import logging
+from typing import Dict, List, Any, Optional
+
+import torch
+from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+IGNORE_INDEX = -100
+
+# Assistant turn body (content + closing tag) in a rendered ChatML string
+ASSISTANT_SPAN_RE = re.compile(r"<\|im_start\|>assistant\n(.*?<\|im_end\|>)", re.DOTALL)
+
+
+def assistant_char_spans(text: str) -> List[tuple]:
+    """Character spans of every assistant turn body in a rendered ChatML text"""
+    return [match.span(1) for match in ASSISTANT_SPAN_RE.finditer(text)]
+
+
+def tokenize_with_assistant_labels(tokenizer, texts: List[str], max_length: int) -> Dict[str, List[List[int]]]:
+    """
+    Tokenize rendered ChatML texts with loss only on assistant turns
+
+    Tokens overlapping an assistant span (including its <|im_end|>) keep their
+    id as label; system/user tokens and role headers get IGNORE_INDEX.
+    Requires a fast tokenizer (offset mapping).
+    """
+    encoded = tokenizer(
+        texts,
+        truncation=True,
+        max_length=max_length,
+        padding=False,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+    )
+
+    all_labels = []
+    for text, input_ids, offsets in zip(texts, encoded["input_ids"], encoded["offset_mapping"]):
+        spans = assistant_char_spans(text)
+        labels = [IGNORE_INDEX] * len(input_ids)
+        span_idx = 0
+        for i, (start, end) in enumerate(offsets):
+            while span_idx < len(spans) and spans[span_idx][1] <= start:
+                span_idx += 1
+            if span_idx == len(spans):
+                break
+            span_start, span_end = spans[span_idx]
+            if end > span_start and start < span_end:
+                labels[i] = input_ids[i]
+        all_labels.append(labels)
+
+    return {"input_ids": encoded["input_ids"], "labels": all_labels}
+
+
+def pack_sequences(dataset: Dataset, max_length: int) -> Dataset:
+    """
+    Pack tokenized samples into rows of at most `max_length` tokens
+
+    Uses best-fit-decreasing bin packing. Each output row keeps
+    `input_ids`, `labels`, `position_ids` (reset to 0 at every sample start)
+    and `seq_lengths` (per-sample lengths, used to build attention boundaries).
+    Samples with no supervised tokens are dropped.
+    """
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    labels = dataset["labels"]
+    order = sorted(
+        (i for i in range(len(lengths)) if any(label != IGNORE_INDEX for label in labels[i])),
+        key=lambda i: lengths[i],
+        reverse=True,
+    )
+    dropped = len(lengths) - len(order)
+
+    # Best fit: sorted remaining capacities, smallest bin that still fits
+    bins: List[List[int]] = []
+    remaining: List[tuple] = []  # (capacity_left, bin_idx), kept sorted
+    for idx in order:
+        length = min(lengths[idx], max_length)
+        pos = bisect.bisect_left(remaining, (length, -1))
+        if pos < len(remaining):
+            capacity, bin_idx = remaining.pop(pos)
+        else:
+            capacity, bin_idx = max_length, len(bins)
+            bins.append([])
+        bins[bin_idx].append(idx)
+        bisect.insort(remaining, (capacity - length, bin_idx))
+
+    input_ids = dataset["input_ids"]
+    rows = {"input_ids": [], "labels": [], "position_ids": [], "seq_lengths": []}
+    for members in bins:
+        row_ids, row_labels, row_positions, row_lengths = [], [], [], []
+        for idx in members:
+            ids = input_ids[idx][:max_length]
+            row_ids.extend(ids)
+            row_labels.extend(labels[idx][:max_length])
+            row_positions.extend(range(len(ids)))
+            row_lengths.append(len(ids))
+        rows["input_ids"].append(row_ids)
+        rows["labels"].append(row_labels)
+        rows["position_ids"].append(row_positions)
+        rows["seq_lengths"].append(row_lengths)
+
+    stats = packing_stats(lengths, rows["seq_lengths"], max_length)
+    logger.info(
+        f"Packed {stats['samples']} samples into {stats['rows']} rows "
+        f"({stats['samples_per_row']:.1f} samples/row, dropped {dropped} without assistant tokens)"
+    )
+    logger.info(
+        f"Packing efficiency: {stats['packing_efficiency']:.1%} of {max_length}-token rows filled "
+        f"(unpacked padded to max_length: {stats['unpacked_efficiency']:.1%}), "
+        f"{stats['truncated']} samples truncated"
+    )
+    return Dataset.from_dict(rows)
+
+
+def packing_stats(lengths: List[int], seq_lengths: List[List[int]], max_length: int) -> Dict[str, Any]:
+    """Fill rate of packed rows vs. one sample per max_length row"""
+    real_tokens = sum(sum(row) for row in seq_lengths)
+    samples = sum(len(row) for row in seq_lengths)
+    rows = len(seq_lengths)
+    return {
+        "samples": samples,
+        "rows": rows,
+        "samples_per_row": samples / max(rows, 1),
+        "real_tokens": real_tokens,
+        "packing_efficiency": real_tokens / max(rows * max_length, 1),
+        "unpacked_efficiency": real_tokens / max(samples * max_length, 1),
+        "truncated": sum(1 for length in lengths if length > max_length),
+    }
+
+
+class PackedDataCollator:
+    """
+    Collate packed rows so samples sharing a row cannot attend to each other
+
+    - mode "position_ids": flatten the batch into one row and pass only
+      `position_ids`; varlen kernels (flash_attention_2, Unsloth) split
+      sequences at every position reset. No attention_mask is returned.
+    - mode "mask": pad rows and build a 4D block-diagonal causal mask
+      (additive, in `dtype`) for sdpa/eager attention.
+    """
+
+    def __init__(self, pad_token_id: int, mode: str = "mask", dtype: torch.dtype = torch.float32):
+        if mode not in ("position_ids", "mask"):
+            raise ValueError(f"Unknown packed collator mode: {mode}")
+        self.pad_token_id = pad_token_id
+        self.mode = mode
+        self.dtype = dtype
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        if self.mode == "position_ids":
+            return self._flatten(features)
+        return self._block_diagonal(features)
+
+    def _flatten(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        input_ids, labels, position_ids = [], [], []
+        for feature in features:
+            input_ids.extend(feature["input_ids"])
+            position_ids.extend(feature["position_ids"])
+            # The first token of each sample must not be predicted from the previous sample
+            row_labels = list(feature["labels"])
+            start = 0
+            for length in feature["seq_lengths"]:
+                row_labels[start] = IGNORE_INDEX
+                start += length
+            labels.extend(row_labels)
+
+        return {
+            "input_ids": torch.tensor([input_ids], dtype=torch.long),
+            "labels": torch.tensor([labels], dtype=torch.long),
+            "position_ids": torch.tensor([position_ids], dtype=torch.long),
+        }
+
+    def _block_diagonal(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        batch_size = len(features)
+        seq_len = max(len(feature["input_ids"]) for feature in features)
+
+        input_ids = torch.full((batch_size, seq_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, seq_len), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, seq_len), dtype=torch.long)
+        allowed = torch.zeros((batch_size, seq_len, seq_len), dtype=torch.bool)
+
+        for b, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[b, :length] = torch.tensor(feature["input_ids"], dtype=torch.long)
+            position_ids[b, :length] = torch.tensor(feature["position_ids"], dtype=torch.long)
+            row_labels = torch.tensor(feature["labels"], dtype=torch.long)
+
+            start = 0
+            for sample_length in feature["seq_lengths"]:
+                end = start + sample_length
+                allowed[b, start:end, start:end] = torch.ones(sample_length, sample_length, dtype=torch.bool).tril()
+                row_labels[start] = IGNORE_INDEX
+                start = end
+            labels[b, :length] = row_labels
+
+            # Padding rows attend to themselves only so softmax stays finite
+            pad = torch.arange(length, seq_len)
+            allowed[b, pad, pad] = True
+
+        attention_mask = torch.zeros((batch_size, 1, seq_len, seq_len), dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed.unsqueeze(1), torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
+
+
+def build_packed_dataset(tokenizer, dataset: Dataset, max_length: int,
+                         text_field: str = "text", num_proc: Optional[int] = None) -> Dataset:
+    """Tokenize a formatted-text dataset with assistant-only labels and pack it"""
+    tokenized = dataset.map(
+        lambda batch: tokenize_with_assistant_labels(tokenizer, batch[text_field], max_length),
+        batched=True,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        desc="Tokenizing with assistant-only labels",
+    )
+    return pack_sequences(tokenized, max_length)
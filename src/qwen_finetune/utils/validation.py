@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Compiled-schema validation for conversation data
+Records are decoded and type-checked against msgspec structs (pure-Python
+checks when msgspec is not installed), JSONL files are validated in parallel
+byte ranges, and every problem goes to a machine-readable error index
+(`<data>.errors.json`: item index, byte offset, field, reason) that
+`iter_records(..., skip_invalid=True)`, the converters and the trainers use to
+drop bad rows without validating again
+
+Usage:
+    python -m qwen_finetune.utils.validation data/pika_data.jsonl --workers 8
+
+Author: StepUp Education Team
+Date: 2025
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import logging
+import multiprocessing
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Any
+
+try:
+    import msgspec
+except ImportError:  # Same checks in pure Python, just slower
+    msgspec = None
+
+from .dataset_io import iter_records, is_jsonl, error_index_path, file_fingerprint
+
+logger = logging.getLogger(__name__)
+
+VALID_ROLES = ("system", "user", "assistant")
+
+# JSONL files smaller than this are validated in-process
+MIN_BYTES_PER_WORKER = 4 * 1024 * 1024
+MAX_LOGGED_ERRORS = 10
+
+_POSITION_RE = re.compile(r"\[\d+\]")
+
+Problem = Tuple[str, str]  # (field path, reason)
+
+if msgspec is not None:
+    class Turn(msgspec.Struct):
+        """One message; role/content may be any JSON value (the trainers stringify them)"""
+        role: Any
+        content: Any
+
+    class ConversationRecord(msgspec.Struct):
+        """A training record; other fields (user_intent, conversationID, ...) are ignored"""
+        conversations: List[Turn]
+
+    _DECODER = msgspec.json.Decoder(ConversationRecord)
+
+
+def _split_msgspec_error(error: Exception) -> Problem:
+    """'Expected `str`, got `int` - at `$.conversations[0].role`' -> (field, reason)"""
+    message = str(error)
+    reason, _, field = message.partition(" - at `")
+    return (field.rstrip("`"), reason) if field else ("$", message)
+
+
+def _check_turns(turns: List[Tuple[Any, Any]], strict: bool) -> Optional[Problem]:
+    """Value checks on (role, content) pairs, identical for both decoding paths"""
+    if not turns:
+        return "$.conversations", "empty conversation"
+
+    for i, (role, content) in enumerate(turns):
+        role = str(role).strip().lower()
+        if not role:
+            return f"$.conversations[{i}].role", "empty role"
+        if not str(content).strip():
+            return f"$.conversations[{i}].content", "empty content"
+        if strict and role not in VALID_ROLES:
+            return f"$.conversations[{i}].role", f"unknown role '{role}'"
+    return None
+
+
+def _check_python(item: Any, strict: bool) -> Optional[Problem]:
+    if not isinstance(item, dict):
+        return "$", "record is not an object"
+    if "conversations" not in item:
+        return "$", "Object missing required field `conversations`"
+    if not isinstance(item["conversations"], list):
+        return "$.conversations", "Expected `array`"
+
+    turns = []
+    for i, turn in enumerate(item["conversations"]):
+        if not isinstance(turn, dict):
+            return f"$.conversations[{i}]", "Expected `object`"
+        for key in ("role", "content"):
+            if key not in turn:
+                return f"$.conversations[{i}]", f"Object missing required field `{key}`"
+        turns.append((turn["role"], turn["content"]))
+    return _check_turns(turns, strict)
+
+
+def check_record(item: Any, strict: bool = False) -> Optional[Problem]:
+    """(field, reason) for an invalid decoded record, None if it is valid"""
+    if msgspec is None:
+        return _check_python(item, strict)
+    try:
+        record = msgspec.convert(item, ConversationRecord)
+    except msgspec.ValidationError as e:
+        return _split_msgspec_error(e)
+    return _check_turns([(turn.role, turn.content) for turn in record.conversations], strict)
+
+
+def check_line(line: bytes, strict: bool = False) -> Optional[Problem]:
+    """(field, reason) for an invalid JSONL line, decoded straight into the schema"""
+    if msgspec is None:
+        try:
+            return _check_python(json.loads(line), strict)
+        except json.JSONDecodeError as e:
+            return "$", f"invalid JSON: {e}"
+    try:
+        record = _DECODER.decode(line)
+    except msgspec.ValidationError as e:
+        return _split_msgspec_error(e)
+    except msgspec.DecodeError as e:
+        return "$", f"invalid JSON: {e}"
+    return _check_turns([(turn.role, turn.content) for turn in record.conversations], strict)
+
+
+def _byte_ranges(path: str, parts: int) -> List[Tuple[int, int]]:
+    """Split a file into `parts` ranges that start at line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for part in range(1, parts):
+            f.seek(size * part // parts)
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def _validate_range(task: Tuple[str, int, int, bool]) -> Tuple[int, List[Tuple[int, int, str, str]]]:
+    """Worker: (records, [(index within range, byte offset, field, reason)]) for one byte range"""
+    path, start, end, strict = task
+    count, errors = 0, []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                problem = check_line(line, strict)
+                if problem:
+                    errors.append((count, offset, *problem))
+                count += 1
+            offset += len(line)
+    return count, errors
+
+
+def validate_file(path: str, strict: bool = False, num_workers: Optional[int] = None,
+                  write_index: bool = True) -> Dict[str, Any]:
+    """
+    Validate every record of a data file and write its error index
+
+    JSONL is split into byte ranges validated by worker processes; other
+    formats (JSON arrays, Parquet, Arrow) are checked record by record.
+    Record indices count non-blank lines / array elements / rows, the way
+    `iter_records` enumerates them.
+
+    Returns:
+        {"total", "valid", "errors": [{"index", "offset", "field", "reason"}], "summary", ...}
+    """
+    start = time.perf_counter()
+    errors: List[Dict[str, Any]] = []
+    total = 0
+
+    if is_jsonl(path):
+        num_workers = num_workers or os.cpu_count() or 1
+        parts = max(1, min(num_workers, os.path.getsize(path) // MIN_BYTES_PER_WORKER))
+        tasks = [(path, begin, end, strict) for begin, end in _byte_ranges(path, parts)]
+        if len(tasks) > 1:
+            with multiprocessing.Pool(min(num_workers, len(tasks))) as pool:
+                results = pool.map(_validate_range, tasks, chunksize=1)
+        else:
+            results = [_validate_range(task) for task in tasks]
+
+        for count, range_errors in results:
+            errors.extend(
+                {"index": total + index, "offset": offset, "field": field, "reason": reason}
+                for index, offset, field, reason in range_errors
+            )
+            total += count
+    else:
+        for index, item in enumerate(iter_records(path)):
+            problem = check_record(item, strict)
+            if problem:
+                errors.append({"index": index, "offset": None, "field": problem[0], "reason": problem[1]})
+            total = index + 1
+
+    # Group by field pattern and reason without positions, e.g. "$.conversations[].content: empty content"
+    summary = Counter(
+        f"{_POSITION_RE.sub('[]', error['field'])}: {error['reason'].split(':')[0]}" for error in errors
+    )
+    report = {
+        "path": os.path.basename(path),
+        "fingerprint": file_fingerprint(path),
+        "strict": strict,
+        "schema": "msgspec" if msgspec is not None else "python",
+        "total": total,
+        "valid": total - len(errors),
+        "time_s": round(time.perf_counter() - start, 3),
+        "summary": dict(summary.most_common()),
+        "errors": errors,
+    }
+
+    if write_index:
+        with open(error_index_path(path), 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False)
+    return report
+
+
+def log_report(report: Dict[str, Any]) -> None:
+    logger.info(f"✅ Validation completed: {report['valid']}/{report['total']} valid samples "
+                f"({report['time_s']}s, {report['schema']} schema)")
+    for problem, count in report["summary"].items():
+        logger.warning(f"⚠️ {count} x {problem}")
+    for error in report["errors"][:MAX_LOGGED_ERRORS]:
+        logger.warning(f"   item {error['index']}: {error['field']}: {error['reason']}")
+    if report["errors"]:
+        logger.info(f"Error index: {len(report['errors'])} invalid items (skipped with skip_invalid=True)")
+
+
+def main():
+    """Data validation CLI"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description="Validate conversation data and write its error index")
+    parser.add_argument("data_path")
+    parser.add_argument("--strict", action="store_true", help="Only system/user/assistant roles")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for JSONL files (default: CPU count)")
+    args = parser.parse_args()
+
+    report = validate_file(args.data_path, strict=args.strict, num_workers=args.workers)
+    log_report(report)
+    logger.info(f"Error index written to: {error_index_path(args.data_path)}")
+    if report["valid"] < report["total"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,14 +29,14 @@ setup(
     install_requires=[
         # PyTorch ecosystem
         "torch>=2.0.0",
-        "transformers>=4.40.0",
+        "transformers>=4.46.0",
         "datasets>=2.18.0",
         "accelerate>=0.28.0",
         "peft>=0.10.0",
         "trl>=0.8.0",
         
         # vLLM for serving
-        "vllm>=0.4.0",
+        "vllm>=0.6.4",
         
         # Web framework
         "fastapi>=0.100.0",
@@ -47,6 +47,8 @@ setup(
         "pyyaml>=6.0",
         "numpy>=1.21.0",
         "pandas>=1.3.0",
+        "pyarrow>=12.0.0",
+        "msgspec>=0.18.0",
         
         # Optional monitoring
         "wandb>=0.15.0",
@@ -99,6 +101,15 @@ setup(
             "qwen-train=qwen_finetune.training.finetune_unsloth_chatml:main",
             "qwen-serve=qwen_finetune.serving.vllm_server:main",
             "qwen-process-data=qwen_finetune.utils.data_processor:main",
+            "qwen-fast-index=qwen_finetune.serving.fast_response_index:main",
+            "qwen-quantize=qwen_finetune.training.quantize_model:main",
+            "qwen-merge-lora=qwen_finetune.training.merge_lora:main",
+            "qwen-distill-intent=qwen_finetune.training.intent_distill:main",
+            "qwen-format-bench=qwen_finetune.utils.formatting:main",
+            "qwen-scaling-bench=qwen_finetune.training.distributed:main",
+            "qwen-sweep=qwen_finetune.training.sweep:main",
+            "qwen-validate-data=qwen_finetune.utils.validation:main",
+            "qwen-build-data=qwen_finetune.utils.incremental:main",
         ],
     },
     